@@ -0,0 +1,98 @@
+import os
+import gzip
+import socket
+import logging
+import threading
+from storage import storage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "data/archive")
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", 256 * 1024 * 1024))
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "true").lower() in ("1", "true", "yes")
+CODEC = 'zstd' if zstandard else 'gzip'
+
+
+def compress(data):
+    if CODEC == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Archive record is zstd-compressed; pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class SegmentWriter:
+    # Each process appends to its own segment files, so concurrent workers
+    # never interleave writes and offsets need no cross-process locking.
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.file = None
+        self.name = None
+        self.pid = None
+        self.sequence = 0
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.pid = os.getpid()
+        self.sequence += 1
+        self.name = f"segment-{socket.gethostname()}-{self.pid}-{self.sequence:06d}.log"
+        self.file = open(os.path.join(self.directory, self.name), 'ab')
+
+    def append(self, data):
+        with self.lock:
+            if self.file is None or self.pid != os.getpid() or self.file.tell() >= self.max_size:
+                if self.file is not None and self.pid == os.getpid():
+                    self.file.close()
+                self._open()
+            offset = self.file.tell()
+            self.file.write(data)
+            self.file.flush()
+            return self.name, offset
+
+
+writer = SegmentWriter(ARCHIVE_DIR, ARCHIVE_SEGMENT_SIZE)
+
+
+def archive_response(username, kind, body, cursor=None):
+    # Never lets archiving break a scrape; a missing record only means that
+    # payload can't be replayed later.
+    if not ARCHIVE_ENABLED:
+        return
+    try:
+        data = compress(body)
+        segment, offset = writer.append(data)
+        storage.record_archive(username, kind, cursor, segment, offset, len(data), CODEC, len(body))
+    except Exception as e:
+        logger.error(f"Failed to archive {kind} payload for {username}: {e}")
+
+
+def read_record(record):
+    with open(os.path.join(ARCHIVE_DIR, record['segment']), 'rb') as f:
+        f.seek(record['offset'])
+        return decompress(f.read(record['length']), record['codec'])
+
+
+def iter_records(username=None):
+    # Records in fetch order, optionally for one user.
+    yield from storage.get_archive_records(username)
+
+
+def archived_usernames():
+    return storage.get_archived_usernames()
+
+
+def archive_stats():
+    return storage.get_archive_stats()
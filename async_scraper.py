@@ -0,0 +1,232 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from curl_cffi.requests import AsyncSession
+from insta_scraper import *
+from metrics import track_stages, observe_task
+
+# Runs many ScrapeUser flows in one event loop. Instagram API calls go
+# through a shared AsyncSession; media transfers and SQLite writes are
+# blocking, so they run on a bounded thread pool shared by every profile.
+# Redis-backed calls (rate limiter, proxy stats) run via asyncio.to_thread so
+# a Redis stall can't freeze the loop.
+
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", 50))
+ASYNC_MEDIA_WORKERS = int(os.getenv("ASYNC_MEDIA_WORKERS", 32))
+
+
+async def WaitForToken(bucket, key=None):
+    started = time.monotonic()
+    while True:
+        wait = await asyncio.to_thread(rate_limiter.take, bucket, key)
+        if wait <= 0:
+            record_stage('throttle', time.monotonic() - started, count=0)
+            return
+        await asyncio.sleep(min(wait, 5))
+
+
+async def BackoffAsync(attempt, retry_after=None):
+    delay = BackoffDelay(attempt, retry_after)
+    record_stage('backoff', delay)
+    await asyncio.sleep(delay)
+
+
+async def SendRequestsAsync(session, url):
+    endpoint = urlsplit(url).path
+    for attempt in range(MAX_RETRIES):
+        await WaitForToken('profile')
+        entry = proxy_pool.acquire()
+        if entry:
+            await WaitForToken('proxy', entry.name)
+        started = time.monotonic()
+        try:
+            response = await session.get(url, proxies=entry.proxies if entry else None)
+        except Exception as e:
+            observe_request(endpoint, 'error', time.monotonic() - started)
+            await asyncio.to_thread(proxy_pool.report, entry, False)
+            logger.warning(f"Request error for {url}: {e}")
+            count_retry(endpoint, 'error')
+            await BackoffAsync(attempt)
+            continue
+        elapsed = time.monotonic() - started
+        observe_request(endpoint, response.status_code, elapsed)
+        await asyncio.to_thread(proxy_pool.report, entry, response.status_code in (200, 404, 410),
+                                elapsed, response.status_code)
+        if response.status_code == 200:
+            return response
+        if response.status_code in NOT_FOUND_STATUSES:
+            raise ProfileUnavailable(f"{url} returned HTTP {response.status_code}")
+        if response.status_code not in RETRY_STATUSES:
+            logger.error(f"Giving up on {url}: HTTP {response.status_code}")
+            return None
+        logger.warning(f"HTTP {response.status_code} for {url}, retrying (attempt {attempt + 1})")
+        count_retry(endpoint, response.status_code)
+        await BackoffAsync(attempt, response.headers.get('Retry-After'))
+    return None
+
+
+class AsyncScraper:
+    def __init__(self, concurrency=ASYNC_CONCURRENCY, media_workers=ASYNC_MEDIA_WORKERS):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=media_workers)
+        self.session = AsyncSession(impersonate="chrome131", headers=headers, timeout=30,
+                                    max_clients=concurrency)
+
+    async def close(self):
+        await self.session.close()
+        self.executor.shutdown(wait=True)
+
+    async def run_blocking(self, func, *args):
+        # run_in_executor doesn't carry contextvars over; copy them so stage
+        # timings from the pool reach the profile that scheduled the work.
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, contextvars.copy_context().run, func, *args)
+
+    async def download_all(self, jobs):
+        results = await asyncio.gather(
+            *[self.run_blocking(DownloadMedia, url, filename) for _, url, filename in jobs],
+            return_exceptions=True)
+        failed = {}
+        stored = {}
+        for (post_id, url, filename), s3_key in zip(jobs, results):
+            if s3_key and not isinstance(s3_key, Exception):
+                logger.info(f"Media stored: {filename} -> {s3_key}")
+                stored[filename] = s3_key
+            else:
+                logger.error(f"Media failed: {filename} {s3_key if isinstance(s3_key, Exception) else ''}")
+                failed.setdefault(post_id, []).append(filename)
+        return failed, stored
+
+    async def fetch_timeline_page(self, user_data, cursor):
+        # As in FetchTimelinePage, a timeline 404 doesn't mean the account is gone.
+        try:
+            response = await SendRequestsAsync(self.session, TimelineUrl(user_data['id'], cursor))
+        except ProfileUnavailable as e:
+            logger.error(f"{user_data['username']}: timeline unavailable: {e}")
+            return None
+        if response is None:
+            return None
+        await self.run_blocking(archive_response, user_data['username'], 'timeline', response.content, cursor)
+        return ParseTimelinePage(response.json())
+
+    async def walk_timeline(self, user_data, page, cursor, budget, checkpoint, stop_at_known, profile=False,
+                            retry=None):
+        # Async twin of WalkTimeline; persistence is shared via SaveTimelinePage.
+        username = user_data['username']
+        pages = 0
+        while True:
+            pages += 1
+            next_cursor = NextCursor(page)
+            new_posts, media_jobs, reached_known = await self.run_blocking(
+                SelectNewPosts, user_data, page.get('edges', []))
+            failed, stored = await self.download_all(media_jobs)
+            new_posts = ResolveMedia(user_data, new_posts, failed, stored)
+            await self.run_blocking(SaveTimelinePage, user_data, page, cursor, new_posts,
+                                    set(failed), checkpoint, profile and pages == 1)
+            logger.info(f"{username}: page {pages} saved {len(new_posts)} new posts")
+            if retry is not None:
+                retry.update(page.get('edges', []), failed, not next_cursor)
+
+            if failed and checkpoint:
+                break
+            if (stop_at_known and reached_known and (retry is None or retry.passed)) or not next_cursor or pages >= budget:
+                break
+            page = await self.fetch_timeline_page(user_data, next_cursor)
+            if page is None:
+                logger.error(f"Failed to fetch timeline page for {username}")
+                break
+            cursor = next_cursor
+        return pages
+
+    async def scrape_user(self, username):
+        logger.info(f"Processing user: {username}")
+        response = await SendRequestsAsync(self.session, ProfileUrl(username))
+        if response is None:
+            logger.error(f"Failed to fetch profile for {username}")
+            return False
+        await self.run_blocking(archive_response, username, 'profile', response.content)
+        raw_user, user_data, timeline, posts_count = ParseProfile(response.json(), username)
+        state = await self.run_blocking(storage.get_scraping_status, username) or {}
+        if raw_user.get('is_private'):
+            await self.run_blocking(SavePrivateProfile, user_data, posts_count, state)
+            return True
+
+        backfill_done, resume_cursor, deep = TimelinePlan(state)
+        retry = None if deep else RetryMark(state.get('retry_taken_at'))
+        pages = await self.walk_timeline(user_data, timeline, None, MAX_TIMELINE_PAGES,
+                                         checkpoint=deep, stop_at_known=not deep, profile=True, retry=retry)
+        if not deep and not backfill_done and pages < MAX_TIMELINE_PAGES:
+            logger.info(f"Resuming backfill for {username}")
+            page = await self.fetch_timeline_page(user_data, resume_cursor)
+            if page is not None:
+                pages += await self.walk_timeline(user_data, page, resume_cursor, MAX_TIMELINE_PAGES - pages,
+                                                  checkpoint=True, stop_at_known=False)
+
+        await self.run_blocking(storage.write, CompletionOps(user_data, posts_count, state, retry))
+        logger.info(f"Completed {username}: {pages} timeline pages processed")
+        return True
+
+    async def scrape_one(self, username):
+        async with self.semaphore:
+            with track_stages() as timings:
+                result = await self.scrape_tracked(username)
+                observe_task('async', result['status'], time.monotonic() - timings.started)
+                await self.run_blocking(storage.record_stage_timings, username, timings.as_dict())
+            return result
+
+    async def scrape_tracked(self, username):
+        await self.run_blocking(storage.update_scraping_status, username, 'running')
+        permanent = False
+        try:
+            if await self.scrape_user(username):
+                return {"status": "success", "username": username}
+            error = f"Scraper failed for {username}"
+        except Exception as e:
+            logger.error(f"Error scraping {username}: {e}")
+            error = str(e)
+            permanent = isinstance(e, ProfileUnavailable)
+        await self.run_blocking(RecordFailure, username, error, permanent)
+        return {"status": "failed", "username": username, "error": error}
+
+
+async def ScrapeMany(usernames, concurrency=ASYNC_CONCURRENCY, on_done=None):
+    # on_done(username), if given, runs off the loop as each profile finishes.
+    scraper = AsyncScraper(concurrency)
+
+    async def scrape(username):
+        try:
+            return await scraper.scrape_one(username)
+        finally:
+            if on_done:
+                await asyncio.to_thread(on_done, username)
+
+    try:
+        return await asyncio.gather(*[scrape(username) for username in usernames])
+    finally:
+        await scraper.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scrape many profiles concurrently in one process")
+    parser.add_argument('usernames', nargs='*')
+    parser.add_argument('-f', '--file', help="File with one username per line")
+    parser.add_argument('-c', '--concurrency', type=int, default=ASYNC_CONCURRENCY)
+    args = parser.parse_args()
+
+    usernames = list(args.usernames)
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            usernames.extend(line.strip() for line in f if line.strip())
+    if not usernames:
+        parser.error("no usernames given")
+
+    started = time.monotonic()
+    results = asyncio.run(ScrapeMany(list(dict.fromkeys(usernames)), args.concurrency))
+    failed = [result for result in results if result['status'] != 'success']
+    logger.info(f"Scraped {len(results) - len(failed)}/{len(results)} profiles "
+                f"in {time.monotonic() - started:.1f}s")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,90 @@
+"""Compare per-call sqlite connections with the pooled db_utils layer.
+
+    python benchmarks/bench_db.py --rows 2000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db_utils
+
+
+def make_post(i):
+    return {
+        'post_id': f'bench_{i}',
+        'id': '1',
+        'username': 'bench_user',
+        'taken_at_timestamp': 1700000000 + i,
+        'is_video': i % 3 == 0,
+        'video_view_count': i,
+        'liked_by': i * 2,
+        'caption': f'caption {i} #bench',
+        'accessibility_caption': '',
+        'img_file': f'media/1_bench_{i}.jpg',
+        'video_file': None,
+    }
+
+
+def legacy_insert_post(post_data):
+    # Mirrors the old db_utils behaviour: connect, write, commit, close.
+    conn = sqlite3.connect(db_utils.db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO posts
+        (post_id, user_id, username, taken_at_timestamp, is_video, video_view_count,
+            liked_by, caption, accessibility_caption, img_file, video_file)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        post_data['post_id'], post_data['id'], post_data['username'],
+        post_data['taken_at_timestamp'], post_data['is_video'],
+        post_data['video_view_count'], post_data['liked_by'], post_data['caption'],
+        post_data['accessibility_caption'], post_data['img_file'], post_data['video_file'],
+    ))
+    conn.commit()
+    conn.close()
+
+
+def run(label, insert, rows):
+    start = time.perf_counter()
+    for i in range(rows):
+        insert(make_post(i))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {rows} rows in {elapsed:.3f}s -> {rows / elapsed:,.0f} rows/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_utils.db_path = os.path.join(tmp, 'legacy.db')
+        db_utils.init_database()
+        db_utils.close_connection()
+        # The legacy layout ran in rollback-journal mode with full sync.
+        conn = sqlite3.connect(db_utils.db_path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        run('legacy', legacy_insert_post, args.rows)
+
+        db_utils.db_path = os.path.join(tmp, 'pooled.db')
+        db_utils.init_database()
+        run('pooled', db_utils.insert_post, args.rows)
+        db_utils.close_connection()
+
+        db_utils.db_path = os.path.join(tmp, 'batched.db')
+        db_utils.init_database()
+        start = time.perf_counter()
+        db_utils.save_profile({'id': '1', 'username': 'bench_user'},
+                              [make_post(i) for i in range(args.rows)])
+        elapsed = time.perf_counter() - start
+        print(f"{'batched':<10} {args.rows} rows in {elapsed:.3f}s -> {args.rows / elapsed:,.0f} rows/sec")
+        db_utils.close_connection()
+
+
+if __name__ == '__main__':
+    main()
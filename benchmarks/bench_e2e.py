@@ -0,0 +1,230 @@
+"""End-to-end scrape throughput against local Instagram/CDN and S3 stand-ins.
+
+Drives ScrapeUser, the scrape_insta Celery task (run eagerly, no broker) and
+the read endpoints of the FastAPI app, then reports profiles/sec, media MB/s,
+p50/p99 latency and peak RSS. Nothing leaves the machine.
+
+    python benchmarks/bench_e2e.py --profiles 50 --workers 8 --posts 36 --payload-kb 200
+    python benchmarks/bench_e2e.py --save baseline.json
+    python benchmarks/bench_e2e.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_services import FakeConfig, InstagramHandler, S3Handler, start
+
+API_KEY = 'bench'
+
+
+def configure(tmp, instagram_url, s3_url):
+    # The scraper modules read their settings at import, so this must run
+    # before they are imported. Rate limits are off: the fake services are
+    # what is being paced, not Instagram.
+    os.environ.update({
+        'INSTAGRAM_BASE_URL': instagram_url,
+        'S3_ENDPOINT_URL': s3_url,
+        'S3_BUCKET_NAME': 'bench',
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_REGION': 'us-east-1',
+        'DB_PATH': os.path.join(tmp, 'bench.db'),
+        'ARCHIVE_DIR': os.path.join(tmp, 'archive'),
+        'PROFILE_RATE': '0',
+        'MEDIA_RATE': '0',
+        'PROXY_RATE': '0',
+        'PROXY_ENDPOINTS': '',
+        'BACKOFF_BASE': '0.01',
+        'BACKOFF_MAX': '0.1',
+        'USER_CACHE_REDIS': 'false',
+        'APIKEY': API_KEY,
+    })
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(name, latencies, elapsed, units, media_bytes=0):
+    result = {
+        'name': name,
+        'count': len(latencies),
+        'seconds': round(elapsed, 3),
+        'per_sec': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 1) if latencies else 0,
+        'units': units,
+    }
+    if media_bytes:
+        result['media_mb_per_sec'] = round(media_bytes / elapsed / 1024 / 1024, 2)
+    return result
+
+
+def run_parallel(func, items, workers):
+    latencies = []
+    failures = 0
+
+    def timed(item):
+        started = time.perf_counter()
+        ok = func(item)
+        return ok, time.perf_counter() - started
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for ok, latency in pool.map(timed, items):
+            latencies.append(latency)
+            failures += not ok
+    return latencies, time.perf_counter() - start, failures
+
+
+def media_bytes():
+    from db_utils import get_connection
+    return get_connection().execute("SELECT COALESCE(SUM(size), 0) FROM media_manifest").fetchone()[0]
+
+
+def bench_scraper(usernames, workers):
+    from insta_scraper import ScrapeUser
+    before = media_bytes()
+    latencies, elapsed, failures = run_parallel(ScrapeUser, usernames, workers)
+    result = summarize('ScrapeUser', latencies, elapsed, 'profiles', media_bytes() - before)
+    result['failures'] = failures
+    return result
+
+
+def bench_task(usernames, workers):
+    from tasks import scrape_insta
+    before = media_bytes()
+
+    def run(username):
+        return scrape_insta.apply(args=(username,)).result.get('status') == 'success'
+
+    latencies, elapsed, failures = run_parallel(run, usernames, workers)
+    result = summarize('scrape_insta', latencies, elapsed, 'profiles', media_bytes() - before)
+    result['failures'] = failures
+    return result
+
+
+def bench_api(usernames, workers, requests_per_user):
+    from fastapi.testclient import TestClient
+    import main
+    headers = {'Authorization': API_KEY}
+    results = []
+    with TestClient(main.app) as client:
+        calls = {
+            'get-user': lambda username: client.post(
+                '/api/v1/get-user', json={'username': username}, headers=headers),
+            'get-users': lambda username: client.post(
+                '/api/v1/get-users', json={'usernames': usernames[:50], 'posts_per_user': 12}, headers=headers),
+            'user posts': lambda username: client.get(
+                f'/api/v1/user/{username}/posts?limit=20', headers=headers),
+        }
+        for name, call in calls.items():
+            items = usernames * requests_per_user
+            latencies, elapsed, failures = run_parallel(
+                lambda username: call(username).status_code == 200, items, workers)
+            result = summarize(name, latencies, elapsed, 'requests')
+            result['failures'] = failures
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Flags throughput drops and p99 rises beyond `tolerance` (a fraction).
+    previous = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result['name'])
+        if not old:
+            continue
+        if old['per_sec'] and result['per_sec'] < old['per_sec'] * (1 - tolerance):
+            regressions.append(f"{result['name']}: {result['per_sec']}/s vs {old['per_sec']}/s")
+        if old['p99_ms'] and result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{result['name']}: p99 {result['p99_ms']}ms vs {old['p99_ms']}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=8, help="concurrent profiles, like Celery concurrency")
+    parser.add_argument('--posts', type=int, default=36)
+    parser.add_argument('--payload-kb', type=int, default=100)
+    parser.add_argument('--video-every', type=int, default=0, help="make every Nth post a video")
+    parser.add_argument('--latency-ms', type=float, default=20, help="Instagram API latency")
+    parser.add_argument('--cdn-latency-ms', type=float, default=5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of 429/503 responses")
+    parser.add_argument('--api-requests', type=int, default=5, help="read requests per profile")
+    parser.add_argument('--only', choices=['scraper', 'task', 'api'], action='append')
+    parser.add_argument('--save', help="write results as JSON")
+    parser.add_argument('--baseline', help="compare against a saved run and exit non-zero on regression")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--verbose', action='store_true', help="keep the scraper's INFO logging")
+    args = parser.parse_args()
+    stages = args.only or ['scraper', 'task', 'api']
+
+    config = FakeConfig(args.posts, args.payload_kb, args.latency_ms, args.cdn_latency_ms,
+                        args.error_rate, args.video_every)
+    instagram, instagram_url = start(InstagramHandler, config)
+    s3, s3_url = start(S3Handler, config)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            configure(tmp, instagram_url, s3_url)
+            import db_utils
+            import insta_scraper
+            if not args.verbose:
+                logging.getLogger().setLevel(logging.CRITICAL)
+            db_utils.init_database()
+            # Each stage scrapes its own profiles so nothing is already stored.
+            if 'scraper' in stages:
+                results.append(bench_scraper([f'scraper_{i}' for i in range(args.profiles)], args.workers))
+            if 'task' in stages:
+                results.append(bench_task([f'task_{i}' for i in range(args.profiles)], args.workers))
+            if 'api' in stages:
+                usernames = [f'api_{i}' for i in range(args.profiles)]
+                if not {'scraper', 'task'} & set(stages):
+                    bench_scraper(usernames, args.workers)
+                else:
+                    usernames = [f'scraper_{i}' if 'scraper' in stages else f'task_{i}'
+                                 for i in range(args.profiles)]
+                results.extend(bench_api(usernames, args.workers, args.api_requests))
+            db_utils.close_connection()
+    finally:
+        instagram.terminate()
+        s3.terminate()
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{'stage':<14} {'count':>6} {'per sec':>9} {'p50 ms':>9} {'p99 ms':>9} {'MB/s':>8} {'fail':>5}")
+    for result in results:
+        print(f"{result['name']:<14} {result['count']:>6} {result['per_sec']:>9} {result['p50_ms']:>9} "
+              f"{result['p99_ms']:>9} {result.get('media_mb_per_sec', '-'):>8} {result['failures']:>5}")
+    print(f"peak RSS {peak_rss_mb:.1f} MB")
+
+    report = {'config': vars(args), 'peak_rss_mb': round(peak_rss_mb, 1), 'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
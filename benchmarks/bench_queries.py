@@ -0,0 +1,74 @@
+"""Time the scrape/read queries on a synthetic database, before and after
+the db_utils migrations add their indexes.
+
+    python benchmarks/bench_queries.py --posts 1000000 --users 10000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db_utils
+
+
+def populate(posts, users):
+    with db_utils.transaction() as cursor:
+        db_utils._create_tables(cursor)
+        cursor.executemany(db_utils.USER_UPSERT_SQL, (
+            (str(u), f'user_{u}', f'User {u}', 'bio', None, u, u, False, False, None, None, None)
+            for u in range(users)
+        ))
+        cursor.executemany(db_utils.POST_UPSERT_SQL, (
+            (f'post_{i}', str(i % users), f'user_{i % users}', 1600000000 + i, i % 5 == 0,
+             i, i, f'caption {i} #tag{i % 1000}', '', f'media/{i}.jpg', None)
+            for i in range(posts)
+        ))
+
+
+def timeit(label, func, usernames):
+    start = time.perf_counter()
+    for username in usernames:
+        func(username)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<22} {elapsed / len(usernames) * 1000:8.3f} ms/query")
+
+
+def run_queries(usernames):
+    timeit('get_all_posts', db_utils.get_all_posts, usernames)
+    timeit('get_user_with_posts', db_utils.get_user_with_posts, usernames)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_utils.db_path = os.path.join(tmp, 'bench.db')
+        start = time.perf_counter()
+        populate(args.posts, args.users)
+        print(f"populated {args.posts} posts / {args.users} users in {time.perf_counter() - start:.1f}s")
+
+        usernames = [f'user_{random.randrange(args.users)}' for _ in range(args.queries)]
+        print("before migrations:")
+        run_queries(usernames)
+
+        start = time.perf_counter()
+        applied = db_utils.migrate()
+        print(f"applied {applied} migrations in {time.perf_counter() - start:.1f}s")
+        print("after migrations:")
+        run_queries(usernames)
+        # Each tag matches ~posts/1000 rows; results are ranked and cut to 20.
+        tags = [f'#tag{random.randrange(1000)}' for _ in range(args.queries)]
+        timeit('search (tag)', db_utils.search, tags)
+        timeit('search (users)', lambda tag: db_utils.search('user', 'users', limit=20), tags)
+        db_utils.close_connection()
+
+
+if __name__ == '__main__':
+    main()
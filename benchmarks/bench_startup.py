@@ -0,0 +1,78 @@
+"""Measure cold-start cost of the API and worker entry points.
+
+Each module is imported in a fresh interpreter so nothing is already cached
+in sys.modules. Exits non-zero when a budget is exceeded, so it can gate CI.
+
+    python benchmarks/bench_startup.py --budget-ms 800 --budget-mb 120
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules only the scrape workers need; the API must start without them.
+WORKER_MODULES = ('insta_scraper', 'async_scraper', 'tasks', 'boto3', 'curl_cffi')
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+heavy = [m for m in {worker_modules!r} if m in sys.modules]
+print(json.dumps({{'ms': elapsed * 1000, 'mb': rss, 'heavy': heavy}}))
+"""
+
+
+def scratch_env(directory):
+    # Importing the worker runs storage.init(), which migrates whatever
+    # DB_PATH points at; probes get a throwaway SQLite database and archive.
+    return dict(os.environ, DB_PATH=os.path.join(directory, 'startup.db'),
+                ARCHIVE_DIR=os.path.join(directory, 'archive'), STORAGE_BACKEND='sqlite')
+
+
+def measure(module, runs, env):
+    samples = []
+    probe = PROBE.format(module=module, worker_modules=WORKER_MODULES)
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', probe],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+        )
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    samples.sort(key=lambda s: s['ms'])
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', nargs='+', default=['main', 'tasks'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=None, help="import time budget for main")
+    parser.add_argument('--budget-mb', type=float, default=None, help="peak RSS budget for main")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory(prefix='bench-startup-') as scratch:
+        for module in args.modules:
+            result = measure(module, args.runs, scratch_env(scratch))
+            print(f"{module:<10} {result['ms']:8.1f} ms {result['mb']:8.1f} MB  heavy={','.join(result['heavy']) or '-'}")
+            if module != 'main':
+                continue
+            if result['heavy']:
+                print(f"  main imported worker-only modules: {', '.join(result['heavy'])}")
+                failed = True
+            if args.budget_ms is not None and result['ms'] > args.budget_ms:
+                print(f"  over time budget ({args.budget_ms:.0f} ms)")
+                failed = True
+            if args.budget_mb is not None and result['mb'] > args.budget_mb:
+                print(f"  over memory budget ({args.budget_mb:.0f} MB)")
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Timeline-page write latency seen by concurrent workers, per storage mode.
+
+Each thread stands in for a Celery worker saving pages of 12 posts. Direct
+modes pay for the database lock on every page; write-behind only pays for a
+Redis RPUSH, and the single drainer's batch throughput is reported
+separately. Needs a reachable REDIS_URL for write-behind and DATABASE_URL
+for postgres; the postgres mode works in a schema of its own that is
+dropped afterwards, so existing tables are never touched.
+
+    python benchmarks/bench_storage.py --workers 16 --pages 50
+    python benchmarks/bench_storage.py --modes sqlite write-behind postgres
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_page(worker, page, size=12):
+    username = f'bench_{worker}'
+    user = {'id': str(1000 + worker), 'username': username, 'full_name': username,
+            'edge_followed_by': {'count': page}, 'edge_follow': {'count': 1}}
+    posts = [{
+        'post_id': f'{1000 + worker}{page:04d}{i:02d}',
+        'user_id': user['id'],
+        'username': username,
+        'taken_at_timestamp': 1700000000 + page * size + i,
+        'is_video': False,
+        'liked_by': i,
+        'caption': f'page {page} post {i} #bench',
+    } for i in range(size)]
+    return username, user, posts
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+@contextmanager
+def scratch_schema(url):
+    import psycopg
+    from psycopg.conninfo import make_conninfo
+
+    schema = f"bench_storage_{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(url, autocommit=True) as admin:
+        admin.execute(f"CREATE SCHEMA {schema}")
+        try:
+            yield make_conninfo(url, options=f"-c search_path={schema}")
+        finally:
+            admin.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+def run(store, workers, pages):
+    def work(worker):
+        latencies = []
+        for page in range(pages):
+            username, user, posts = make_page(worker, page)
+            started = time.perf_counter()
+            store.save_page(username, user if page == 0 else None, posts,
+                            checkpoint={'end_cursor': str(page)})
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        latencies = [latency for result in pool.map(work, range(workers)) for latency in result]
+    elapsed = time.perf_counter() - start
+    return (f"{len(latencies) / elapsed:>9.0f} {percentile(latencies, 0.5) * 1000:>9.2f} "
+            f"{percentile(latencies, 0.99) * 1000:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--pages', type=int, default=50, help="pages saved per worker")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--modes', nargs='+', default=['sqlite', 'write-behind'],
+                        choices=['sqlite', 'write-behind', 'postgres'])
+    args = parser.parse_args()
+    if 'postgres' in args.modes and not os.getenv('DATABASE_URL'):
+        parser.error("the postgres mode needs DATABASE_URL")
+
+    with tempfile.TemporaryDirectory() as tmp, ExitStack() as cleanup:
+        os.environ['DB_PATH'] = os.path.join(tmp, 'bench.db')
+        import storage
+        from redis_utils import get_redis
+
+        print(f"{'mode':<14} {'pages/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for mode in args.modes:
+            if mode == 'postgres':
+                store = storage.PostgresStorage(cleanup.enter_context(scratch_schema(storage.DATABASE_URL)))
+                store.init()
+            else:
+                store = storage.SQLiteStorage()
+                store.init()
+            if mode == 'write-behind':
+                get_redis().delete(storage.WRITE_QUEUE_KEY)
+                print(f"{mode:<14} {run(storage.WriteBehindStorage(store), args.workers, args.pages)}")
+                queued = get_redis().llen(storage.WRITE_QUEUE_KEY)
+                started = time.perf_counter()
+                storage.drain(store, args.batch_size, once=True)
+                elapsed = time.perf_counter() - started
+                print(f"{'  drain':<14} {queued / elapsed:>9.0f}  (batch {args.batch_size}, one writer)")
+            else:
+                print(f"{mode:<14} {run(store, args.workers, args.pages)}")
+
+
+if __name__ == '__main__':
+    main()
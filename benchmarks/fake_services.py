@@ -0,0 +1,262 @@
+"""Local stand-ins for Instagram (web_profile_info, timeline GraphQL, CDN)
+and S3, for offline benchmarks. Each runs in its own process so the server
+side doesn't compete with the scraper for the GIL.
+
+    python benchmarks/fake_services.py --posts 36 --payload-kb 200
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class FakeConfig:
+    def __init__(self, posts=36, payload_kb=100, latency_ms=0, cdn_latency_ms=0,
+                 error_rate=0.0, video_every=0, private_every=0):
+        self.posts = posts
+        self.payload_kb = payload_kb
+        self.latency_ms = latency_ms
+        self.cdn_latency_ms = cdn_latency_ms
+        self.error_rate = error_rate
+        self.video_every = video_every
+        self.private_every = private_every
+
+
+def user_id(username):
+    # Small enough that '{user id}{index:06d}' post ids still fit in int64,
+    # like real Instagram ids.
+    return str(int(hashlib.md5(username.encode()).hexdigest()[:8], 16))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if 'aws-chunked' in (self.headers.get('Content-Encoding') or ''):
+            body = decode_aws_chunked(body)
+        return body
+
+
+def decode_aws_chunked(body):
+    data = bytearray()
+    pos = 0
+    while pos < len(body):
+        end = body.index(b'\r\n', pos)
+        size = int(body[pos:end].split(b';')[0], 16)
+        if size == 0:
+            break
+        data += body[end + 2:end + 2 + size]
+        pos = end + 2 + size + 2
+    return bytes(data)
+
+
+class InstagramHandler(Handler):
+    config = FakeConfig()
+    payload = b''
+
+    def base_url(self):
+        return f'http://{self.headers.get("Host")}'
+
+    def fail(self):
+        return self.config.error_rate and random.random() < self.config.error_rate
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path.startswith('/cdn/'):
+            return self.cdn(parts.path)
+        time.sleep(self.config.latency_ms / 1000)
+        if self.fail():
+            return self.send_body(429, b'{"message": "Please wait a few minutes"}', headers={'Retry-After': '0'})
+        if parts.path == '/api/v1/users/web_profile_info/':
+            return self.profile(query['username'][0])
+        if parts.path == '/graphql/query/':
+            variables = json.loads(query['variables'][0])
+            return self.timeline(variables['id'], variables.get('after'), variables.get('first', 12))
+        self.send_body(404, b'{}')
+
+    def post_node(self, uid, index):
+        node = {
+            'id': f'{uid}{index:06d}',
+            'taken_at_timestamp': 1700000000 + (self.config.posts - index) * 3600,
+            'display_url': f'{self.base_url()}/cdn/{uid}/{index}.jpg?sig={uuid.uuid4().hex}',
+            'edge_liked_by': {'count': index * 7},
+            'edge_media_preview_like': {'count': index * 7},
+            'edge_media_to_caption': {'edges': [{'node': {'text': f'post {index} #bench'}}]},
+            'accessibility_caption': 'benchmark image',
+            'is_video': False,
+        }
+        if self.config.video_every and index % self.config.video_every == 0:
+            node['is_video'] = True
+            node['video_view_count'] = index * 11
+            node['video_url'] = f'{self.base_url()}/cdn/{uid}/{index}.mp4?sig={uuid.uuid4().hex}'
+        return node
+
+    def page(self, uid, after, first):
+        start = int(after) if after else 0
+        end = min(self.config.posts, start + first)
+        return {
+            'count': self.config.posts,
+            'edges': [{'node': self.post_node(uid, i)} for i in range(start, end)],
+            'page_info': {'has_next_page': end < self.config.posts, 'end_cursor': str(end) if end < self.config.posts else None},
+        }
+
+    def profile(self, username):
+        uid = user_id(username)
+        private = self.config.private_every and int(uid) % self.config.private_every == 0
+        user = {
+            'id': uid,
+            'username': username,
+            'full_name': f'Bench {username}',
+            'biography': 'offline benchmark profile',
+            'edge_followed_by': {'count': int(uid) % 100000},
+            'edge_follow': {'count': 100},
+            'is_private': bool(private),
+            'is_verified': False,
+            'category_name': 'Bench',
+            'bio_links': [],
+            'edge_owner_to_timeline_media': self.page(uid, None, 12),
+        }
+        self.send_body(200, json.dumps({'data': {'user': user}, 'status': 'ok'}).encode())
+
+    def timeline(self, uid, after, first):
+        media = self.page(uid, after, first)
+        self.send_body(200, json.dumps({'data': {'user': {'edge_owner_to_timeline_media': media}}}).encode())
+
+    def cdn(self, path):
+        time.sleep(self.config.cdn_latency_ms / 1000)
+        if self.fail():
+            return self.send_body(503, b'', 'text/plain')
+        # Unique leading bytes per file so content-hash dedup doesn't kick in.
+        body = hashlib.sha256(path.encode()).digest() + self.payload
+        start = 0
+        status = 200
+        headers = {}
+        range_header = self.headers.get('Range')
+        if range_header:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(body):
+                return self.send_body(416, b'', 'application/octet-stream')
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+        self.send_body(status, body[start:], 'application/octet-stream', headers)
+
+
+class S3Handler(Handler):
+    # Path-style S3 subset used by MediaUpload and HeadObject. Only sizes and
+    # ETags are kept, so memory stays flat however much is uploaded.
+    objects = {}
+    uploads = {}
+    lock = threading.Lock()
+
+    def key(self):
+        return urlsplit(self.path).path.lstrip('/')
+
+    def query(self):
+        return parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+
+    def do_HEAD(self):
+        item = self.objects.get(self.key())
+        if item is None:
+            return self.send_body(404, b'', 'application/xml')
+        size, etag = item
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+    def do_PUT(self):
+        body = self.read_body()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        query = self.query()
+        with self.lock:
+            if 'uploadId' in query:
+                self.uploads[query['uploadId'][0]].append(len(body))
+            else:
+                self.objects[self.key()] = (len(body), etag)
+        self.send_body(200, b'', 'application/xml', {'ETag': etag})
+
+    def do_POST(self):
+        self.read_body()
+        query = self.query()
+        bucket, _, key = self.key().partition('/')
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.lock:
+                self.uploads[upload_id] = []
+            body = (f'<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                    f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+            return self.send_body(200, body.encode(), 'application/xml')
+        with self.lock:
+            parts = self.uploads.pop(query['uploadId'][0])
+            etag = f'"{uuid.uuid4().hex}-{len(parts)}"'
+            self.objects[self.key()] = (sum(parts), etag)
+        body = (f'<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>'
+                f'<ETag>{etag}</ETag></CompleteMultipartUploadResult>')
+        self.send_body(200, body.encode(), 'application/xml')
+
+    def do_DELETE(self):
+        with self.lock:
+            self.uploads.pop(self.query().get('uploadId', [''])[0], None)
+            self.objects.pop(self.key(), None)
+        self.send_response(204)
+        self.end_headers()
+
+
+def serve(handler, config, ready):
+    handler.config = config
+    handler.payload = random.randbytes(config.payload_kb * 1024)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(handler, config):
+    # Returns (process, base url); terminate the process when done.
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(handler, config, ready), daemon=True)
+    process.start()
+    return process, f'http://127.0.0.1:{ready.get(timeout=10)}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=36)
+    parser.add_argument('--payload-kb', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+    config = FakeConfig(args.posts, args.payload_kb, args.latency_ms, error_rate=args.error_rate)
+    instagram, instagram_url = start(InstagramHandler, config)
+    s3, s3_url = start(S3Handler, config)
+    print(f"INSTAGRAM_BASE_URL={instagram_url}\nS3_ENDPOINT_URL={s3_url}")
+    try:
+        instagram.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
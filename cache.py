@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 1024))
+# Local entries can't be invalidated from a worker process, so they live
+# briefly; the Redis tier is invalidated on every write and can live longer.
+USER_CACHE_LOCAL_TTL = float(os.getenv("USER_CACHE_LOCAL_TTL", 5))
+USER_CACHE_REDIS_TTL = int(os.getenv("USER_CACHE_REDIS_TTL", 300))
+USER_CACHE_REDIS = os.getenv("USER_CACHE_REDIS", "true").lower() in ("1", "true", "yes")
+KEY_PREFIX = "user_cache:"
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class UserCache:
+    # Stores the serialised get-user response together with its ETag, so a
+    # hit skips both SQLite and JSON encoding.
+    def __init__(self, maxsize, local_ttl, redis_ttl, use_redis):
+        self.local = LRUCache(maxsize, local_ttl)
+        self.redis_ttl = redis_ttl
+        self.use_redis = use_redis
+
+    def get(self, username):
+        entry = self.local.get(username)
+        if entry is not None:
+            return entry
+        if self.use_redis:
+            try:
+                body = get_redis().get(KEY_PREFIX + username)
+            except Exception as e:
+                logger.warning(f"User cache read failed: {e}")
+                body = None
+            if body is not None:
+                entry = (body, make_etag(body))
+                self.local.set(username, entry)
+                return entry
+        return None
+
+    def set(self, username, data):
+        body = json.dumps(data, default=str).encode('utf-8')
+        entry = (body, make_etag(body))
+        self.local.set(username, entry)
+        if self.use_redis:
+            try:
+                get_redis().set(KEY_PREFIX + username, body, ex=self.redis_ttl)
+            except Exception as e:
+                logger.warning(f"User cache write failed: {e}")
+        return entry
+
+    def invalidate(self, username):
+        self.local.delete(username)
+        if self.use_redis:
+            try:
+                get_redis().delete(KEY_PREFIX + username)
+            except Exception as e:
+                logger.warning(f"User cache invalidation failed for {username}: {e}")
+
+
+def make_etag(body):
+    return f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_LOCAL_TTL, USER_CACHE_REDIS_TTL, USER_CACHE_REDIS)
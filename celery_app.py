@@ -0,0 +1,39 @@
+from celery import Celery
+import os
+
+# Broker/backend configuration only. The API imports this module to enqueue
+# tasks by name, so it must stay free of scraper imports.
+app = Celery('macmap_scraper')
+
+# Scrapes someone asked for through the API go to the interactive queue;
+# batches, async bulk runs and scheduled refreshes go to backfill. Run
+# separate workers per queue so bulk work never delays interactive requests.
+INTERACTIVE_QUEUE = os.getenv('INTERACTIVE_QUEUE', 'interactive')
+BACKFILL_QUEUE = os.getenv('BACKFILL_QUEUE', 'backfill')
+# Seconds between scheduler runs that queue accounts due for a refresh.
+REFRESH_TICK = float(os.getenv('REFRESH_TICK', 300))
+
+app.conf.update(
+    broker_url=os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0'),
+    result_backend=os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0'),
+    task_serializer='json',
+    accept_content=['json'],
+    result_serializer='json',
+    worker_prefetch_multiplier=1,
+    result_expires=1800,  
+    task_acks_late=True,
+    worker_max_tasks_per_child=100,
+    task_default_queue=INTERACTIVE_QUEUE,
+    task_routes={
+        'tasks.scrape_insta_batch': {'queue': BACKFILL_QUEUE},
+        'tasks.refresh_due_accounts': {'queue': BACKFILL_QUEUE},
+    },
+    beat_schedule={
+        'refresh-due-accounts': {
+            'task': 'tasks.refresh_due_accounts',
+            'schedule': REFRESH_TICK,
+            # A tick that waited longer than the next one is redundant.
+            'options': {'expires': REFRESH_TICK},
+        },
+    },
+)
@@ -1,13 +1,354 @@
-import pandas as pd
 import sqlite3
 import datetime
+import os
+import io
+import csv
+import json
+import base64
+import threading
+import time
+from contextlib import contextmanager
+from cache import user_cache
+from metrics import observe_db
+
+
+db_path = os.getenv("DB_PATH", "instagram_data.db")
+
+# Applied once to every pooled connection. WAL lets the API readers run
+# alongside the Celery writers, and busy_timeout makes writers queue on the
+# lock instead of failing with "database is locked".
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def get_connection():
+    # One connection per thread and process; a forked Celery child must not
+    # reuse the parent's handle, so the pid is part of the key.
+    key = (os.getpid(), db_path)
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.key != key:
+        conn = sqlite3.connect(
+            db_path,
+            timeout=30,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        _local.key = key
+        _local.depth = 0
+        _local.on_commit = []
+    return conn
+
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.key[0] == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+@contextmanager
+def transaction(operation='transaction'):
+    # Re-entrant: nested calls join the outermost transaction so callers can
+    # group several writes behind a single commit. Only the outermost call is
+    # timed, under its own operation name, lock wait included.
+    conn = get_connection()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn.cursor()
+        finally:
+            _local.depth -= 1
+        return
+
+    started = time.monotonic()
+    conn.execute("BEGIN IMMEDIATE")
+    _local.depth = 1
+    _local.on_commit = []
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+        for callback in _local.on_commit:
+            callback()
+    finally:
+        _local.depth = 0
+        _local.on_commit = []
+        observe_db(operation, time.monotonic() - started)
+
+
+def after_commit(callback):
+    # Runs callback once the outermost transaction commits; used for cache
+    # invalidation so readers can't re-cache rows that aren't visible yet.
+    _local.on_commit.append(callback)
+
+
+# Engagement history. Snapshots are written by triggers only when a metric
+# actually changes, keyed by the numeric Instagram ids (stable across VACUUM,
+# unlike rowids) so no text is repeated per row. Each change also folds
+# into hourly and daily per-user rollups, which is what trend queries read.
+GROWTH_RESOLUTIONS = {'hour': 3600, 'day': 86400}
+_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+
+def _numeric(column):
+    return f"{column} != '' AND {column} NOT GLOB '*[^0-9]*'"
+
+
+def _followers_rollup(resolution):
+    return f'''
+        INSERT INTO user_growth (user_id, resolution, bucket, followers_first, followers_last,
+            followers_min, followers_max, follow_last)
+        VALUES (CAST(new.id AS INTEGER), {resolution}, {_NOW} / {resolution} * {resolution},
+            new.followed_by, new.followed_by, new.followed_by, new.followed_by, new.follow)
+        ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET
+            followers_first = COALESCE(user_growth.followers_first, excluded.followers_first),
+            followers_last = excluded.followers_last,
+            followers_min = MIN(COALESCE(user_growth.followers_min, excluded.followers_min), excluded.followers_min),
+            followers_max = MAX(COALESCE(user_growth.followers_max, excluded.followers_max), excluded.followers_max),
+            follow_last = excluded.follow_last;'''
+
+
+def _engagement_rollup(resolution):
+    return f'''
+        INSERT INTO user_growth (user_id, resolution, bucket, likes_gained, views_gained)
+        VALUES (CAST(new.user_id AS INTEGER), {resolution}, {_NOW} / {resolution} * {resolution},
+            COALESCE(new.liked_by, 0) - COALESCE(old.liked_by, 0),
+            COALESCE(new.video_view_count, 0) - COALESCE(old.video_view_count, 0))
+        ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET
+            likes_gained = user_growth.likes_gained + excluded.likes_gained,
+            views_gained = user_growth.views_gained + excluded.views_gained;'''
+
+
+def _engagement_history_migration():
+    user_snapshot = f'''
+        INSERT INTO user_metrics (user_id, ts, followed_by, follow)
+        VALUES (CAST(new.id AS INTEGER), {_NOW}, new.followed_by, new.follow)
+        ON CONFLICT (user_id, ts) DO UPDATE SET
+            followed_by = excluded.followed_by, follow = excluded.follow;'''
+    post_snapshot = f'''
+        INSERT INTO post_metrics (post_id, ts, liked_by, video_view_count)
+        VALUES (CAST(new.post_id AS INTEGER), {_NOW}, new.liked_by, new.video_view_count)
+        ON CONFLICT (post_id, ts) DO UPDATE SET
+            liked_by = excluded.liked_by, video_view_count = excluded.video_view_count;'''
+    user_rollups = ''.join(_followers_rollup(seconds) for seconds in GROWTH_RESOLUTIONS.values())
+    post_rollups = ''.join(_engagement_rollup(seconds) for seconds in GROWTH_RESOLUTIONS.values())
+    return (
+        '''CREATE TABLE IF NOT EXISTS user_metrics (
+            user_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            followed_by INTEGER,
+            follow INTEGER,
+            PRIMARY KEY (user_id, ts)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS post_metrics (
+            post_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            liked_by INTEGER,
+            video_view_count INTEGER,
+            PRIMARY KEY (post_id, ts)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS user_growth (
+            user_id INTEGER NOT NULL,
+            resolution INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            followers_first INTEGER,
+            followers_last INTEGER,
+            followers_min INTEGER,
+            followers_max INTEGER,
+            follow_last INTEGER,
+            likes_gained INTEGER NOT NULL DEFAULT 0,
+            views_gained INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, resolution, bucket)
+        ) WITHOUT ROWID''',
+        f"""CREATE TRIGGER IF NOT EXISTS users_metrics_insert AFTER INSERT ON users
+        WHEN {_numeric('new.id')} BEGIN {user_snapshot}{user_rollups}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS users_metrics_update AFTER UPDATE OF followed_by, follow ON users
+        WHEN (old.followed_by IS NOT new.followed_by OR old.follow IS NOT new.follow)
+            AND {_numeric('new.id')} BEGIN {user_snapshot}{user_rollups}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS posts_metrics_insert AFTER INSERT ON posts
+        WHEN {_numeric('new.post_id')} BEGIN {post_snapshot}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS posts_metrics_update AFTER UPDATE OF liked_by, video_view_count ON posts
+        WHEN (old.liked_by IS NOT new.liked_by OR old.video_view_count IS NOT new.video_view_count)
+            AND {_numeric('new.post_id')} BEGIN {post_snapshot}{post_rollups}
+        END""",
+        # Existing rows become each series' first snapshot.
+        f"""INSERT OR IGNORE INTO user_metrics (user_id, ts, followed_by, follow)
+        SELECT CAST(id AS INTEGER), CAST(strftime('%s', updated_at) AS INTEGER), followed_by, follow
+        FROM users WHERE {_numeric('id')}""",
+        f"""INSERT OR IGNORE INTO post_metrics (post_id, ts, liked_by, video_view_count)
+        SELECT CAST(post_id AS INTEGER), CAST(strftime('%s', scraped_at) AS INTEGER), liked_by, video_view_count
+        FROM posts WHERE {_numeric('post_id')}""",
+        *[f"""INSERT OR IGNORE INTO user_growth (user_id, resolution, bucket, followers_first,
+            followers_last, followers_min, followers_max, follow_last)
+        SELECT user_id, {seconds}, ts / {seconds} * {seconds}, followed_by, followed_by, followed_by,
+            followed_by, follow
+        FROM user_metrics""" for seconds in GROWTH_RESOLUTIONS.values()],
+    )
+
+
+# Schema changes on top of the base tables. Entry N takes user_version from
+# N to N+1; append new entries, never edit ones that have shipped.
+MIGRATIONS = [
+    (
+        "CREATE INDEX IF NOT EXISTS idx_posts_username_scraped ON posts (username, scraped_at)",
+        "CREATE INDEX IF NOT EXISTS idx_posts_user_taken ON posts (user_id, taken_at_timestamp)",
+    ),
+    (
+        "CREATE INDEX IF NOT EXISTS idx_posts_username_taken ON posts (username, taken_at_timestamp, post_id)",
+    ),
+    (
+        "ALTER TABLE scraping_status ADD COLUMN end_cursor TEXT",
+        "ALTER TABLE scraping_status ADD COLUMN backfill_complete BOOLEAN DEFAULT 0",
+        "ALTER TABLE scraping_status ADD COLUMN newest_post_id TEXT",
+        "ALTER TABLE scraping_status ADD COLUMN newest_taken_at INTEGER",
+    ),
+    (
+        '''CREATE TABLE IF NOT EXISTS media_manifest (
+            url_key TEXT PRIMARY KEY,
+            s3_key TEXT NOT NULL,
+            size INTEGER,
+            etag TEXT,
+            content_hash TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_media_manifest_hash ON media_manifest (content_hash)",
+    ),
+    (
+        '''CREATE TABLE IF NOT EXISTS raw_archive (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            cursor TEXT,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            raw_size INTEGER,
+            fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_raw_archive_username ON raw_archive (username, id)",
+    ),
+    (
+        "ALTER TABLE scraping_status ADD COLUMN stage_timings TEXT",
+    ),
+    (
+        # Full-text indexes over the existing rows (external content, keyed
+        # by rowid). The update triggers skip upserts that leave the text
+        # unchanged, which is most re-scrapes.
+        """CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+            caption, accessibility_caption,
+            content='posts', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, caption, accessibility_caption)
+            VALUES (new.rowid, new.caption, new.accessibility_caption);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, caption, accessibility_caption)
+            VALUES ('delete', old.rowid, old.caption, old.accessibility_caption);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF caption, accessibility_caption ON posts
+        WHEN old.caption IS NOT new.caption OR old.accessibility_caption IS NOT new.accessibility_caption BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, caption, accessibility_caption)
+            VALUES ('delete', old.rowid, old.caption, old.accessibility_caption);
+            INSERT INTO posts_fts (rowid, caption, accessibility_caption)
+            VALUES (new.rowid, new.caption, new.accessibility_caption);
+        END""",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, full_name, biography, category_name,
+            content='users', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username, full_name, biography, category_name)
+            VALUES (new.rowid, new.username, new.full_name, new.biography, new.category_name);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, full_name, biography, category_name)
+            VALUES ('delete', old.rowid, old.username, old.full_name, old.biography, old.category_name);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, full_name, biography, category_name ON users
+        WHEN old.username IS NOT new.username OR old.full_name IS NOT new.full_name
+            OR old.biography IS NOT new.biography OR old.category_name IS NOT new.category_name BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username, full_name, biography, category_name)
+            VALUES ('delete', old.rowid, old.username, old.full_name, old.biography, old.category_name);
+            INSERT INTO users_fts (rowid, username, full_name, biography, category_name)
+            VALUES (new.rowid, new.username, new.full_name, new.biography, new.category_name);
+        END""",
+        "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+    ),
+    _engagement_history_migration(),
+    (
+        # Adaptive refresh: changes/day observed across scrapes and when the
+        # account is next due. Accounts scraped before this start out due a
+        # day after their last scrape.
+        "ALTER TABLE scraping_status ADD COLUMN change_rate REAL",
+        "ALTER TABLE scraping_status ADD COLUMN next_scrape_at INTEGER",
+        "ALTER TABLE scraping_status ADD COLUMN last_followers INTEGER",
+        """UPDATE scraping_status SET
+            next_scrape_at = CAST(strftime('%s', last_scraped) AS INTEGER) + 86400,
+            last_followers = (SELECT followed_by FROM users WHERE users.username = scraping_status.username)
+        WHERE last_scraped IS NOT NULL""",
+        "CREATE INDEX IF NOT EXISTS idx_scraping_status_next ON scraping_status (next_scrape_at)",
+    ),
+    (
+        # taken_at of the oldest post a refresh left unwritten because its
+        # media failed; see insta_scraper.RetryMark.
+        "ALTER TABLE scraping_status ADD COLUMN retry_taken_at INTEGER",
+    ),
+    (
+        # A record is identified by where its payload lives, so an index
+        # write that is replayed (write-behind) doesn't add a duplicate.
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_raw_archive_location ON raw_archive (segment, offset)",
+    ),
+    (
+        # Failed scrapes in a row since the last completed one; sets the
+        # refresh backoff, see scheduler.plan_backoff.
+        "ALTER TABLE scraping_status ADD COLUMN refresh_failures INTEGER DEFAULT 0",
+    ),
+]
 
 
-db_path = "instagram_data.db"
 def init_database():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    with transaction('init_database') as cursor:
+        _create_tables(cursor)
+    migrate()
+
+
+def migrate():
+    # BEGIN IMMEDIATE serialises workers starting at the same time; the
+    # version is read under the write lock so each step runs exactly once.
+    with transaction('migrate') as cursor:
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {target}")
+        applied = len(MIGRATIONS) - version
+    if applied > 0:
+        get_connection().execute("PRAGMA optimize")
+    return applied
+
 
+def _create_tables(cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id TEXT PRIMARY KEY,
@@ -57,19 +398,55 @@ def init_database():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+# Upserts update rows in place (rather than INSERT OR REPLACE deleting and
+# re-inserting them), which keeps created_at and lets a re-parse that has no
+# media columns leave the stored ones alone.
+USER_UPSERT_SQL = '''
+    INSERT INTO users
+    (id, username, full_name, biography, external_url, followed_by, follow,
+        is_verified, is_private, business_email, business_phone_number, category_name, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(id) DO UPDATE SET
+        username = excluded.username,
+        full_name = excluded.full_name,
+        biography = excluded.biography,
+        external_url = excluded.external_url,
+        followed_by = excluded.followed_by,
+        follow = excluded.follow,
+        is_verified = excluded.is_verified,
+        is_private = excluded.is_private,
+        business_email = excluded.business_email,
+        business_phone_number = excluded.business_phone_number,
+        category_name = excluded.category_name,
+        updated_at = CURRENT_TIMESTAMP
+'''
 
-def insert_user(user_data):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+# A username that now belongs to a different account id would otherwise
+# violate the UNIQUE constraint on users.username.
+USER_RECLAIM_SQL = "DELETE FROM users WHERE username = ? AND id != ?"
 
-    cursor.execute('''
-        INSERT OR REPLACE INTO users
-        (id, username, full_name, biography, external_url, followed_by, follow,
-            is_verified, is_private, business_email, business_phone_number, category_name, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (
+POST_UPSERT_SQL = '''
+    INSERT INTO posts
+    (post_id, user_id, username, taken_at_timestamp, is_video, video_view_count,
+        liked_by, caption, accessibility_caption, img_file, video_file)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(post_id) DO UPDATE SET
+        user_id = excluded.user_id,
+        username = excluded.username,
+        taken_at_timestamp = excluded.taken_at_timestamp,
+        is_video = excluded.is_video,
+        video_view_count = excluded.video_view_count,
+        liked_by = excluded.liked_by,
+        caption = excluded.caption,
+        accessibility_caption = excluded.accessibility_caption,
+        img_file = COALESCE(excluded.img_file, posts.img_file),
+        video_file = COALESCE(excluded.video_file, posts.video_file),
+        scraped_at = CURRENT_TIMESTAMP
+'''
+
+
+def _user_row(user_data):
+    return (
         user_data.get('id'),
         user_data.get('username'),
         user_data.get('full_name'),
@@ -82,21 +459,11 @@ def insert_user(user_data):
         user_data.get('business_email'),
         user_data.get('business_phone_number'),
         user_data.get('category_name')
-    ))
+    )
 
-    conn.commit()
-    conn.close()
 
-def insert_post(post_data):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        INSERT OR REPLACE INTO posts
-        (post_id, user_id, username, taken_at_timestamp, is_video, video_view_count,
-            liked_by, caption, accessibility_caption, img_file, video_file)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+def _post_row(post_data):
+    return (
         post_data.get('post_id'),
         post_data.get('id'),
         post_data.get('username'),
@@ -108,27 +475,143 @@ def insert_post(post_data):
         post_data.get('accessibility_caption'),
         post_data.get('img_file'),
         post_data.get('video_file')
-    ))
+    )
 
-    conn.commit()
-    conn.close()
 
-def update_scraping_status( username, status, posts_count=0, error_message=None):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+def _invalidate_users(usernames):
+    for username in set(usernames):
+        after_commit(lambda username=username: user_cache.invalidate(username))
 
-    cursor.execute('''
-        INSERT OR REPLACE INTO scraping_status
-        (username, status, last_scraped, posts_count, error_message, updated_at)
-        VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, CURRENT_TIMESTAMP)
-    ''', (username, status, posts_count, error_message))
 
-    conn.commit()
-    conn.close()
+def insert_user(user_data):
+    with transaction('insert_user') as cursor:
+        cursor.execute(USER_RECLAIM_SQL, (user_data.get('username'), user_data.get('id')))
+        cursor.execute(USER_UPSERT_SQL, _user_row(user_data))
+        _invalidate_users([user_data.get('username')])
+
+def insert_post(post_data):
+    with transaction('insert_post') as cursor:
+        cursor.execute(POST_UPSERT_SQL, _post_row(post_data))
+        _invalidate_users([post_data.get('username')])
+
+def insert_posts(posts):
+    with transaction('insert_posts') as cursor:
+        cursor.executemany(POST_UPSERT_SQL, [_post_row(post) for post in posts])
+        _invalidate_users(post.get('username') for post in posts)
+
+# scraped_at is the posts export watermark, so a changed counter has to move it.
+POST_METRICS_SQL = '''
+    UPDATE posts SET liked_by = :liked_by, video_view_count = :video_view_count, scraped_at = CURRENT_TIMESTAMP
+    WHERE post_id = :post_id
+    AND (liked_by IS NOT :liked_by OR video_view_count IS NOT :video_view_count)
+'''
+
+
+def update_post_metrics(posts):
+    # Refreshes counters on posts already stored; rows whose numbers haven't
+    # moved aren't written, so they cost no WAL and leave no history.
+    rows = [{'post_id': post.get('post_id'), 'liked_by': post.get('liked_by', 0),
+             'video_view_count': post.get('video_view_count', 0)} for post in posts]
+    with transaction('update_post_metrics') as cursor:
+        cursor.executemany(POST_METRICS_SQL, rows)
+        _invalidate_users(post.get('username') for post in posts)
+
+def save_profile(user_data, posts):
+    # User upsert and all of its posts share one transaction, so a profile
+    # costs a single commit no matter how many posts it has.
+    with transaction('save_profile'):
+        insert_user(user_data)
+        insert_posts(posts)
+
+def update_scraping_status(username, status, posts_count=None, error_message=None):
+    # last_scraped only moves when a scrape completes, so it can drive the
+    # freshness window; posts_count is kept when not supplied.
+    with transaction('update_scraping_status') as cursor:
+        cursor.execute('''
+            INSERT INTO scraping_status
+            (username, status, last_scraped, posts_count, error_message, updated_at)
+            VALUES (?, ?, CASE WHEN ? = 'completed' THEN CURRENT_TIMESTAMP END, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(username) DO UPDATE SET
+                status = excluded.status,
+                last_scraped = COALESCE(excluded.last_scraped, scraping_status.last_scraped),
+                posts_count = COALESCE(excluded.posts_count, scraping_status.posts_count),
+                error_message = excluded.error_message,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (username, status, status, posts_count, error_message))
+
+TIMELINE_CHECKPOINT_FIELDS = ('end_cursor', 'backfill_complete', 'newest_post_id', 'newest_taken_at',
+                              'retry_taken_at')
+
+
+def update_timeline_checkpoint(username, **fields):
+    # Only the given fields change, so callers can move the backfill cursor
+    # and the newest-seen marker independently.
+    columns = [name for name in TIMELINE_CHECKPOINT_FIELDS if name in fields]
+    if not columns:
+        return
+    assignments = ', '.join(f"{name} = excluded.{name}" for name in columns)
+    with transaction('update_timeline_checkpoint') as cursor:
+        cursor.execute(f'''
+            INSERT INTO scraping_status (username, {', '.join(columns)}, updated_at)
+            VALUES (?, {', '.join('?' * len(columns))}, CURRENT_TIMESTAMP)
+            ON CONFLICT(username) DO UPDATE SET {assignments}, updated_at = CURRENT_TIMESTAMP
+        ''', (username, *[fields[name] for name in columns]))
+
+def record_stage_timings(username, timings):
+    # Per-stage breakdown of the latest scrape attempt, stored as JSON.
+    with transaction('record_stage_timings') as cursor:
+        cursor.execute('''
+            INSERT INTO scraping_status (username, stage_timings, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(username) DO UPDATE SET stage_timings = excluded.stage_timings
+        ''', (username, json.dumps(timings)))
 
-def get_user_stats(self):
-    conn = sqlite3.connect(self.db_path)
-    cursor = conn.cursor()
+def update_refresh_schedule(username, next_scrape_at, change_rate=None, last_followers=None, refresh_failures=None):
+    # Rate, follower baseline and failure count are kept when not supplied,
+    # so the scheduler can push next_scrape_at on its own.
+    with transaction('update_refresh_schedule') as cursor:
+        cursor.execute('''
+            INSERT INTO scraping_status (username, next_scrape_at, change_rate, last_followers, refresh_failures,
+                updated_at)
+            VALUES (?, ?, ?, ?, COALESCE(?, 0), CURRENT_TIMESTAMP)
+            ON CONFLICT(username) DO UPDATE SET
+                next_scrape_at = excluded.next_scrape_at,
+                change_rate = COALESCE(excluded.change_rate, scraping_status.change_rate),
+                last_followers = COALESCE(excluded.last_followers, scraping_status.last_followers),
+                refresh_failures = COALESCE(?, scraping_status.refresh_failures)
+        ''', (username, next_scrape_at, change_rate, last_followers, refresh_failures, refresh_failures))
+
+def get_due_refreshes(now, limit=100):
+    # Tracked accounts whose next refresh is at or before `now` (unix
+    # seconds), longest overdue first.
+    rows = get_connection().execute('''
+        SELECT username FROM scraping_status
+        WHERE next_scrape_at <= ?
+        ORDER BY next_scrape_at LIMIT ?
+    ''', (now, limit)).fetchall()
+    return [row['username'] for row in rows]
+
+def get_scraping_status(username):
+    row = get_connection().execute(
+        "SELECT * FROM scraping_status WHERE username = ?", (username,)).fetchone()
+    return dict(row) if row else None
+
+def get_recently_scraped(usernames, max_age):
+    # Usernames whose last completed scrape is younger than max_age seconds.
+    cursor = get_connection().cursor()
+    fresh = set()
+    usernames = list(usernames)
+    for start in range(0, len(usernames), 500):
+        chunk = usernames[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f"""SELECT username FROM scraping_status
+            WHERE username IN ({placeholders})
+            AND last_scraped >= datetime('now', ?)""", (*chunk, f'-{int(max_age)} seconds'))
+        fresh.update(row['username'] for row in cursor.fetchall())
+    return fresh
+
+def get_user_stats():
+    cursor = get_connection().cursor()
 
     cursor.execute('SELECT COUNT(*) FROM users')
     users_count = cursor.fetchone()[0]
@@ -136,10 +619,9 @@ def get_user_stats(self):
     cursor.execute('SELECT COUNT(*) FROM posts')
     posts_count = cursor.fetchone()[0]
 
-    cursor.execute('SELECT COUNT(*) FROM scraping_status WHERE status = "completed"')
+    cursor.execute("SELECT COUNT(*) FROM scraping_status WHERE status = 'completed'")
     completed_count = cursor.fetchone()[0]
 
-    conn.close()
     return {
         'total_users': users_count,
         'total_posts': posts_count,
@@ -147,50 +629,239 @@ def get_user_stats(self):
     }
 
 
-def export_to_csv(table_name, output_file=None):
+# Exportable tables and the column used as the incremental-export watermark.
+EXPORT_TABLES = {
+    'users': 'updated_at',
+    'posts': 'scraped_at',
+    'scraping_status': 'updated_at',
+}
+EXPORT_FORMATS = ('csv', 'ndjson', 'parquet')
+EXPORT_CHUNK_SIZE = 5000
+
+
+def iter_table_chunks(table_name, since=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # Keyset-paginates on rowid so each chunk is a short, self-contained
+    # query: memory stays at one chunk and no read transaction is held open
+    # between chunks (which would also stall WAL checkpoints).
+    if table_name not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table: {table_name}")
+    watermark_column = EXPORT_TABLES[table_name]
+    where = f"AND {watermark_column} > ?" if since else ""
+    sql = f"SELECT rowid, * FROM {table_name} WHERE rowid > ? {where} ORDER BY rowid LIMIT ?"
+    last_rowid = 0
+    while True:
+        params = (last_rowid, since, chunk_size) if since else (last_rowid, chunk_size)
+        rows = get_connection().execute(sql, params).fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        yield [tuple(row)[1:] for row in rows]
+
+
+def table_columns(table_name):
+    return [(row['name'], row['type'].upper())
+            for row in get_connection().execute(f"PRAGMA table_info({table_name})")]
+
+
+def _csv_chunks(columns, chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _ndjson_chunks(columns, chunks):
+    names = [name for name, _ in columns]
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(names, row)), default=str) + '\n'
+                      for row in rows).encode('utf-8')
+
+
+class _ParquetSink:
+    # File-like target for pyarrow that hands bytes back to the caller after
+    # every row group while still reporting absolute offsets via tell().
+    closed = False
+
+    def __init__(self):
+        self.pending = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.pending.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.pending)
+        self.pending = []
+        return data
+
+
+def _parquet_chunks(columns, chunks):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+
+    types = {'INTEGER': pa.int64(), 'BOOLEAN': pa.bool_(), 'REAL': pa.float64()}
+    schema = pa.schema([(name, types.get(kind, pa.string())) for name, kind in columns])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    for rows in chunks:
+        arrays = []
+        for index, field in enumerate(schema):
+            values = [row[index] for row in rows]
+            if pa.types.is_string(field.type):
+                values = [None if value is None else str(value) for value in values]
+            elif pa.types.is_boolean(field.type):
+                values = [None if value is None else bool(value) for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def encode_export(columns, chunks, fmt='csv'):
+    # columns is [(name, SQLite type)]; chunks yields lists of row tuples.
+    writers = {'csv': _csv_chunks, 'ndjson': _ndjson_chunks, 'parquet': _parquet_chunks}
+    if fmt not in writers:
+        raise ValueError(f"Unknown export format: {fmt}")
+    return writers[fmt](columns, chunks)
+
+
+def iter_export(table_name, fmt='csv', since=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # Yields the export as encoded byte chunks, one per chunk_size rows.
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if table_name not in EXPORT_TABLES:
+        raise ValueError(f"Unknown table: {table_name}")
+    return encode_export(table_columns(table_name), iter_table_chunks(table_name, since, chunk_size), fmt)
+
+
+def export_table(table_name, output_file=None, fmt='csv', since=None):
     if not output_file:
-        output_file = f"{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        output_file = f"{table_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
 
-    conn = sqlite3.connect(db_path)
-    df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-    df.to_csv(output_file, index=False)
-    conn.close()
+    with open(output_file, 'wb') as f:
+        for chunk in iter_export(table_name, fmt, since):
+            f.write(chunk)
 
     return output_file
 
 
-def get_user_by_username(username):
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+def get_export_watermark(table_name):
+    # Pass the value returned here as `since` on the next incremental export.
+    column = EXPORT_TABLES[table_name]
+    return get_connection().execute(f"SELECT MAX({column}) FROM {table_name}").fetchone()[0]
 
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        row = cursor.fetchone()
-        conn.close()
 
-        return dict(row) if row else None
+def export_to_csv(table_name, output_file=None):
+    return export_table(table_name, output_file, 'csv')
+
+
+def get_user_by_username(username):
+    cursor = get_connection().cursor()
+    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+
+    return dict(row) if row else None
 
 def get_all_posts(username):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
     cursor.execute("SELECT post_id FROM posts WHERE username = ?", (username,))
     post_rows = cursor.fetchall()
     data = [dict(x)['post_id'] for x  in post_rows]
-    conn.close()
     return data
 
 
+def get_media(url_key):
+    row = get_connection().execute(
+        "SELECT * FROM media_manifest WHERE url_key = ?", (url_key,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_media_by_hash(content_hash):
+    row = get_connection().execute(
+        "SELECT * FROM media_manifest WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+    return dict(row) if row else None
+
+
+def record_media(url_key, s3_key, size=None, etag=None, content_hash=None):
+    with transaction('record_media') as cursor:
+        cursor.execute('''
+            INSERT OR REPLACE INTO media_manifest (url_key, s3_key, size, etag, content_hash)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (url_key, s3_key, size, etag, content_hash))
+
+
+def record_archive(username, kind, cursor, segment, offset, length, codec, raw_size):
+    with transaction('record_archive') as db:
+        db.execute('''
+            INSERT OR IGNORE INTO raw_archive (username, kind, cursor, segment, offset, length, codec, raw_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (username, kind, cursor, segment, offset, length, codec, raw_size))
+
+
+def get_archive_records(username=None):
+    # Records in fetch order, optionally for one user.
+    sql = "SELECT * FROM raw_archive"
+    params = ()
+    if username:
+        sql += " WHERE username = ?"
+        params = (username,)
+    sql += " ORDER BY id"
+    return [dict(row) for row in get_connection().execute(sql, params).fetchall()]
+
+
+def get_archived_usernames():
+    return [row['username'] for row in get_connection().execute(
+        "SELECT DISTINCT username FROM raw_archive ORDER BY username")]
+
+
+def get_archive_stats():
+    row = get_connection().execute('''
+        SELECT COUNT(*) AS records, COUNT(DISTINCT username) AS users,
+            COALESCE(SUM(length), 0) AS stored_bytes, COALESCE(SUM(raw_size), 0) AS raw_bytes
+        FROM raw_archive
+    ''').fetchone()
+    return dict(row)
+
+
+def get_existing_post_ids(post_ids):
+    post_ids = list(post_ids)
+    if not post_ids:
+        return set()
+    placeholders = ','.join('?' * len(post_ids))
+    rows = get_connection().execute(
+        f"SELECT post_id FROM posts WHERE post_id IN ({placeholders})", post_ids).fetchall()
+    return {row['post_id'] for row in rows}
+
+
 def get_user_with_posts(username):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection().cursor()
 
     cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
     user_row = cursor.fetchone()
 
     if not user_row:
-        conn.close()
         return None
 
     user = dict(user_row)
@@ -201,5 +872,200 @@ def get_user_with_posts(username):
     post_rows = cursor.fetchall()
     user['posts'] = [dict(row) for row in post_rows]
 
-    conn.close()
     return user
+
+
+def encode_cursor(post):
+    raw = f"{post['taken_at_timestamp']}:{post['post_id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        taken_at, post_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split(':', 1)
+        return int(taken_at), post_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def get_user_posts(username, cursor=None, limit=20):
+    # Keyset pagination on (taken_at_timestamp, post_id), newest first; each
+    # page is an index range scan however deep the caller has paged.
+    sql = "SELECT * FROM posts WHERE username = ?"
+    params = [username]
+    if cursor:
+        sql += " AND (taken_at_timestamp, post_id) < (?, ?)"
+        params.extend(decode_cursor(cursor))
+    sql += " ORDER BY taken_at_timestamp DESC, post_id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = [dict(row) for row in get_connection().execute(sql, params).fetchall()]
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return {'posts': rows[:limit], 'next_cursor': next_cursor}
+
+
+SEARCH_TYPES = {
+    # type: (fts table, searchable columns, bm25 column weights)
+    'posts': ('posts_fts', ('caption', 'accessibility_caption'), (1.0, 0.4)),
+    'users': ('users_fts', ('username', 'full_name', 'biography', 'category_name'), (3.0, 2.0, 1.0, 2.0)),
+}
+SNIPPET_TOKENS = 16
+
+
+def fts_query(text, column=None):
+    # Turns free text into an FTS5 expression: every word must match, each
+    # quoted so user input can't inject query syntax. '#tag' and '@name'
+    # match the bare word, and a trailing '*' keeps a prefix search.
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.strip('#@*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    if not terms:
+        return None
+    query = ' '.join(terms)
+    return f'{column} : ({query})' if column else query
+
+
+def search(text, search_type='posts', column=None, username=None, limit=20, offset=0):
+    # Ranked by bm25 (lower is better). `username` narrows post results to
+    # one account; `column` restricts matching to one indexed field.
+    table, columns, weights = SEARCH_TYPES[search_type]
+    if column is not None and column not in columns:
+        raise ValueError(f"Unknown {search_type} search field: {column}")
+    query = fts_query(text, column)
+    if query is None:
+        raise ValueError("Search query is empty")
+
+    source = 'posts' if search_type == 'posts' else 'users'
+    sql = f'''
+        SELECT {source}.*,
+            snippet({table}, -1, '<b>', '</b>', '…', {SNIPPET_TOKENS}) AS snippet,
+            bm25({table}, {', '.join(map(str, weights))}) AS rank
+        FROM {table} JOIN {source} ON {source}.rowid = {table}.rowid
+        WHERE {table} MATCH ?'''
+    params = [query]
+    if username and search_type == 'posts':
+        sql += " AND posts.username = ?"
+        params.append(username)
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params.extend([limit, offset])
+    return [dict(row) for row in get_connection().execute(sql, params).fetchall()]
+
+
+def rebuild_search_index():
+    # Re-derives both indexes from the base tables. Needed after a VACUUM,
+    # which may renumber the rowids the indexes point at.
+    with transaction('rebuild_search_index') as cursor:
+        for table, _, _ in SEARCH_TYPES.values():
+            cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+            cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+
+
+def get_user_growth(username, resolution='day', since=None, until=None, limit=90):
+    # Reads the precomputed rollups, newest `limit` buckets in [since, until)
+    # (unix seconds), returned oldest first. followers_change is measured
+    # against the previous bucket's closing count.
+    seconds = GROWTH_RESOLUTIONS[resolution]
+    user = get_connection().execute(
+        "SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+    if not user or not str(user['id']).isdigit():
+        return None
+    sql = "SELECT * FROM user_growth WHERE user_id = ? AND resolution = ?"
+    params = [int(user['id']), seconds]
+    if since is not None:
+        sql += " AND bucket >= ?"
+        params.append(since // seconds * seconds)
+    if until is not None:
+        sql += " AND bucket < ?"
+        params.append(until)
+    sql += " ORDER BY bucket DESC LIMIT ?"
+    params.append(limit)
+    rows = [dict(row) for row in get_connection().execute(sql, params).fetchall()][::-1]
+    return growth_buckets(username, resolution, rows)
+
+
+def growth_buckets(username, resolution, rows):
+    # user_growth rows, oldest first, as returned by get_user_growth.
+    previous = None
+    buckets = []
+    for row in rows:
+        start = row['followers_first'] if previous is None else previous
+        buckets.append({
+            'bucket': row['bucket'],
+            'start': datetime.datetime.fromtimestamp(row['bucket'], datetime.timezone.utc).isoformat(),
+            'followers': row['followers_last'],
+            'followers_change': None if row['followers_last'] is None or start is None else row['followers_last'] - start,
+            'followers_min': row['followers_min'],
+            'followers_max': row['followers_max'],
+            'following': row['follow_last'],
+            'likes_gained': row['likes_gained'],
+            'views_gained': row['views_gained'],
+        })
+        if row['followers_last'] is not None:
+            previous = row['followers_last']
+    return {'username': username, 'resolution': resolution, 'buckets': buckets}
+
+
+def get_users_with_posts(usernames, posts_per_user=20):
+    # One users query and one windowed posts query per 500 usernames,
+    # instead of two queries per username.
+    conn = get_connection()
+    users = {}
+    usernames = list(dict.fromkeys(usernames))
+    for start in range(0, len(usernames), 500):
+        chunk = usernames[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f"SELECT * FROM users WHERE username IN ({placeholders})", chunk):
+            user = dict(row)
+            user['posts'] = []
+            user['next_cursor'] = None
+            users[user['username']] = user
+
+        if posts_per_user <= 0:
+            continue
+        rows = conn.execute(f"""SELECT * FROM (
+                SELECT posts.*, ROW_NUMBER() OVER (
+                    PARTITION BY username ORDER BY taken_at_timestamp DESC, post_id DESC
+                ) AS row_number
+                FROM posts WHERE username IN ({placeholders})
+            ) WHERE row_number <= ?
+            ORDER BY username, row_number""", (*chunk, posts_per_user + 1))
+        for row in rows:
+            post = dict(row)
+            user = users.get(post['username'])
+            if user is None:
+                continue
+            if post.pop('row_number') > posts_per_user:
+                user['next_cursor'] = encode_cursor(user['posts'][-1])
+            else:
+                user['posts'].append(post)
+    return users
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Database maintenance commands")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate', help="Apply pending schema migrations")
+    export_parser = commands.add_parser('export', help="Stream a table to a file")
+    export_parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--since', help="Only rows changed after this watermark")
+    export_parser.add_argument('--output')
+    commands.add_parser('rebuild-search', help="Rebuild the full-text search indexes")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        init_database()
+        print(f"Applied schema version {get_connection().execute('PRAGMA user_version').fetchone()[0]}")
+    elif args.command == 'export':
+        watermark = get_export_watermark(args.table)
+        output_file = export_table(args.table, args.output, args.format, args.since)
+        print(f"Exported {args.table} to {output_file} (next --since {watermark})")
+    elif args.command == 'rebuild-search':
+        init_database()
+        rebuild_search_index()
+        print("Rebuilt posts_fts and users_fts")
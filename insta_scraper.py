@@ -2,29 +2,31 @@ from db_utils import *
 import logging
 import os
 import json
+import hashlib
+import random
+import threading
+import contextvars
+import time
 from datetime import datetime
 from pathlib import Path
-import pandas as pd
+from urllib.parse import quote, urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests as media_req
 from curl_cffi import requests
 from dotenv import load_dotenv
-import boto3
+from proxy_pool import proxy_pool
+from rate_limiter import rate_limiter
+from metrics import observe_request, count_retry, observe_media, count_media, record_stage
+from archive import archive_response
+from storage import storage
+from scheduler import plan_refresh, plan_backoff
 
 load_dotenv()
-init_database()
+storage.init()
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
-proxy_config = {
-    'username': os.getenv("PROXY_USERNAME"),
-    'password': os.getenv("PROXY_PASSWORD"),
-    'endpoint': os.getenv("ENDPOINT"),
-}
-proxy = {
-    'http': f'http://{proxy_config["username"]}:{proxy_config["password"]}@{proxy_config["endpoint"]}',
-    'https': f'http://{proxy_config["username"]}:{proxy_config["password"]}@{proxy_config["endpoint"]}'
-}
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
     'Accept': '*/*',
@@ -36,77 +38,393 @@ headers = {
     'Origin': 'https://www.instagram.com'
 }
 
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-    region_name=os.getenv("AWS_REGION")
-)
 s3_bucket = os.getenv("S3_BUCKET_NAME")
+# Overridable so benchmarks can point the scraper at local stand-ins.
+INSTAGRAM_BASE_URL = os.getenv("INSTAGRAM_BASE_URL", "https://www.instagram.com").rstrip('/')
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+# botocore's default of 10 pooled connections is below the number of media
+# threads uploading at once, which makes it drop and reopen connections.
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+_s3_client = None
+_s3_lock = threading.Lock()
 
-if not s3_bucket:
-    logger.error("S3_BUCKET_NAME environment variable is not set")
-    exit(1)
+export_header_written = False
+MEDIA_CONCURRENCY = int(os.getenv("MEDIA_CONCURRENCY", 8))
+# S3 rejects multipart parts under 5 MiB (except the last one).
+MEDIA_PART_SIZE = max(int(os.getenv("MEDIA_PART_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+MEDIA_CHUNK_SIZE = 256 * 1024
 
-os.makedirs("media", exist_ok=True)
-os.makedirs("data", exist_ok=True)
+# Timeline pages (12 posts each) fetched per scrape, across refresh and backfill.
+MAX_TIMELINE_PAGES = int(os.getenv("MAX_TIMELINE_PAGES", 10))
+TIMELINE_PAGE_SIZE = 12
+TIMELINE_QUERY_HASH = os.getenv("TIMELINE_QUERY_HASH", "69cba40317214236af40e7efa697781d")
 
-export_header_written = False
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 8))
+BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", 1))
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", 60))
+# Instagram answers rate limiting with 429 and, for logged-out clients,
+# 401/403 "please wait a few minutes"; those are worth retrying.
+RETRY_STATUSES = {401, 403, 429, 500, 502, 503, 504}
+NOT_FOUND_STATUSES = {404, 410}
+
+_sessions = threading.local()
+_media_pool = None
+_media_pool_pid = None
+_media_pool_lock = threading.Lock()
+
+
+def GetS3Client():
+    # Created on first media transfer rather than at import, so importing
+    # this module needs neither boto3 start-up time nor S3 credentials.
+    global _s3_client
+    if _s3_client is None:
+        with _s3_lock:
+            if _s3_client is None:
+                if not s3_bucket:
+                    raise RuntimeError("S3_BUCKET_NAME environment variable is not set")
+                import boto3
+                from botocore.config import Config
+                _s3_client = boto3.client(
+                    "s3",
+                    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                    region_name=os.getenv("AWS_REGION"),
+                    endpoint_url=S3_ENDPOINT_URL,
+                    config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+                )
+    return _s3_client
+
+
+class ProfileUnavailable(Exception):
+    pass
+
+
+def GetMediaPool():
+    # One media pool per process, shared by every page and profile, so the
+    # per-thread media sessions (and their keep-alive connections) and SQLite
+    # connections outlive a single page. Recreated after a fork.
+    global _media_pool, _media_pool_pid
+    if _media_pool is None or _media_pool_pid != os.getpid():
+        with _media_pool_lock:
+            if _media_pool is None or _media_pool_pid != os.getpid():
+                _media_pool = ThreadPoolExecutor(max_workers=MEDIA_CONCURRENCY, thread_name_prefix='media')
+                _media_pool_pid = os.getpid()
+    return _media_pool
+
+
+def GetSession():
+    # Sessions are kept per thread so keep-alive connections (and HTTP/2 for
+    # the impersonated client) survive across requests and retries.
+    session = getattr(_sessions, 'api', None)
+    if session is None:
+        session = requests.Session(impersonate="chrome131", headers=headers, timeout=30)
+        _sessions.api = session
+    return session
+
+
+def GetMediaSession():
+    session = getattr(_sessions, 'media', None)
+    if session is None:
+        session = media_req.Session()
+        adapter = media_req.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=MEDIA_CONCURRENCY)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions.media = session
+    return session
+
+
+def BackoffDelay(attempt, retry_after=None):
+    # Exponential backoff with full jitter; Retry-After wins when it is longer.
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), BACKOFF_MAX))
+        except ValueError:
+            pass
+    return delay
+
+
+def Backoff(attempt, retry_after=None):
+    delay = BackoffDelay(attempt, retry_after)
+    record_stage('backoff', delay)
+    time.sleep(delay)
+
+
+def Throttle(bucket, key=None):
+    # Rate limiter wait, reported separately from time spent on the wire.
+    started = time.monotonic()
+    rate_limiter.acquire(bucket, key)
+    record_stage('throttle', time.monotonic() - started, count=0)
 
 
 def SendRequests(url):
-    retry = 0
-    while retry < 20:
+    session = GetSession()
+    endpoint = urlsplit(url).path
+    for attempt in range(MAX_RETRIES):
+        Throttle('profile')
+        entry = proxy_pool.acquire()
+        if entry:
+            Throttle('proxy', entry.name)
+        started = time.monotonic()
         try:
-            response = requests.get(url, headers=headers, timeout=30, impersonate="chrome131",proxies=proxy)
-            if response.status_code == 200:
-                print(response.text)
-                # with open('test.json','w',encoding='utf-8') as f:
-                #     json.dump(response.json(),f)
-                # f.close()
-                return response
+            response = session.get(url, proxies=entry.proxies if entry else None)
         except Exception as e:
-            print(e)
-        retry += 1
-        
+            observe_request(endpoint, 'error', time.monotonic() - started)
+            proxy_pool.report(entry, False)
+            logger.warning(f"Request error for {url}: {e}")
+            count_retry(endpoint, 'error')
+            Backoff(attempt)
+            continue
+        elapsed = time.monotonic() - started
+        observe_request(endpoint, response.status_code, elapsed)
+        # 404 means the account is gone, not that the proxy misbehaved.
+        proxy_pool.report(entry, response.status_code in (200, 404, 410),
+                          elapsed, response.status_code)
+        if response.status_code == 200:
+            return response
+        if response.status_code in NOT_FOUND_STATUSES:
+            raise ProfileUnavailable(f"{url} returned HTTP {response.status_code}")
+        if response.status_code not in RETRY_STATUSES:
+            logger.error(f"Giving up on {url}: HTTP {response.status_code}")
+            return None
+        logger.warning(f"HTTP {response.status_code} for {url}, retrying (attempt {attempt + 1})")
+        count_retry(endpoint, response.status_code)
+        Backoff(attempt, response.headers.get('Retry-After'))
+    return None
+
+
+def MediaUrlKey(url):
+    # CDN URLs carry expiring signature parameters; the path identifies the file.
+    return urlsplit(url).path
+
+
+def HeadObject(key):
+    from botocore.exceptions import ClientError
+    try:
+        return GetS3Client().head_object(Bucket=s3_bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            logger.warning(f"S3 HEAD failed for {key}: {e}")
+        return None
+
 
 def DownloadMedia(url, filename):
-    retry = 0
-    while retry < 20:
+    # Returns the S3 key holding this media, or None on failure. The manifest
+    # (then S3 itself) is checked first so bytes already stored by an earlier
+    # or crashed attempt are never fetched again.
+    url_key = MediaUrlKey(url)
+    stored = storage.get_media(url_key)
+    if stored:
+        count_media('manifest')
+        return stored['s3_key']
+
+    key = Path(filename).name
+    head = HeadObject(key)
+    if head:
+        count_media('head')
+        storage.record_media(url_key, key, head.get('ContentLength'), head.get('ETag'))
+        return key
+
+    upload = TransferMedia(url, key)
+    if upload is None:
+        count_media('failed')
+        return None
+    count_media('dedup' if upload.key != key else 'transferred')
+    storage.record_media(url_key, upload.key, upload.size, upload.etag, upload.content_hash)
+    return upload.key
+
+
+def TransferMedia(url, key):
+    # Streams the CDN body straight into S3. At most one part is buffered in
+    # memory, and a dropped connection resumes with a Range request from the
+    # last byte received instead of starting over.
+    upload = MediaUpload(key)
+    session = GetMediaSession()
+    attempt = 0
+    try:
+        while attempt < MAX_RETRIES:
+            Throttle('media')
+            entry = proxy_pool.acquire()
+            started = time.monotonic()
+            try:
+                request_headers = {}
+                if upload.received:
+                    request_headers['Range'] = f'bytes={upload.received}-'
+                with session.get(url, stream=True, proxies=entry.proxies if entry else None,
+                                 timeout=300, headers=request_headers) as response:
+                    upload.download_seconds += time.monotonic() - started
+                    proxy_pool.report(entry, response.status_code < 500 and response.status_code != 429,
+                                      time.monotonic() - started, response.status_code)
+                    entry = None
+                    if response.status_code == 416 and upload.received:
+                        # Everything was already received before the drop.
+                        upload.complete()
+                        return upload
+                    if response.status_code == 200 and upload.received:
+                        # Server ignored the Range header; start from scratch.
+                        upload.reset()
+                    elif response.status_code in NOT_FOUND_STATUSES:
+                        logger.error(f"Media gone {url}: HTTP {response.status_code}")
+                        break
+                    elif response.status_code not in (200, 206):
+                        attempt += 1
+                        Backoff(attempt, response.headers.get('Retry-After'))
+                        continue
+                    for chunk in TimedChunks(response, upload):
+                        upload.write(chunk)
+                upload.complete()
+                return upload
+            except Exception as e:
+                proxy_pool.report(entry, False)
+                logger.warning(f"Media transfer error for {key}: {e}")
+                attempt += 1
+                Backoff(attempt)
+    except BaseException:
+        upload.abort()
+        raise
+    finally:
+        observe_media('download', upload.download_seconds, upload.downloaded)
+        observe_media('upload', upload.upload_seconds, upload.sent)
+    upload.abort()
+    return None
+
+
+def TimedChunks(response, upload):
+    # Yields the body while timing only the waits on the CDN, so S3 time
+    # spent inside upload.write() isn't counted as download.
+    chunks = response.iter_content(chunk_size=MEDIA_CHUNK_SIZE)
+    while True:
+        started = time.monotonic()
+        chunk = next(chunks, None)
+        upload.download_seconds += time.monotonic() - started
+        if chunk is None:
+            return
+        upload.downloaded += len(chunk)
+        yield chunk
+
+
+class MediaUpload:
+    # Buffers up to MEDIA_PART_SIZE bytes and ships each full buffer as an S3
+    # multipart part. Files smaller than one part go up with a single put,
+    # unless identical bytes are already stored under another key.
+    def __init__(self, key):
+        self.key = key
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.uploaded = 0
+        self.hasher = hashlib.sha256()
+        self.etag = None
+        self.downloaded = 0
+        self.download_seconds = 0.0
+        self.sent = 0
+        self.upload_seconds = 0.0
+
+    @property
+    def size(self):
+        return self.received
+
+    @property
+    def content_hash(self):
+        return self.hasher.hexdigest()
+
+    @property
+    def received(self):
+        return self.uploaded + len(self.buffer)
+
+    def write(self, chunk):
+        self.hasher.update(chunk)
+        self.buffer += chunk
+        if len(self.buffer) >= MEDIA_PART_SIZE:
+            self._flush_part()
+
+    def _s3(self, method, nbytes=0, **kwargs):
+        started = time.monotonic()
         try:
-            response = media_req.get(url, stream=True, proxies=proxy, timeout=300)
-            if response.status_code == 200:
-                filepath = Path(filename)
-                filepath.parent.mkdir(parents=True, exist_ok=True)        
-                with open(filepath, 'wb') as f:
-                    f.write(response.content)
-                s3_client.upload_file(str(filepath), s3_bucket, filepath.name)
-                os.remove(filename)
-                return True
-            retry += 1
+            return getattr(GetS3Client(), method)(Bucket=s3_bucket, Key=self.key, **kwargs)
+        finally:
+            self.upload_seconds += time.monotonic() - started
+            self.sent += nbytes
+
+    def _flush_part(self):
+        if self.upload_id is None:
+            self.upload_id = self._s3('create_multipart_upload')['UploadId']
+        part_number = len(self.parts) + 1
+        response = self._s3('upload_part', len(self.buffer), UploadId=self.upload_id,
+                            PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.uploaded += len(self.buffer)
+        self.buffer = bytearray()
+
+    def complete(self):
+        if self.upload_id is None:
+            duplicate = storage.get_media_by_hash(self.content_hash)
+            if duplicate:
+                self.key = duplicate['s3_key']
+                self.etag = duplicate['etag']
+            else:
+                response = self._s3('put_object', len(self.buffer), Body=bytes(self.buffer))
+                self.etag = response.get('ETag')
+        else:
+            if self.buffer:
+                self._flush_part()
+            response = self._s3('complete_multipart_upload', UploadId=self.upload_id,
+                                MultipartUpload={'Parts': self.parts})
+            self.etag = response.get('ETag')
+            self.upload_id = None
+        self.uploaded = self.received
+        self.buffer = bytearray()
+
+    def reset(self):
+        self.abort()
+        self.buffer = bytearray()
+        self.parts = []
+        self.uploaded = 0
+        self.hasher = hashlib.sha256()
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                self._s3('abort_multipart_upload', UploadId=self.upload_id)
+            except Exception as e:
+                logger.error(f"Failed to abort upload {self.key}: {e}")
+            self.upload_id = None
+
+
+def DownloadAll(jobs):
+    # Fetch/upload every (post_id, url, filename) job with bounded concurrency.
+    # Returns ({post_id: [filenames that failed]}, {filename: s3 key}).
+    failed = {}
+    stored = {}
+    if not jobs:
+        return failed, stored
+    pool = GetMediaPool()
+    # Each job runs in a copy of the caller's context so its timings land in
+    # the scrape's stage breakdown.
+    futures = {pool.submit(contextvars.copy_context().run, DownloadMedia, url, filename): (post_id, filename)
+               for post_id, url, filename in jobs}
+    for future in as_completed(futures):
+        post_id, filename = futures[future]
+        try:
+            s3_key = future.result()
         except Exception as e:
-            print(e)
-    return False
+            logger.error(f"Media failed {filename}: {e}")
+            s3_key = None
+        if s3_key:
+            logger.info(f"Media stored: {filename} -> {s3_key}")
+            stored[filename] = s3_key
+        else:
+            logger.error(f"Media failed: {filename}")
+            failed.setdefault(post_id, []).append(filename)
+    return failed, stored
 
 
-def ScrapeUser(username):
-    logger.info(f"Processing user: {username}")
-    
-    profile_url = f'https://www.instagram.com/api/v1/users/web_profile_info/?username={username}'
-    response = SendRequests(profile_url)
-    if response == None:
-        logger.error(f"Failed to fetch profile for {username}")
-        return False
-    print(response.text)
-    user_data = response.json()['data']['user']
-    posts = user_data.get('edge_owner_to_timeline_media', {}).get('edges', [])
-    logger.info(f"Found {len(posts)} posts for {username}")
-    
+def ParseUser(user_data, username):
     business_address = {}
     if user_data.get('business_address_json'):
         business_address = json.loads(user_data['business_address_json'])
     
-    user_data = {
+    return {
         'username': username,
         'biography': user_data.get('biography', ''),
         'eimu_id': user_data.get('eimu_id', ''),
@@ -128,53 +446,301 @@ def ScrapeUser(username):
         'street_address': business_address.get('street_address', ''),
         'zip_code': business_address.get('zip_code', '')
     }
+
+
+def ParsePost(post_node, user_data):
+    # Returns the post row and the (post_id, url, filename) media jobs it needs.
+    post_id = post_node.get('id', '')
+    media_jobs = []
+    video_filename = None
+    image_filename = None
     
-    insert_user(user_data)
-    all_posts = get_all_posts(user_data['username'])
-    print(all_posts)
-    for i, post in enumerate(posts):
-        post_node = post.get('node', {})
+    if post_node.get('is_video') and post_node.get('video_url'):
+        video_filename = f'media/{user_data["id"]}_{post_id}.mp4'
+        media_jobs.append((post_id, post_node['video_url'], video_filename))
+    
+    if post_node.get('display_url'):
+        image_filename = f'media/{user_data["id"]}_{post_id}.jpg'
+        media_jobs.append((post_id, post_node['display_url'], image_filename))
+        
+    caption_edges = post_node.get('edge_media_to_caption', {}).get('edges', [])
+    caption = ''
+    for edge in caption_edges:
+        caption += edge.get('node', {}).get('text', '')
+    
+    post_data = {
+        'username': user_data['username'],
+        'id': user_data.get('id', ''),
+        'post_id': post_id,
+        'is_video': post_node.get('is_video', False),
+        'video_view_count': post_node.get('video_view_count', 0),
+        'taken_at_timestamp': post_node.get('taken_at_timestamp', 0),
+        'liked_by': post_node.get('edge_liked_by', {}).get('count', 0),
+        'post_preview_like': post_node.get('edge_media_preview_like', {}).get('count', 0),
+        'img_file': image_filename,
+        'video_file': video_filename,
+        'accessibility_caption': post_node.get('accessibility_caption', ''),
+        'caption': caption,
+        'scraped_at': datetime.now().isoformat()
+    }
+    return post_data, media_jobs
+
+
+def SelectNewPosts(user_data, edges):
+    # Returns rows and media jobs for posts not yet in the DB, and whether a
+    # known (non-pinned) post was reached.
+    nodes = [edge.get('node', {}) for edge in edges]
+    known = storage.get_existing_post_ids(node.get('id', '') for node in nodes)
+    new_posts = []
+    media_jobs = []
+    reached_known = False
+    for post_node in nodes:
         post_id = post_node.get('id', '')
-        if post_id in all_posts:
+        if post_id in known:
             logger.info(f"post already downloaded {post_id}")
+            # Pinned posts sit on top regardless of age, so they don't mark
+            # the point where the timeline becomes familiar.
+            if not post_node.get('pinned_for_users'):
+                reached_known = True
             continue
-            
-        video_filename = None
-        image_filename = None
-        
-        if post_node.get('is_video') and post_node.get('video_url'):
-            video_filename = f'media/{user_data["id"]}_{post_id}.mp4'
-            if DownloadMedia(post_node['video_url'], video_filename):
-                logger.info(f"Video downloaded: {post_id}")
-        
-        if post_node.get('display_url'):
-            image_filename = f'media/{user_data["id"]}_{post_id}.jpg'
-            if DownloadMedia(post_node['display_url'], image_filename):
-                logger.info(f"Image downloaded: {post_id}")
-            
-        caption_edges = post.get('node', {}).get('edge_media_to_caption', {}).get('edges', [])
-        caption = ''
-        for edge in caption_edges:
-            caption += edge.get('node', {}).get('text', '')
-        
-        post_data = {
-            'username': username,
-            'id': user_data.get('id', ''),
-            'post_id': post_id,
-            'video_view_count': post_node.get('video_view_count', 0),
-            'taken_at_timestamp': post_node.get('taken_at_timestamp', 0),
-            'post_liked_by': post_node.get('edge_liked_by', {}).get('count', 0),
-            'post_preview_like': post_node.get('edge_media_preview_like', {}).get('count', 0),
-            'img_file': image_filename,
-            'video_file': video_filename,
-            'accessibility_caption': post_node.get('accessibility_caption', ''),
-            'caption': caption,
-            'scraped_at': datetime.now().isoformat()
-        }
-        insert_post(post_data)
-        
-    logger.info(f"Completed {username}: {len(posts)} posts processed")
-    return True
+        post_data, jobs = ParsePost(post_node, user_data)
+        new_posts.append(post_data)
+        media_jobs.extend(jobs)
+    return new_posts, media_jobs, reached_known
+
+
+def ResolveMedia(user_data, new_posts, failed, stored):
+    if failed:
+        # Posts with missing media are left out so the next scrape retries them.
+        logger.warning(f"{len(failed)} media items failed for {user_data['username']}")
+        new_posts = [post for post in new_posts if post['post_id'] not in failed]
+    for post in new_posts:
+        # Point at the object actually holding the bytes, which differs from
+        # the default name when the media was deduplicated.
+        for field in ('img_file', 'video_file'):
+            filename = post.get(field)
+            if filename in stored and stored[filename] != Path(filename).name:
+                post[field] = f"media/{stored[filename]}"
+    return new_posts
+
+
+def ProcessEdges(user_data, edges):
+    # Downloads media for posts not yet in the DB. Returns the rows to write,
+    # whether a known post was reached, and the failed post ids.
+    new_posts, media_jobs, reached_known = SelectNewPosts(user_data, edges)
+    failed, stored = DownloadAll(media_jobs)
+    return ResolveMedia(user_data, new_posts, failed, stored), reached_known, set(failed)
+
+
+class RetryMark:
+    # A refresh stops at the first stored post, which would hide posts left
+    # unwritten because their media failed further down. The oldest such
+    # post's taken_at is kept on scraping_status.retry_taken_at, and later
+    # refreshes keep walking past stored posts until they reach it.
+    def __init__(self, taken_at=None):
+        self.pending = taken_at
+        self.failed = None
+
+    def update(self, edges, failed, last_page):
+        nodes = [edge.get('node', {}) for edge in edges]
+        times = [node.get('taken_at_timestamp', 0) for node in nodes if not node.get('pinned_for_users')]
+        if last_page or (self.pending is not None and times and min(times) <= self.pending):
+            self.pending = None
+        times = [node.get('taken_at_timestamp', 0) for node in nodes if node.get('id') in failed]
+        if times:
+            self.failed = min(times + ([self.failed] if self.failed is not None else []))
+
+    @property
+    def passed(self):
+        return self.pending is None
+
+    @property
+    def taken_at(self):
+        marks = [mark for mark in (self.pending, self.failed) if mark is not None]
+        return min(marks) if marks else None
+
+
+def SaveTimelinePage(user_data, page, cursor, new_posts, failed, checkpoint, profile):
+    # Writes one page's posts, plus the profile row and checkpoint fields,
+    # in a single transaction.
+    edges = page.get('edges', [])
+    next_cursor = NextCursor(page)
+    fields = {}
+    if checkpoint:
+        if failed:
+            fields['end_cursor'] = cursor
+        elif next_cursor:
+            fields['end_cursor'] = next_cursor
+        else:
+            fields['end_cursor'] = None
+            fields['backfill_complete'] = True
+    if cursor is None:
+        newest = [edge.get('node', {}) for edge in edges]
+        newest = [node for node in newest
+                  if not node.get('pinned_for_users') and node.get('id') not in failed]
+        if newest:
+            newest = max(newest, key=lambda node: node.get('taken_at_timestamp', 0))
+            fields['newest_post_id'] = newest.get('id')
+            fields['newest_taken_at'] = newest.get('taken_at_timestamp')
+
+    storage.save_page(user_data['username'], user_data if profile else None, new_posts,
+                      KnownPostMetrics(user_data, edges, new_posts), fields)
+
+
+def KnownPostMetrics(user_data, edges, new_posts):
+    # Current counters for the page's posts that weren't just inserted, so
+    # posts already stored still get their likes/views history.
+    new_ids = {post['post_id'] for post in new_posts}
+    return [{
+        'post_id': node.get('id'),
+        'username': user_data['username'],
+        'liked_by': node.get('edge_liked_by', {}).get('count', 0),
+        'video_view_count': node.get('video_view_count', 0),
+    } for node in (edge.get('node', {}) for edge in edges) if node.get('id') not in new_ids]
+
+
+def NextCursor(page):
+    page_info = page.get('page_info', {})
+    return page_info.get('end_cursor') if page_info.get('has_next_page') else None
+
 
+def TimelineUrl(user_id, cursor):
+    variables = json.dumps({'id': user_id, 'first': TIMELINE_PAGE_SIZE, 'after': cursor})
+    return f'{INSTAGRAM_BASE_URL}/graphql/query/?query_hash={TIMELINE_QUERY_HASH}&variables={quote(variables)}'
 
 
+def ParseTimelinePage(payload):
+    return ((payload.get('data') or {}).get('user') or {}).get('edge_owner_to_timeline_media')
+
+
+def FetchTimelinePage(user_data, cursor):
+    # A 404 here is the GraphQL endpoint (or a stale query hash), not the
+    # account: stop the walk and keep the checkpoint instead of failing it.
+    try:
+        response = SendRequests(TimelineUrl(user_data['id'], cursor))
+    except ProfileUnavailable as e:
+        logger.error(f"{user_data['username']}: timeline unavailable: {e}")
+        return None
+    if response is None:
+        return None
+    archive_response(user_data['username'], 'timeline', response.content, cursor)
+    return ParseTimelinePage(response.json())
+
+
+def WalkTimeline(user_data, page, cursor, budget, checkpoint, stop_at_known, profile=False, retry=None):
+    # Follows page_info.end_cursor from `page` (fetched with `cursor`). Each
+    # page's posts are written in one transaction together with, when
+    # `checkpoint` is set, the cursor to resume from, so an interrupted walk
+    # picks up at the last completed page. A refresh with a `retry` mark
+    # doesn't stop at stored posts until it has passed the mark. Returns the
+    # number of pages used.
+    username = user_data['username']
+    pages = 0
+    while True:
+        pages += 1
+        next_cursor = NextCursor(page)
+        new_posts, reached_known, failed = ProcessEdges(user_data, page.get('edges', []))
+        SaveTimelinePage(user_data, page, cursor, new_posts, failed, checkpoint, profile and pages == 1)
+        logger.info(f"{username}: page {pages} saved {len(new_posts)} new posts")
+        if retry is not None:
+            retry.update(page.get('edges', []), failed, not next_cursor)
+
+        if failed and checkpoint:
+            break
+        if (stop_at_known and reached_known and (retry is None or retry.passed)) or not next_cursor or pages >= budget:
+            break
+        page = FetchTimelinePage(user_data, next_cursor)
+        if page is None:
+            logger.error(f"Failed to fetch timeline page for {username}")
+            break
+        cursor = next_cursor
+    return pages
+
+
+def ProfileUrl(username):
+    return f'{INSTAGRAM_BASE_URL}/api/v1/users/web_profile_info/?username={username}'
+
+
+def ParseProfile(payload, username):
+    raw_user = (payload.get('data') or {}).get('user')
+    if not raw_user:
+        raise ProfileUnavailable(f"Profile {username} does not exist")
+    user_data = ParseUser(raw_user, username)
+    timeline = raw_user.get('edge_owner_to_timeline_media', {})
+    posts_count = timeline.get('count', len(timeline.get('edges', [])))
+    return raw_user, user_data, timeline, posts_count
+
+
+def CompletionOps(user_data, posts_count, state, retry=None):
+    # Marks the scrape completed and schedules the next refresh from how much
+    # the account changed since `state`, the status row before this scrape.
+    username = user_data['username']
+    ops = [
+        ('update_scraping_status', {'username': username, 'status': 'completed', 'posts_count': posts_count}),
+        ('update_refresh_schedule', {'username': username,
+                                     **plan_refresh(state, posts_count, user_data['followed_by'])}),
+    ]
+    if retry is not None and retry.taken_at != state.get('retry_taken_at'):
+        ops.append(('save_page', {'username': username, 'checkpoint': {'retry_taken_at': retry.taken_at}}))
+    return ops
+
+
+def RecordFailure(username, error, permanent=False):
+    # Marks the scrape failed and backs the account's next refresh off;
+    # `permanent` is for profiles that are gone (ProfileUnavailable).
+    ops = [('update_scraping_status', {'username': username, 'status': 'failed',
+                                       'posts_count': None, 'error_message': error})]
+    backoff = plan_backoff(storage.get_scraping_status(username) or {}, permanent)
+    if backoff:
+        ops.append(('update_refresh_schedule', {'username': username, **backoff}))
+    storage.write(ops)
+
+
+def SavePrivateProfile(user_data, posts_count, state):
+    # Timeline is hidden; store the profile and skip the post/media work.
+    logger.info(f"{user_data['username']} is private, skipping posts")
+    storage.write([
+        ('save_page', {'username': user_data['username'], 'user_data': user_data}),
+        *CompletionOps(user_data, posts_count, state),
+    ])
+
+
+def TimelinePlan(state):
+    # A refresh walks from the newest post and stops at the first one already
+    # stored. Until the account has been walked to the end once, the walk
+    # also checkpoints its cursor; an interrupted backfill resumes from the
+    # saved cursor after the refresh pass.
+    backfill_done = bool(state.get('backfill_complete'))
+    resume_cursor = state.get('end_cursor')
+    deep = not backfill_done and not resume_cursor
+    return backfill_done, resume_cursor, deep
+
+
+def ScrapeUser(username):
+    logger.info(f"Processing user: {username}")
+    
+    response = SendRequests(ProfileUrl(username))
+    if response == None:
+        logger.error(f"Failed to fetch profile for {username}")
+        return False
+    archive_response(username, 'profile', response.content)
+    raw_user, user_data, timeline, posts_count = ParseProfile(response.json(), username)
+    state = storage.get_scraping_status(username) or {}
+    if raw_user.get('is_private'):
+        SavePrivateProfile(user_data, posts_count, state)
+        return True
+
+    backfill_done, resume_cursor, deep = TimelinePlan(state)
+    retry = None if deep else RetryMark(state.get('retry_taken_at'))
+    pages = WalkTimeline(user_data, timeline, None, MAX_TIMELINE_PAGES,
+                         checkpoint=deep, stop_at_known=not deep, profile=True, retry=retry)
+    if not deep and not backfill_done and pages < MAX_TIMELINE_PAGES:
+        logger.info(f"Resuming backfill for {username}")
+        page = FetchTimelinePage(user_data, resume_cursor)
+        if page is not None:
+            pages += WalkTimeline(user_data, page, resume_cursor, MAX_TIMELINE_PAGES - pages,
+                                  checkpoint=True, stop_at_known=False)
+
+    storage.write(CompletionOps(user_data, posts_count, state, retry))
+    logger.info(f"Completed {username}: {pages} timeline pages processed")
+    return True
@@ -1,17 +1,22 @@
 import os
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import Request
 from pydantic import BaseModel, Field
-from tasks import app as celery_app
-from tasks import scrape_insta
+from contextlib import asynccontextmanager
+from celery_app import app as celery_app
+from scrape_queue import enqueue_scrape, dispatch_batch, get_batch_progress
 from celery.result import AsyncResult
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-from db_utils import get_user_with_posts
+from db_utils import EXPORT_TABLES, EXPORT_FORMATS, SEARCH_TYPES, GROWTH_RESOLUTIONS
+from storage import storage
+from proxy_pool import get_published_stats
+import metrics
+from cache import user_cache
 from dotenv import load_dotenv
 import logging
 
@@ -21,13 +26,19 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    storage.init()
+    yield
+
 app = FastAPI(
     title="Insta API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 class TaskResponse(BaseModel):
-    task_id: str
+    task_id: Optional[str] = None
     status: str
     message: str
 
@@ -41,7 +52,45 @@ class TaskStatusResponse(BaseModel):
 class UserRequest(BaseModel):
     username : str
 
+class ScrapeRequest(UserRequest):
+    force: bool = False
+
+class UsersRequest(BaseModel):
+    usernames: List[str]
+    posts_per_user: int = Field(20, ge=0, le=100)
+
+class BatchRequest(BaseModel):
+    usernames: List[str]
+    force: bool = False
+
+class BatchResponse(BaseModel):
+    batch_id: str
+    status: str
+    total: int
+    queued: int
+    in_progress: int
+    fresh: int
+    message: str
+
+class BatchStatusResponse(BaseModel):
+    batch_id: str
+    total: int
+    started: int
+    running: int
+    pending: int
+    success: int
+    failed: int
+    skipped: int
+    done: bool
+
 API_KEY =  os.getenv("APIKEY")
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 10000))
+MAX_LOOKUP_SIZE = int(os.getenv("MAX_LOOKUP_SIZE", 1000))
 
 app.add_middleware(
     CORSMiddleware,
@@ -120,33 +169,187 @@ async def get_task_status(task_id: str, _: bool = Depends(verify_api_key)):
         raise HTTPException(status_code=500, detail=f"Error checking task status: {str(e)}")
 
 @app.post("/api/v1/scrape/username", response_model=TaskResponse)
-async def scrape_username(request: UserRequest, _: bool = Depends(verify_api_key)):
+async def scrape_username(request: ScrapeRequest, _: bool = Depends(verify_api_key)):
     try:
         logger.info(f"Starting scrape task for username: {request.username}")
         
-        task = scrape_insta.delay(request.username)
-        
-        logger.info(f"Task created with ID: {task.id} for username: {request.username}")
+        task_id, status = enqueue_scrape(request.username, force=request.force)
+
+        if status == "fresh":
+            message = f"{request.username} was scraped recently; pass force=true to re-scrape"
+        elif status == "in_progress":
+            message = f"User scraping task already queued for {request.username}"
+        else:
+            message = f"User scraping task queued for {request.username}"
+        logger.info(f"Task {task_id} ({status}) for username: {request.username}")
         
         return TaskResponse(
-            task_id=task.id,
-            status="queued",
-            message=f"User scraping task queued for {request.username}"
+            task_id=task_id,
+            status=status,
+            message=message
         )
     except Exception as e:
         logger.error(f"Error creating scrape task for {request.username}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def clean_usernames(usernames):
+    seen = {}
+    for username in usernames:
+        username = username.strip().lstrip('@')
+        if username:
+            seen[username] = None
+    return list(seen)
+
+@app.post("/api/v1/scrape/batch", response_model=BatchResponse)
+async def scrape_batch(request: Request, _: bool = Depends(verify_api_key)):
+    # Accepts either {"usernames": [...]} or a multipart upload with a
+    # "file" field holding one username per line.
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None:
+            raise HTTPException(status_code=400, detail="Missing file field")
+        usernames = (await upload.read()).decode("utf-8").splitlines()
+        force = str(form.get("force", "")).lower() in ("1", "true", "yes")
+    else:
+        try:
+            batch = BatchRequest(**await request.json())
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid batch request: {str(e)}")
+        usernames, force = batch.usernames, batch.force
+
+    usernames = clean_usernames(usernames)
+    if not usernames:
+        raise HTTPException(status_code=400, detail="No usernames supplied")
+    if len(usernames) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {MAX_BATCH_SIZE} usernames")
+
+    try:
+        batch_id, counts = dispatch_batch(usernames, force=force)
+        logger.info(f"Batch {batch_id}: {counts['queued']} of {len(usernames)} usernames queued")
+        return BatchResponse(
+            batch_id=batch_id,
+            status="queued",
+            total=len(usernames),
+            message=f"Scraping tasks queued for {counts['queued']} users",
+            **counts
+        )
+    except Exception as e:
+        logger.error(f"Error creating batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/batch/{batch_id}", response_model=BatchStatusResponse)
+async def batch_status(batch_id: str, _: bool = Depends(verify_api_key)):
+    try:
+        progress = get_batch_progress(batch_id)
+    except Exception as e:
+        logger.error(f"Error reading batch {batch_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if progress is None:
+        raise HTTPException(status_code=404, detail=f"Batch not found or expired: {batch_id}")
+    return BatchStatusResponse(batch_id=batch_id, **progress)
+
 @app.post("/api/v1/get-user")
-async def get_user(request: UserRequest, _: bool = Depends(verify_api_key)):
+async def get_user(request: UserRequest, http_request: Request, _: bool = Depends(verify_api_key)):
     try:
         logger.info(f"Getting user data for: {request.username}")
-        data = get_user_with_posts(request.username)
-        return data
+        cached = user_cache.get(request.username)
+        if cached is None:
+            cached = user_cache.set(request.username, storage.get_user_with_posts(request.username))
+        body, etag = cached
+        if http_request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
     except Exception as e:
         logger.error(f"Error getting user data for {request.username}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/v1/get-users")
+async def get_users(request: UsersRequest, _: bool = Depends(verify_api_key)):
+    usernames = clean_usernames(request.usernames)
+    if len(usernames) > MAX_LOOKUP_SIZE:
+        raise HTTPException(status_code=400, detail=f"Lookup exceeds {MAX_LOOKUP_SIZE} usernames")
+    try:
+        logger.info(f"Getting user data for {len(usernames)} users")
+        users = storage.get_users_with_posts(usernames, request.posts_per_user)
+        return {
+            "users": users,
+            "missing": [username for username in usernames if username not in users]
+        }
+    except Exception as e:
+        logger.error(f"Error getting bulk user data: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/user/{username}/posts")
+async def user_posts(username: str, cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=100),
+                     _: bool = Depends(verify_api_key)):
+    try:
+        return storage.get_user_posts(username, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error getting posts for {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/user/{username}/growth")
+async def user_growth(username: str, resolution: str = 'day', since: Optional[int] = None,
+                      until: Optional[int] = None, limit: int = Query(90, ge=1, le=2000),
+                      _: bool = Depends(verify_api_key)):
+    if resolution not in GROWTH_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of {sorted(GROWTH_RESOLUTIONS)}")
+    try:
+        growth = storage.get_user_growth(username, resolution, since, until, limit)
+    except Exception as e:
+        logger.error(f"Error getting growth for {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if growth is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return growth
+
+@app.get("/api/v1/search")
+async def search_index(q: str, search_type: str = Query('posts', alias='type'), field: Optional[str] = None,
+                       username: Optional[str] = None, limit: int = Query(20, ge=1, le=100),
+                       offset: int = Query(0, ge=0, le=1000), _: bool = Depends(verify_api_key)):
+    if search_type not in SEARCH_TYPES:
+        raise HTTPException(status_code=400, detail=f"type must be one of {sorted(SEARCH_TYPES)}")
+    try:
+        results = storage.search(q, search_type, field, username, limit, offset)
+        return {"query": q, "type": search_type, "results": results}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error searching {search_type} for {q!r}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/export/{table_name}")
+async def export_table(table_name: str, format: str = Query("csv"), since: Optional[str] = None,
+                       _: bool = Depends(verify_api_key)):
+    if table_name not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table: {table_name}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    logger.info(f"Exporting {table_name} as {format} since {since}")
+    filename = f"{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        storage.iter_export(table_name, format, since),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/v1/proxies/stats")
+async def proxy_stats(_: bool = Depends(verify_api_key)):
+    try:
+        return {"workers": get_published_stats()}
+    except Exception as e:
+        logger.error(f"Error reading proxy stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/metrics")
+async def prometheus_metrics(_: bool = Depends(verify_api_key)):
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/api/v1/debug/celery-status")
 async def celery_status(_: bool = Depends(verify_api_key)):
     try:
@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest,
+)
+
+# Prometheus metrics plus a per-scrape stage breakdown. Celery and gunicorn
+# run several processes; set PROMETHEUS_MULTIPROC_DIR to the same empty
+# directory for the API and the workers on a host, and /metrics aggregates
+# all of them. Without it /metrics only shows the API process itself.
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TASK_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+REQUEST_SECONDS = Histogram(
+    'insta_request_seconds', "Instagram API request latency per attempt",
+    ['endpoint', 'outcome'], buckets=LATENCY_BUCKETS)
+REQUEST_RETRIES = Counter(
+    'insta_request_retries_total', "Instagram API attempts that were retried",
+    ['endpoint', 'reason'])
+MEDIA_SECONDS = Histogram(
+    'insta_media_seconds', "Per-file media time, CDN download vs S3 upload",
+    ['phase'], buckets=LATENCY_BUCKETS)
+MEDIA_BYTES = Counter(
+    'insta_media_bytes_total', "Media bytes read from the CDN or sent to S3", ['phase'])
+MEDIA_FILES = Counter(
+    'insta_media_files_total', "Media files by how they were resolved", ['outcome'])
+DB_WRITE_SECONDS = Histogram(
+    'insta_db_write_seconds', "SQLite write transactions, including lock wait",
+    ['operation'], buckets=LATENCY_BUCKETS)
+TASK_SECONDS = Histogram(
+    'insta_scrape_seconds', "Whole-profile scrape duration",
+    ['task', 'outcome'], buckets=TASK_BUCKETS)
+
+_stages = contextvars.ContextVar('scrape_stages', default=None)
+
+
+class StageTimings:
+    # Seconds, event counts and bytes per stage for one scrape. Media work
+    # runs on several threads, so stage seconds are summed across threads
+    # and can exceed the wall-clock total.
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, nbytes=0, count=1):
+        with self.lock:
+            entry = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0, 'bytes': 0})
+            entry['seconds'] += seconds
+            entry['count'] += count
+            entry['bytes'] += nbytes
+
+    def as_dict(self):
+        with self.lock:
+            stages = {
+                stage: {key: round(value, 4) if key == 'seconds' else value
+                        for key, value in entry.items() if value or key == 'seconds'}
+                for stage, entry in self.stages.items()
+            }
+        return {'total_seconds': round(time.monotonic() - self.started, 4), 'stages': stages}
+
+
+@contextmanager
+def track_stages():
+    # Collects record_stage() calls made in this context; worker threads
+    # must be started with contextvars.copy_context() to report into it.
+    timings = StageTimings()
+    token = _stages.set(timings)
+    try:
+        yield timings
+    finally:
+        _stages.reset(token)
+
+
+def record_stage(stage, seconds=0.0, nbytes=0, count=1):
+    timings = _stages.get()
+    if timings is not None:
+        timings.add(stage, seconds, nbytes, count)
+
+
+def observe_request(endpoint, outcome, seconds):
+    REQUEST_SECONDS.labels(endpoint, str(outcome)).observe(seconds)
+    record_stage('api', seconds)
+
+
+def count_retry(endpoint, reason):
+    REQUEST_RETRIES.labels(endpoint, str(reason)).inc()
+    record_stage('retries', count=1)
+
+
+def observe_media(phase, seconds, nbytes):
+    MEDIA_SECONDS.labels(phase).observe(seconds)
+    MEDIA_BYTES.labels(phase).inc(nbytes)
+    record_stage(phase, seconds, nbytes)
+
+
+def count_media(outcome):
+    MEDIA_FILES.labels(outcome).inc()
+    record_stage(f'media_{outcome}', count=1)
+
+
+def observe_db(operation, seconds):
+    DB_WRITE_SECONDS.labels(operation).observe(seconds)
+    record_stage('db', seconds)
+
+
+def observe_task(task, outcome, seconds):
+    TASK_SECONDS.labels(task, outcome).observe(seconds)
+
+
+def render():
+    # Returns (body, content type) for the /metrics endpoint.
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import random
+import socket
+import logging
+import threading
+from collections import deque
+from redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+PROXY_COOLDOWN = float(os.getenv("PROXY_COOLDOWN", 60))
+PROXY_MAX_COOLDOWN = float(os.getenv("PROXY_MAX_COOLDOWN", 900))
+RATE_LIMIT_WINDOW = 300
+FAILURES_BEFORE_COOLDOWN = 3
+LATENCY_ALPHA = 0.3
+STATS_KEY = "proxy_pool:stats"
+PUBLISH_INTERVAL = 10
+STATS_MAX_AGE = 600
+
+
+class ProxyEntry:
+    def __init__(self, url):
+        self.url = url
+        self.proxies = {'http': url, 'https': url}
+        self.latency = None
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.strikes = 0
+        self.recent_429 = deque()
+        self.cooldown_until = 0
+        self.in_flight = 0
+
+    @property
+    def name(self):
+        # Never expose proxy credentials in logs or stats.
+        return self.url.split('://', 1)[-1].rsplit('@', 1)[-1]
+
+    def success_rate(self):
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def score(self, now):
+        while self.recent_429 and self.recent_429[0] < now - RATE_LIMIT_WINDOW:
+            self.recent_429.popleft()
+        latency = self.latency or 1.0
+        return self.success_rate() / (latency * (1 + len(self.recent_429)) * (1 + self.in_flight))
+
+    def stats(self, now):
+        return {
+            'proxy': self.name,
+            'latency_ms': round(self.latency * 1000) if self.latency is not None else None,
+            'success_rate': round(self.success_rate(), 3),
+            'successes': self.successes,
+            'failures': self.failures,
+            'recent_429': len(self.recent_429),
+            'cooling_down': self.cooldown_until > now,
+            'cooldown_remaining': max(0, round(self.cooldown_until - now)),
+            'in_flight': self.in_flight,
+        }
+
+
+class ProxyPool:
+    def __init__(self, urls):
+        self.entries = [ProxyEntry(url) for url in urls]
+        self.lock = threading.Lock()
+        self.last_publish = 0
+
+    def acquire(self):
+        if not self.entries:
+            return None
+        now = time.time()
+        with self.lock:
+            healthy = [entry for entry in self.entries if entry.cooldown_until <= now]
+            if healthy:
+                best = max(healthy, key=lambda entry: (entry.score(now), random.random()))
+            else:
+                # Everything is cooling down: use whichever recovers first.
+                best = min(self.entries, key=lambda entry: entry.cooldown_until)
+            best.in_flight += 1
+        return best
+
+    def report(self, entry, ok, latency=None, status_code=None):
+        if entry is None:
+            return
+        now = time.time()
+        with self.lock:
+            entry.in_flight = max(0, entry.in_flight - 1)
+            if latency is not None:
+                if entry.latency is None:
+                    entry.latency = latency
+                else:
+                    entry.latency += LATENCY_ALPHA * (latency - entry.latency)
+            if status_code == 429:
+                entry.recent_429.append(now)
+            if ok:
+                entry.successes += 1
+                entry.consecutive_failures = 0
+                entry.strikes = 0
+            else:
+                entry.failures += 1
+                entry.consecutive_failures += 1
+                if status_code == 429 or entry.consecutive_failures >= FAILURES_BEFORE_COOLDOWN:
+                    entry.strikes += 1
+                    cooldown = min(PROXY_MAX_COOLDOWN, PROXY_COOLDOWN * 2 ** (entry.strikes - 1))
+                    entry.cooldown_until = now + cooldown
+                    entry.consecutive_failures = 0
+                    logger.warning(f"Proxy {entry.name} cooling down for {cooldown:.0f}s")
+        self.publish()
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return [entry.stats(now) for entry in self.entries]
+
+    def publish(self):
+        # Workers push their view of the pool to Redis so the API can report
+        # it; throttled so this never costs more than one write per interval.
+        now = time.time()
+        if now - self.last_publish < PUBLISH_INTERVAL:
+            return
+        self.last_publish = now
+        try:
+            payload = json.dumps({'updated_at': now, 'proxies': self.stats()})
+            client = get_redis()
+            client.hset(STATS_KEY, f"{socket.gethostname()}:{os.getpid()}", payload)
+            client.expire(STATS_KEY, STATS_MAX_AGE)
+        except Exception as e:
+            logger.warning(f"Failed to publish proxy stats: {e}")
+
+
+def load_proxy_urls():
+    username = os.getenv("PROXY_USERNAME")
+    password = os.getenv("PROXY_PASSWORD")
+    endpoints = os.getenv("PROXY_ENDPOINTS") or os.getenv("ENDPOINT") or ''
+    urls = []
+    for endpoint in endpoints.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        if '://' in endpoint:
+            urls.append(endpoint)
+        elif username:
+            urls.append(f'http://{username}:{password}@{endpoint}')
+        else:
+            urls.append(f'http://{endpoint}')
+    return urls
+
+
+def get_published_stats():
+    workers = {}
+    cutoff = time.time() - STATS_MAX_AGE
+    for worker, payload in get_redis().hgetall(STATS_KEY).items():
+        data = json.loads(payload)
+        if data['updated_at'] >= cutoff:
+            workers[worker.decode()] = data
+    return workers
+
+
+proxy_pool = ProxyPool(load_proxy_urls())
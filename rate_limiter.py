@@ -0,0 +1,115 @@
+import os
+import time
+import logging
+import threading
+from redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+# (tokens per second, burst) for each budget. "profile" covers Instagram API
+# calls, "media" CDN fetches, and "proxy" is applied per proxy on API calls.
+LIMITS = {
+    'profile': (float(os.getenv("PROFILE_RATE", 1)), float(os.getenv("PROFILE_BURST", 5))),
+    'media': (float(os.getenv("MEDIA_RATE", 20)), float(os.getenv("MEDIA_BURST", 40))),
+    'proxy': (float(os.getenv("PROXY_RATE", 0.5)), float(os.getenv("PROXY_BURST", 2))),
+}
+KEY_PREFIX = "ratelimit:"
+MAX_SLEEP = 5
+REDIS_RETRY_INTERVAL = 30
+
+# Refills the bucket from Redis' own clock so every worker host agrees on
+# time, then either takes the tokens or returns how long to wait.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class LocalTokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits, redis_client=None):
+        self.limits = limits
+        self.redis = redis_client
+        self.script = None
+        self.local = {}
+        self.local_lock = threading.Lock()
+        self.redis_down_until = 0
+
+    def _client(self):
+        if self.redis is None:
+            self.redis = get_redis()
+        return self.redis
+
+    def _take_redis(self, name, rate, capacity, tokens):
+        if self.script is None:
+            self.script = self._client().register_script(TOKEN_BUCKET_LUA)
+        return float(self.script(keys=[KEY_PREFIX + name], args=[rate, capacity, tokens]))
+
+    def _take_local(self, name, rate, capacity, tokens):
+        with self.local_lock:
+            bucket = self.local.get(name)
+            if bucket is None:
+                bucket = self.local[name] = LocalTokenBucket(rate, capacity)
+        return bucket.take(tokens)
+
+    def take(self, bucket, key=None, tokens=1):
+        # Returns 0 when the tokens were granted, else seconds until they might be.
+        rate, capacity = self.limits[bucket]
+        if rate <= 0:
+            return 0
+        name = bucket if key is None else f"{bucket}:{key}"
+        if time.monotonic() >= self.redis_down_until:
+            try:
+                return self._take_redis(name, rate, capacity, tokens)
+            except Exception as e:
+                # Keep scraping on the in-process buckets until Redis is back.
+                logger.warning(f"Rate limiter falling back to local buckets: {e}")
+                self.redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+        return self._take_local(name, rate, capacity, tokens)
+
+    def acquire(self, bucket, key=None, tokens=1):
+        waited = 0
+        while True:
+            wait = self.take(bucket, key, tokens)
+            if wait <= 0:
+                return waited
+            wait = min(wait, MAX_SLEEP)
+            time.sleep(wait)
+            waited += wait
+
+
+rate_limiter = RateLimiter(LIMITS)
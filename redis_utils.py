@@ -0,0 +1,18 @@
+import os
+import logging
+import redis
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+
+_client = None
+
+
+def get_redis():
+    # Shared client for the broker Redis; redis-py pools connections
+    # internally, so one client per process is enough.
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL, socket_timeout=5, socket_connect_timeout=5)
+    return _client
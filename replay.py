@@ -0,0 +1,77 @@
+import json
+import time
+import logging
+import argparse
+from insta_scraper import *
+from archive import iter_records, read_record, archived_usernames, archive_stats
+
+# Re-runs the parsing/persistence half of ScrapeUser against archived raw
+# payloads. Nothing touches the network: posts already in the DB get their
+# parsed fields refreshed (media columns are kept), and posts that were never
+# stored are left for a live scrape, which still has to fetch their media.
+
+logger = logging.getLogger(__name__)
+
+
+def ReplayUser(username):
+    profile = None
+    nodes = {}
+    for record in iter_records(username):
+        payload = json.loads(read_record(record))
+        if record['kind'] == 'profile':
+            user = (payload.get('data') or {}).get('user') or {}
+            if not user:
+                # ScrapeUser archives the payload before finding the account
+                # missing; keep the last profile that had one.
+                continue
+            profile = payload
+            page = user.get('edge_owner_to_timeline_media') or {}
+        else:
+            page = ParseTimelinePage(payload) or {}
+        # Later fetches overwrite earlier ones, so each post ends up with
+        # its most recently archived state.
+        for edge in page.get('edges', []):
+            node = edge.get('node', {})
+            nodes[node.get('id', '')] = node
+
+    if profile is None:
+        logger.warning(f"No archived profile for {username}")
+        return 0
+
+    raw_user, user_data, timeline, posts_count = ParseProfile(profile, username)
+    existing = storage.get_existing_post_ids(nodes)
+    posts = []
+    for post_id in existing:
+        post_data, _ = ParsePost(nodes[post_id], user_data)
+        post_data['img_file'] = None
+        post_data['video_file'] = None
+        posts.append(post_data)
+
+    storage.save_page(username, user_data, posts)
+    return len(posts)
+
+
+def ReplayAll(usernames=None):
+    usernames = usernames or archived_usernames()
+    started = time.monotonic()
+    total_posts = 0
+    for username in usernames:
+        try:
+            total_posts += ReplayUser(username)
+        except ProfileUnavailable as e:
+            logger.warning(f"Skipping {username}: {e}")
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {len(usernames)} users / {total_posts} posts in {elapsed:.1f}s")
+    return total_posts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-parse archived Instagram payloads without network access")
+    parser.add_argument('usernames', nargs='*', help="Defaults to every archived user")
+    parser.add_argument('--stats', action='store_true', help="Only print archive statistics")
+    args = parser.parse_args()
+
+    if args.stats:
+        print(archive_stats())
+    else:
+        ReplayAll(args.usernames)
@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+from datetime import datetime, timezone
+from celery import group
+from celery_app import app, BACKFILL_QUEUE
+from scrape_queue import SCRAPE_TASK, INFLIGHT_QUEUE_TTL, INFLIGHT_TTL, claim_usernames, release_usernames
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Adaptive refresh. Every completed scrape measures how much the account
+# changed since the previous one (posts added or removed, plus follower
+# movement) as changes/day, smooths it, and schedules the next scrape for
+# when about REFRESH_TARGET_CHANGES changes are expected. Busy accounts are
+# revisited within hours, dormant ones after days, so the proxy budget goes
+# where the data actually moves.
+REFRESH_MIN_INTERVAL = int(os.getenv("REFRESH_MIN_INTERVAL", 3600))
+REFRESH_MAX_INTERVAL = int(os.getenv("REFRESH_MAX_INTERVAL", 7 * 24 * 3600))
+REFRESH_TARGET_CHANGES = float(os.getenv("REFRESH_TARGET_CHANGES", 1.0))
+# A follower move of this fraction counts as one change.
+REFRESH_FOLLOWER_UNIT = float(os.getenv("REFRESH_FOLLOWER_UNIT", 0.01))
+# Weight of the newest observation in the smoothed rate.
+REFRESH_SMOOTHING = float(os.getenv("REFRESH_SMOOTHING", 0.5))
+# Accounts queued per scheduler run.
+REFRESH_BATCH = int(os.getenv("REFRESH_BATCH", 200))
+
+
+def _epoch(value):
+    # last_scraped is an aware datetime from Postgres and a UTC
+    # 'YYYY-MM-DD HH:MM:SS' string from SQLite.
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def plan_refresh(state, posts_count, followers, now=None):
+    # Fields for update_refresh_schedule from the scraping_status row as it
+    # was before this scrape. Without a previous scrape to compare with,
+    # the account is revisited after REFRESH_MIN_INTERVAL to measure a rate.
+    now = now or time.time()
+    previous = state.get('last_scraped')
+    rate = state.get('change_rate')
+    if previous and state.get('posts_count') is not None and state.get('last_followers') is not None:
+        elapsed_days = max(now - _epoch(previous), 60) / 86400
+        follower_change = abs(followers - state['last_followers']) / max(state['last_followers'], 1)
+        changes = abs(posts_count - state['posts_count']) + follower_change / REFRESH_FOLLOWER_UNIT
+        observed = changes / elapsed_days
+        rate = observed if rate is None else REFRESH_SMOOTHING * observed + (1 - REFRESH_SMOOTHING) * rate
+        interval = REFRESH_TARGET_CHANGES / rate * 86400 if rate > 0 else REFRESH_MAX_INTERVAL
+    else:
+        interval = REFRESH_MIN_INTERVAL
+    interval = min(max(interval, REFRESH_MIN_INTERVAL), REFRESH_MAX_INTERVAL)
+    return {
+        'next_scrape_at': int(now + interval),
+        'change_rate': round(rate, 4) if rate is not None else None,
+        'last_followers': followers,
+        'refresh_failures': 0,
+    }
+
+
+def plan_backoff(state, permanent, now=None):
+    # Fields for update_refresh_schedule after a failed scrape, or None for
+    # an account the refresher doesn't manage. A profile that is gone is
+    # only rechecked every REFRESH_MAX_INTERVAL; transient failures back off
+    # exponentially from REFRESH_MIN_INTERVAL until a scrape completes.
+    if state.get('next_scrape_at') is None:
+        return None
+    now = now or time.time()
+    failures = (state.get('refresh_failures') or 0) + 1
+    interval = REFRESH_MAX_INTERVAL if permanent else REFRESH_MIN_INTERVAL * 2 ** failures
+    return {
+        'next_scrape_at': int(now + min(interval, REFRESH_MAX_INTERVAL)),
+        'refresh_failures': failures,
+    }
+
+
+def plan_lease(state, now=None):
+    # Fields for update_refresh_schedule when a scrape starts, or None for an
+    # account the refresher doesn't manage. The dispatch lease only had to
+    # outlast the queue; this one covers the run and its retries.
+    if state.get('next_scrape_at') is None:
+        return None
+    return {'next_scrape_at': int((now or time.time()) + INFLIGHT_TTL)}
+
+
+def enqueue_due(limit=REFRESH_BATCH, now=None):
+    # Queues accounts whose refresh is due on the backfill queue. Each one
+    # is leased by pushing next_scrape_at out for as long as its task may
+    # wait in the queue (the message expires with it), however long the
+    # backlog; the task renews the lease when it starts, and a completed or
+    # failed scrape replaces it with its own schedule. A scrape that is lost
+    # is picked up again when its lease runs out, not every tick.
+    now = int(now or time.time())
+    due = storage.get_due_refreshes(now, limit)
+    if not due:
+        return {'due': 0, 'queued': 0, 'in_progress': 0}
+    # Leased before dispatch so a fast scrape's own schedule isn't overwritten.
+    storage.write([('update_refresh_schedule', {'username': username, 'next_scrape_at': now + INFLIGHT_QUEUE_TTL})
+                   for username in due])
+    claimed, existing = claim_usernames(due)
+    try:
+        group(app.signature(SCRAPE_TASK, args=(username,))
+              .set(task_id=task_id, queue=BACKFILL_QUEUE, expires=INFLIGHT_QUEUE_TTL)
+              for username, task_id in claimed.items()).apply_async()
+    except Exception:
+        if claimed:
+            release_usernames(claimed)
+        raise
+    logger.info(f"Refresh: {len(due)} due, {len(claimed)} queued, {len(existing)} already in flight")
+    return {'due': len(due), 'queued': len(claimed), 'in_progress': len(existing)}
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Queue accounts due for a refresh (normally run by celery beat)")
+    parser.add_argument('--limit', type=int, default=REFRESH_BATCH)
+    parser.add_argument('--dry-run', action='store_true', help="List due accounts without queueing them")
+    args = parser.parse_args()
+
+    storage.init()
+    if args.dry_run:
+        print('\n'.join(storage.get_due_refreshes(int(time.time()), args.limit)))
+    else:
+        print(json.dumps(enqueue_due(args.limit)))
@@ -0,0 +1,130 @@
+from celery import group
+import os
+import uuid
+import logging
+from celery_app import app, INTERACTIVE_QUEUE, BACKFILL_QUEUE
+from redis_utils import get_redis
+from storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Tasks are enqueued by name so callers never import the scraper itself.
+SCRAPE_TASK = 'tasks.scrape_insta'
+
+BATCH_TTL = int(os.getenv("BATCH_TTL", 7 * 24 * 3600))
+# How long a claimed username blocks duplicate submissions while its task
+# waits in the queue. The task message expires at the same moment, so a
+# scrape that outlives its claim is dropped instead of running alongside a
+# newer one.
+INFLIGHT_QUEUE_TTL = int(os.getenv("INFLIGHT_QUEUE_TTL", 24 * 3600))
+# Once the task starts its claim is renewed for this long; covers the
+# task's own retries with room to spare.
+INFLIGHT_TTL = int(os.getenv("INFLIGHT_TTL", 2 * 3600))
+# Accounts completed within this many seconds are not re-scraped unless forced.
+FRESHNESS_TTL = int(os.getenv("FRESHNESS_TTL", 6 * 3600))
+
+
+def batch_key(batch_id):
+    return f"batch:{batch_id}"
+
+
+def inflight_key(username):
+    return f"inflight:{username}"
+
+
+def claim_usernames(usernames):
+    # Atomically reserves a task id per username. Returns the usernames we
+    # claimed and, for the rest, the task id already queued or running.
+    client = get_redis()
+    task_ids = {username: str(uuid.uuid4()) for username in usernames}
+    pipe = client.pipeline()
+    for username, task_id in task_ids.items():
+        pipe.set(inflight_key(username), task_id, nx=True, ex=INFLIGHT_QUEUE_TTL)
+    claimed = {}
+    taken = []
+    for (username, task_id), ok in zip(task_ids.items(), pipe.execute()):
+        if ok:
+            claimed[username] = task_id
+        else:
+            taken.append(username)
+    existing = {}
+    if taken:
+        for username, task_id in zip(taken, client.mget([inflight_key(u) for u in taken])):
+            if task_id:
+                existing[username] = task_id.decode()
+    return claimed, existing
+
+
+def release_usernames(usernames):
+    get_redis().delete(*[inflight_key(username) for username in usernames])
+
+
+def renew_inflight(username, task_id):
+    # Called when the task starts (and on each retry); only extends a claim
+    # that is still there.
+    get_redis().set(inflight_key(username), task_id, xx=True, ex=INFLIGHT_TTL)
+
+
+def release_inflight(username, task_id):
+    client = get_redis()
+    if client.get(inflight_key(username)) == task_id.encode():
+        client.delete(inflight_key(username))
+
+
+def enqueue_scrape(username, force=False):
+    # Returns (task_id, status) where status is queued, in_progress or fresh.
+    if not force and storage.get_recently_scraped([username], FRESHNESS_TTL):
+        return None, 'fresh'
+    claimed, existing = claim_usernames([username])
+    if username not in claimed:
+        return existing.get(username), 'in_progress'
+    try:
+        app.send_task(SCRAPE_TASK, args=(username,), task_id=claimed[username], queue=INTERACTIVE_QUEUE,
+                      expires=INFLIGHT_QUEUE_TTL)
+    except Exception:
+        release_usernames([username])
+        raise
+    return claimed[username], 'queued'
+
+
+def dispatch_batch(usernames, force=False, queue=BACKFILL_QUEUE):
+    # Progress lives in one Redis hash per batch that the tasks increment, so
+    # reading it never has to look up individual AsyncResults. Usernames that
+    # are fresh or already in flight are counted as skipped.
+    fresh = set() if force else storage.get_recently_scraped(usernames, FRESHNESS_TTL)
+    claimed, existing = claim_usernames([u for u in usernames if u not in fresh])
+    batch_id = str(uuid.uuid4())
+    client = get_redis()
+    client.hset(batch_key(batch_id), mapping={
+        'total': len(usernames), 'started': 0, 'success': 0, 'failed': 0,
+        'skipped': len(usernames) - len(claimed),
+    })
+    client.expire(batch_key(batch_id), BATCH_TTL)
+    try:
+        group(app.signature(SCRAPE_TASK, args=(username, batch_id))
+              .set(task_id=task_id, queue=queue, expires=INFLIGHT_QUEUE_TTL)
+              for username, task_id in claimed.items()).apply_async()
+    except Exception:
+        if claimed:
+            release_usernames(claimed)
+        raise
+    return batch_id, {'queued': len(claimed), 'in_progress': len(existing), 'fresh': len(fresh)}
+
+
+def get_batch_progress(batch_id):
+    counts = get_redis().hgetall(batch_key(batch_id))
+    if not counts:
+        return None
+    counts = {key.decode(): int(value) for key, value in counts.items()}
+    finished = counts['success'] + counts['failed']
+    counts['running'] = counts['started'] - finished
+    counts['pending'] = counts['total'] - counts['skipped'] - counts['started']
+    counts['done'] = finished + counts['skipped'] >= counts['total']
+    return counts
+
+
+def record_batch(batch_id, field):
+    try:
+        get_redis().hincrby(batch_key(batch_id), field, 1)
+    except Exception as e:
+        logger.error(f"Failed to update batch {batch_id}: {e}")
@@ -0,0 +1,882 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+import db_utils
+from cache import user_cache
+from metrics import observe_db
+from redis_utils import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Persistence used by the API, the scraper and its tasks. Writes are
+# expressed as named operations so a backend can apply a whole batch of them
+# in one transaction, and so they can be queued and applied later by one
+# writer. Reads always go to the backend itself.
+#
+#   sqlite    db_utils against DB_PATH (single host)
+#   postgres  a shared PostgreSQL database at DATABASE_URL (multi-host)
+#
+# With STORAGE_WRITE_BEHIND set, workers only push operations onto a Redis
+# list and `python storage.py drain` applies them in large batches, so
+# scrapes never wait on the database lock.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+STORAGE_WRITE_BEHIND = os.getenv("STORAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+DATABASE_URL = os.getenv("DATABASE_URL")
+WRITE_QUEUE_KEY = "storage:writes"
+WRITE_DEAD_KEY = "storage:writes:failed"
+WRITER_LOCK_KEY = "storage:writer"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 500))
+WRITER_LOCK_TTL = 30
+# How long a worker keeps retrying a push to the write queue before giving up.
+WRITE_PUSH_TIMEOUT = float(os.getenv("WRITE_PUSH_TIMEOUT", 60))
+
+# Takes the writer lock when it's free, renews it when we already hold it.
+WRITER_LOCK_LUA = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+# Renews the lock only while we still hold it.
+WRITER_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Trims an applied batch off the queue, unless the lock has moved on to
+# another writer in the meantime.
+WRITER_TRIM_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('LTRIM', KEYS[2], ARGV[2], -1)
+return 1
+"""
+WRITER_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Storage:
+    def init(self):
+        pass
+
+    def write(self, ops):
+        # Applies [(op name, kwargs), ...] atomically.
+        raise NotImplementedError
+
+    def save_page(self, username, user_data=None, posts=(), metrics=(), checkpoint=None):
+        self.write([('save_page', {'username': username, 'user_data': user_data, 'posts': list(posts),
+                                   'metrics': list(metrics), 'checkpoint': checkpoint})])
+
+    def update_scraping_status(self, username, status, posts_count=None, error_message=None):
+        self.write([('update_scraping_status', {'username': username, 'status': status,
+                                                'posts_count': posts_count, 'error_message': error_message})])
+
+    def record_stage_timings(self, username, timings):
+        self.write([('record_stage_timings', {'username': username, 'timings': timings})])
+
+    def record_media(self, url_key, s3_key, size=None, etag=None, content_hash=None):
+        self.write([('record_media', {'url_key': url_key, 's3_key': s3_key, 'size': size,
+                                      'etag': etag, 'content_hash': content_hash})])
+
+    def update_refresh_schedule(self, username, next_scrape_at, change_rate=None, last_followers=None,
+                                refresh_failures=None):
+        self.write([('update_refresh_schedule', {'username': username, 'next_scrape_at': next_scrape_at,
+                                                 'change_rate': change_rate, 'last_followers': last_followers,
+                                                 'refresh_failures': refresh_failures})])
+
+    def record_archive(self, username, kind, cursor, segment, offset, length, codec, raw_size):
+        self.write([('record_archive', {'username': username, 'kind': kind, 'cursor': cursor,
+                                        'segment': segment, 'offset': offset, 'length': length,
+                                        'codec': codec, 'raw_size': raw_size})])
+
+
+class SQLiteStorage(Storage):
+    def init(self):
+        db_utils.init_database()
+
+    def write(self, ops):
+        with db_utils.transaction('storage_write'):
+            for name, kwargs in ops:
+                getattr(self, f'_{name}')(**kwargs)
+
+    def _save_page(self, username, user_data=None, posts=(), metrics=(), checkpoint=None):
+        if user_data:
+            db_utils.insert_user(user_data)
+        if posts:
+            db_utils.insert_posts(posts)
+        if metrics:
+            db_utils.update_post_metrics(metrics)
+        if checkpoint:
+            db_utils.update_timeline_checkpoint(username, **checkpoint)
+
+    def _update_scraping_status(self, **kwargs):
+        db_utils.update_scraping_status(**kwargs)
+
+    def _record_stage_timings(self, username, timings):
+        db_utils.record_stage_timings(username, timings)
+
+    def _record_media(self, **kwargs):
+        db_utils.record_media(**kwargs)
+
+    def _update_refresh_schedule(self, **kwargs):
+        db_utils.update_refresh_schedule(**kwargs)
+
+    def _record_archive(self, **kwargs):
+        db_utils.record_archive(**kwargs)
+
+    def get_existing_post_ids(self, post_ids):
+        return db_utils.get_existing_post_ids(post_ids)
+
+    def get_media(self, url_key):
+        return db_utils.get_media(url_key)
+
+    def get_media_by_hash(self, content_hash):
+        return db_utils.get_media_by_hash(content_hash)
+
+    def get_scraping_status(self, username):
+        return db_utils.get_scraping_status(username)
+
+    def get_due_refreshes(self, now, limit=100):
+        return db_utils.get_due_refreshes(now, limit)
+
+    def get_recently_scraped(self, usernames, max_age):
+        return db_utils.get_recently_scraped(usernames, max_age)
+
+    def get_user_with_posts(self, username):
+        return db_utils.get_user_with_posts(username)
+
+    def get_users_with_posts(self, usernames, posts_per_user=20):
+        return db_utils.get_users_with_posts(usernames, posts_per_user)
+
+    def get_user_posts(self, username, cursor=None, limit=20):
+        return db_utils.get_user_posts(username, cursor, limit)
+
+    def get_user_growth(self, username, resolution='day', since=None, until=None, limit=90):
+        return db_utils.get_user_growth(username, resolution, since, until, limit)
+
+    def search(self, text, search_type='posts', column=None, username=None, limit=20, offset=0):
+        return db_utils.search(text, search_type, column, username, limit, offset)
+
+    def iter_export(self, table_name, fmt='csv', since=None, chunk_size=db_utils.EXPORT_CHUNK_SIZE):
+        return db_utils.iter_export(table_name, fmt, since, chunk_size)
+
+    def get_export_watermark(self, table_name):
+        return db_utils.get_export_watermark(table_name)
+
+    def get_archive_records(self, username=None):
+        return db_utils.get_archive_records(username)
+
+    def get_archived_usernames(self):
+        return db_utils.get_archived_usernames()
+
+    def get_archive_stats(self):
+        return db_utils.get_archive_stats()
+
+
+POSTGRES_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        full_name TEXT,
+        biography TEXT,
+        external_url TEXT,
+        followed_by BIGINT DEFAULT 0,
+        follow BIGINT DEFAULT 0,
+        is_verified BOOLEAN DEFAULT FALSE,
+        is_private BOOLEAN DEFAULT FALSE,
+        business_email TEXT,
+        business_phone_number TEXT,
+        category_name TEXT,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )''',
+    '''CREATE TABLE IF NOT EXISTS posts (
+        post_id TEXT PRIMARY KEY,
+        user_id TEXT,
+        username TEXT,
+        taken_at_timestamp BIGINT,
+        is_video BOOLEAN DEFAULT FALSE,
+        video_view_count BIGINT DEFAULT 0,
+        liked_by BIGINT DEFAULT 0,
+        caption TEXT,
+        accessibility_caption TEXT,
+        img_file TEXT,
+        video_file TEXT,
+        scraped_at TIMESTAMPTZ DEFAULT now()
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_posts_username_taken ON posts (username, taken_at_timestamp, post_id)",
+    '''CREATE TABLE IF NOT EXISTS scraping_status (
+        username TEXT PRIMARY KEY,
+        status TEXT DEFAULT 'pending',
+        last_scraped TIMESTAMPTZ,
+        posts_count INTEGER DEFAULT 0,
+        error_message TEXT,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now(),
+        end_cursor TEXT,
+        backfill_complete BOOLEAN DEFAULT FALSE,
+        newest_post_id TEXT,
+        newest_taken_at BIGINT,
+        stage_timings TEXT
+    )''',
+    "ALTER TABLE scraping_status ADD COLUMN IF NOT EXISTS change_rate DOUBLE PRECISION",
+    "ALTER TABLE scraping_status ADD COLUMN IF NOT EXISTS next_scrape_at BIGINT",
+    "ALTER TABLE scraping_status ADD COLUMN IF NOT EXISTS last_followers BIGINT",
+    "ALTER TABLE scraping_status ADD COLUMN IF NOT EXISTS retry_taken_at BIGINT",
+    "ALTER TABLE scraping_status ADD COLUMN IF NOT EXISTS refresh_failures INTEGER DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_scraping_status_next ON scraping_status (next_scrape_at)",
+    '''CREATE TABLE IF NOT EXISTS media_manifest (
+        url_key TEXT PRIMARY KEY,
+        s3_key TEXT NOT NULL,
+        size BIGINT,
+        etag TEXT,
+        content_hash TEXT,
+        created_at TIMESTAMPTZ DEFAULT now()
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_media_manifest_hash ON media_manifest (content_hash)",
+    '''CREATE TABLE IF NOT EXISTS raw_archive (
+        id BIGSERIAL PRIMARY KEY,
+        username TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        cursor TEXT,
+        segment TEXT NOT NULL,
+        "offset" BIGINT NOT NULL,
+        length BIGINT NOT NULL,
+        codec TEXT NOT NULL,
+        raw_size BIGINT,
+        fetched_at TIMESTAMPTZ DEFAULT now(),
+        UNIQUE (segment, "offset")
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_raw_archive_username ON raw_archive (username, id)",
+)
+
+
+def _pg_trigger(name, table, definition):
+    # CREATE TRIGGER has no IF NOT EXISTS, and dropping first would lock
+    # the table on every worker start.
+    return f"""DO $trigger$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = '{name}' AND tgrelid = '{table}'::regclass) THEN
+            CREATE TRIGGER {name} {definition};
+        END IF;
+    END $trigger$"""
+
+
+def _pg_history_schema():
+    # db_utils' engagement-history tables and triggers, in plpgsql.
+    steps = ', '.join(str(seconds) for seconds in db_utils.GROWTH_RESOLUTIONS.values())
+    numeric = "~ '^[0-9]+$'"
+    return (
+        '''CREATE TABLE IF NOT EXISTS user_metrics (
+            user_id BIGINT NOT NULL,
+            ts BIGINT NOT NULL,
+            followed_by BIGINT,
+            follow BIGINT,
+            PRIMARY KEY (user_id, ts)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS post_metrics (
+            post_id BIGINT NOT NULL,
+            ts BIGINT NOT NULL,
+            liked_by BIGINT,
+            video_view_count BIGINT,
+            PRIMARY KEY (post_id, ts)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS user_growth (
+            user_id BIGINT NOT NULL,
+            resolution BIGINT NOT NULL,
+            bucket BIGINT NOT NULL,
+            followers_first BIGINT,
+            followers_last BIGINT,
+            followers_min BIGINT,
+            followers_max BIGINT,
+            follow_last BIGINT,
+            likes_gained BIGINT NOT NULL DEFAULT 0,
+            views_gained BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, resolution, bucket)
+        )''',
+        f'''CREATE OR REPLACE FUNCTION record_user_metrics() RETURNS trigger AS $$
+        DECLARE
+            now_ts BIGINT := extract(epoch FROM now())::BIGINT;
+            step BIGINT;
+        BEGIN
+            INSERT INTO user_metrics (user_id, ts, followed_by, follow)
+            VALUES (NEW.id::BIGINT, now_ts, NEW.followed_by, NEW.follow)
+            ON CONFLICT (user_id, ts) DO UPDATE SET
+                followed_by = excluded.followed_by, follow = excluded.follow;
+            FOREACH step IN ARRAY ARRAY[{steps}] LOOP
+                INSERT INTO user_growth (user_id, resolution, bucket, followers_first, followers_last,
+                    followers_min, followers_max, follow_last)
+                VALUES (NEW.id::BIGINT, step, now_ts / step * step,
+                    NEW.followed_by, NEW.followed_by, NEW.followed_by, NEW.followed_by, NEW.follow)
+                ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET
+                    followers_first = COALESCE(user_growth.followers_first, excluded.followers_first),
+                    followers_last = excluded.followers_last,
+                    followers_min = LEAST(user_growth.followers_min, excluded.followers_min),
+                    followers_max = GREATEST(user_growth.followers_max, excluded.followers_max),
+                    follow_last = excluded.follow_last;
+            END LOOP;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql''',
+        f'''CREATE OR REPLACE FUNCTION record_post_metrics() RETURNS trigger AS $$
+        DECLARE
+            now_ts BIGINT := extract(epoch FROM now())::BIGINT;
+            step BIGINT;
+        BEGIN
+            INSERT INTO post_metrics (post_id, ts, liked_by, video_view_count)
+            VALUES (NEW.post_id::BIGINT, now_ts, NEW.liked_by, NEW.video_view_count)
+            ON CONFLICT (post_id, ts) DO UPDATE SET
+                liked_by = excluded.liked_by, video_view_count = excluded.video_view_count;
+            IF TG_OP = 'UPDATE' AND NEW.user_id {numeric} THEN
+                FOREACH step IN ARRAY ARRAY[{steps}] LOOP
+                    INSERT INTO user_growth (user_id, resolution, bucket, likes_gained, views_gained)
+                    VALUES (NEW.user_id::BIGINT, step, now_ts / step * step,
+                        COALESCE(NEW.liked_by, 0) - COALESCE(OLD.liked_by, 0),
+                        COALESCE(NEW.video_view_count, 0) - COALESCE(OLD.video_view_count, 0))
+                    ON CONFLICT (user_id, resolution, bucket) DO UPDATE SET
+                        likes_gained = user_growth.likes_gained + excluded.likes_gained,
+                        views_gained = user_growth.views_gained + excluded.views_gained;
+                END LOOP;
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql''',
+        _pg_trigger('users_metrics_insert', 'users', f"""AFTER INSERT ON users FOR EACH ROW
+            WHEN (NEW.id {numeric}) EXECUTE FUNCTION record_user_metrics()"""),
+        _pg_trigger('users_metrics_update', 'users', f"""AFTER UPDATE OF followed_by, follow ON users FOR EACH ROW
+            WHEN ((OLD.followed_by IS DISTINCT FROM NEW.followed_by OR OLD.follow IS DISTINCT FROM NEW.follow)
+                AND NEW.id {numeric}) EXECUTE FUNCTION record_user_metrics()"""),
+        _pg_trigger('posts_metrics_insert', 'posts', f"""AFTER INSERT ON posts FOR EACH ROW
+            WHEN (NEW.post_id {numeric}) EXECUTE FUNCTION record_post_metrics()"""),
+        _pg_trigger('posts_metrics_update', 'posts', f"""AFTER UPDATE OF liked_by, video_view_count ON posts FOR EACH ROW
+            WHEN ((OLD.liked_by IS DISTINCT FROM NEW.liked_by OR OLD.video_view_count IS DISTINCT FROM NEW.video_view_count)
+                AND NEW.post_id {numeric}) EXECUTE FUNCTION record_post_metrics()"""),
+    )
+
+
+# Full-text search over the same fields as db_utils.SEARCH_TYPES. Each field
+# gets its own weight label (A, B, ...) so a search can be narrowed to one
+# of them, and the GIN indexes are on exactly these expressions.
+PG_SEARCH_LABELS = 'ABCD'
+PG_HEADLINE_OPTIONS = (f"StartSel=<b>, StopSel=</b>, MaxWords={db_utils.SNIPPET_TOKENS}, "
+                       f"MinWords={db_utils.SNIPPET_TOKENS // 2}")
+
+
+def _pg_search_vector(columns):
+    return ' || '.join(f"setweight(to_tsvector('simple', COALESCE({column}, '')), '{label}')"
+                       for column, label in zip(columns, PG_SEARCH_LABELS))
+
+
+def _pg_rank_weights(weights):
+    # ts_rank takes the label weights as {D, C, B, A}, each at most 1.
+    weights = [weight / max(weights) for weight in weights]
+    weights += [0.0] * (len(PG_SEARCH_LABELS) - len(weights))
+    return weights[::-1]
+
+
+def pg_tsquery(text, label=None):
+    # db_utils.fts_query for to_tsquery: every word must match, each quoted
+    # as a lexeme so input can't inject operators, a trailing '*' keeps a
+    # prefix search and `label` limits matches to one field.
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.strip('#@*').replace('\\', '\\\\').replace("'", "''")
+        if word:
+            suffix = ('*' if prefix else '') + (label or '')
+            terms.append(f"'{word}'" + (f':{suffix}' if suffix else ''))
+    return ' & '.join(terms) or None
+
+
+POSTGRES_SCHEMA += _pg_history_schema() + tuple(
+    f"CREATE INDEX IF NOT EXISTS idx_{table}_search ON {table} USING GIN (({_pg_search_vector(columns)}))"
+    for table, (_, columns, _) in db_utils.SEARCH_TYPES.items())
+
+# Export key per table (rowid has no Postgres equivalent) and the SQLite
+# type each Postgres column type is exported as.
+PG_EXPORT_KEYS = {'users': 'id', 'posts': 'post_id', 'scraping_status': 'username'}
+PG_EXPORT_TYPES = {'bigint': 'INTEGER', 'integer': 'INTEGER', 'boolean': 'BOOLEAN', 'double precision': 'REAL'}
+
+
+def _postgres_sql(sql):
+    return sql.replace('?', '%s').replace('CURRENT_TIMESTAMP', 'now()')
+
+
+PG_USER_RECLAIM_SQL = _postgres_sql(db_utils.USER_RECLAIM_SQL)
+PG_USER_UPSERT_SQL = _postgres_sql(db_utils.USER_UPSERT_SQL)
+PG_POST_UPSERT_SQL = _postgres_sql(db_utils.POST_UPSERT_SQL)
+PG_POST_METRICS_SQL = '''
+    UPDATE posts SET liked_by = %(liked_by)s, video_view_count = %(video_view_count)s, scraped_at = now()
+    WHERE post_id = %(post_id)s
+    AND (liked_by IS DISTINCT FROM %(liked_by)s OR video_view_count IS DISTINCT FROM %(video_view_count)s)
+'''
+PG_STATUS_SQL = '''
+    INSERT INTO scraping_status (username, status, last_scraped, posts_count, error_message, updated_at)
+    VALUES (%(username)s, %(status)s, CASE WHEN %(status)s = 'completed' THEN now() END,
+        %(posts_count)s, %(error_message)s, now())
+    ON CONFLICT (username) DO UPDATE SET
+        status = excluded.status,
+        last_scraped = COALESCE(excluded.last_scraped, scraping_status.last_scraped),
+        posts_count = COALESCE(excluded.posts_count, scraping_status.posts_count),
+        error_message = excluded.error_message,
+        updated_at = now()
+'''
+PG_STAGE_TIMINGS_SQL = '''
+    INSERT INTO scraping_status (username, stage_timings, updated_at) VALUES (%s, %s, now())
+    ON CONFLICT (username) DO UPDATE SET stage_timings = excluded.stage_timings
+'''
+PG_REFRESH_SQL = '''
+    INSERT INTO scraping_status (username, next_scrape_at, change_rate, last_followers, refresh_failures, updated_at)
+    VALUES (%(username)s, %(next_scrape_at)s, %(change_rate)s, %(last_followers)s,
+        COALESCE(%(refresh_failures)s, 0), now())
+    ON CONFLICT (username) DO UPDATE SET
+        next_scrape_at = excluded.next_scrape_at,
+        change_rate = COALESCE(excluded.change_rate, scraping_status.change_rate),
+        last_followers = COALESCE(excluded.last_followers, scraping_status.last_followers),
+        refresh_failures = COALESCE(%(refresh_failures)s, scraping_status.refresh_failures)
+'''
+PG_MEDIA_SQL = '''
+    INSERT INTO media_manifest (url_key, s3_key, size, etag, content_hash) VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (url_key) DO UPDATE SET
+        s3_key = excluded.s3_key, size = excluded.size,
+        etag = excluded.etag, content_hash = excluded.content_hash
+'''
+PG_ARCHIVE_SQL = '''
+    INSERT INTO raw_archive (username, kind, cursor, segment, "offset", length, codec, raw_size)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (segment, "offset") DO NOTHING
+'''
+
+
+class PostgresStorage(Storage):
+    # Same tables, upsert semantics and history triggers as the SQLite
+    # schema, with the same reads on top; connections are per thread and
+    # process, like db_utils.get_connection().
+    def __init__(self, url=None):
+        self.url = url or DATABASE_URL
+        self.local = threading.local()
+
+    def connection(self):
+        try:
+            import psycopg
+            from psycopg.rows import dict_row
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=postgres needs psycopg (pip install 'psycopg[binary]')")
+        if not self.url:
+            raise RuntimeError("STORAGE_BACKEND=postgres needs DATABASE_URL")
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.closed or conn.broken or self.local.pid != os.getpid():
+            conn = psycopg.connect(self.url, autocommit=True, row_factory=dict_row)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def init(self):
+        conn = self.connection()
+        with conn.transaction():
+            # Every worker runs this on start; one at a time.
+            conn.execute("SELECT pg_advisory_xact_lock(hashtext('storage_init'))")
+            for statement in POSTGRES_SCHEMA:
+                conn.execute(statement)
+
+    def write(self, ops):
+        conn = self.connection()
+        started = time.monotonic()
+        try:
+            with conn.transaction(), conn.cursor() as cursor:
+                for name, kwargs in ops:
+                    getattr(self, f'_{name}')(cursor, **kwargs)
+        finally:
+            observe_db('postgres_write', time.monotonic() - started)
+        # What db_utils does after a SQLite commit.
+        for username in {kwargs['username'] for name, kwargs in ops if name == 'save_page'}:
+            user_cache.invalidate(username)
+
+    def _save_page(self, cursor, username, user_data=None, posts=(), metrics=(), checkpoint=None):
+        if user_data:
+            cursor.execute(PG_USER_RECLAIM_SQL, (user_data.get('username'), user_data.get('id')))
+            cursor.execute(PG_USER_UPSERT_SQL, db_utils._user_row(user_data))
+        if posts:
+            cursor.executemany(PG_POST_UPSERT_SQL, [db_utils._post_row(post) for post in posts])
+        if metrics:
+            cursor.executemany(PG_POST_METRICS_SQL, [{
+                'post_id': post.get('post_id'), 'liked_by': post.get('liked_by', 0),
+                'video_view_count': post.get('video_view_count', 0)} for post in metrics])
+        columns = [name for name in db_utils.TIMELINE_CHECKPOINT_FIELDS if name in (checkpoint or {})]
+        if columns:
+            assignments = ', '.join(f"{name} = excluded.{name}" for name in columns)
+            cursor.execute(f'''
+                INSERT INTO scraping_status (username, {', '.join(columns)}, updated_at)
+                VALUES (%s, {', '.join(['%s'] * len(columns))}, now())
+                ON CONFLICT (username) DO UPDATE SET {assignments}, updated_at = now()
+            ''', (username, *[checkpoint[name] for name in columns]))
+
+    def _update_scraping_status(self, cursor, **kwargs):
+        cursor.execute(PG_STATUS_SQL, kwargs)
+
+    def _record_stage_timings(self, cursor, username, timings):
+        cursor.execute(PG_STAGE_TIMINGS_SQL, (username, json.dumps(timings)))
+
+    def _record_media(self, cursor, url_key, s3_key, size=None, etag=None, content_hash=None):
+        cursor.execute(PG_MEDIA_SQL, (url_key, s3_key, size, etag, content_hash))
+
+    def _update_refresh_schedule(self, cursor, username, next_scrape_at, change_rate=None, last_followers=None,
+                                 refresh_failures=None):
+        cursor.execute(PG_REFRESH_SQL, {'username': username, 'next_scrape_at': next_scrape_at,
+                                        'change_rate': change_rate, 'last_followers': last_followers,
+                                        'refresh_failures': refresh_failures})
+
+    def _record_archive(self, db, username, kind, cursor, segment, offset, length, codec, raw_size):
+        # `cursor` here is the timeline page cursor the payload was fetched at.
+        db.execute(PG_ARCHIVE_SQL, (username, kind, cursor, segment, offset, length, codec, raw_size))
+
+    def get_existing_post_ids(self, post_ids):
+        post_ids = [post_id for post_id in post_ids if post_id]
+        if not post_ids:
+            return set()
+        rows = self.connection().execute(
+            "SELECT post_id FROM posts WHERE post_id = ANY(%s)", (post_ids,)).fetchall()
+        return {row['post_id'] for row in rows}
+
+    def get_media(self, url_key):
+        return self.connection().execute(
+            "SELECT * FROM media_manifest WHERE url_key = %s", (url_key,)).fetchone()
+
+    def get_media_by_hash(self, content_hash):
+        return self.connection().execute(
+            "SELECT * FROM media_manifest WHERE content_hash = %s LIMIT 1", (content_hash,)).fetchone()
+
+    def get_scraping_status(self, username):
+        return self.connection().execute(
+            "SELECT * FROM scraping_status WHERE username = %s", (username,)).fetchone()
+
+    def get_due_refreshes(self, now, limit=100):
+        rows = self.connection().execute(
+            "SELECT username FROM scraping_status WHERE next_scrape_at <= %s ORDER BY next_scrape_at LIMIT %s",
+            (now, limit)).fetchall()
+        return [row['username'] for row in rows]
+
+    def get_recently_scraped(self, usernames, max_age):
+        rows = self.connection().execute(
+            """SELECT username FROM scraping_status WHERE username = ANY(%s)
+            AND last_scraped >= now() - make_interval(secs => %s)""", (list(usernames), max_age)).fetchall()
+        return {row['username'] for row in rows}
+
+    def get_user_with_posts(self, username):
+        conn = self.connection()
+        user = conn.execute("SELECT * FROM users WHERE username = %s", (username,)).fetchone()
+        if not user:
+            return None
+        user['posts'] = conn.execute(
+            "SELECT * FROM posts WHERE username = %s ORDER BY scraped_at DESC LIMIT 20", (username,)).fetchall()
+        return user
+
+    def get_users_with_posts(self, usernames, posts_per_user=20):
+        conn = self.connection()
+        usernames = list(dict.fromkeys(usernames))
+        users = {}
+        for user in conn.execute("SELECT * FROM users WHERE username = ANY(%s)", (usernames,)):
+            user['posts'] = []
+            user['next_cursor'] = None
+            users[user['username']] = user
+        if posts_per_user <= 0:
+            return users
+        rows = conn.execute("""SELECT * FROM (
+                SELECT posts.*, ROW_NUMBER() OVER (
+                    PARTITION BY username ORDER BY taken_at_timestamp DESC, post_id DESC
+                ) AS row_number
+                FROM posts WHERE username = ANY(%s)
+            ) ranked WHERE row_number <= %s
+            ORDER BY username, row_number""", (usernames, posts_per_user + 1))
+        for post in rows:
+            user = users.get(post['username'])
+            if user is None:
+                continue
+            if post.pop('row_number') > posts_per_user:
+                user['next_cursor'] = db_utils.encode_cursor(user['posts'][-1])
+            else:
+                user['posts'].append(post)
+        return users
+
+    def get_user_posts(self, username, cursor=None, limit=20):
+        sql = "SELECT * FROM posts WHERE username = %s"
+        params = [username]
+        if cursor:
+            sql += " AND (taken_at_timestamp, post_id) < (%s, %s)"
+            params.extend(db_utils.decode_cursor(cursor))
+        sql += " ORDER BY taken_at_timestamp DESC, post_id DESC LIMIT %s"
+        params.append(limit + 1)
+
+        rows = self.connection().execute(sql, params).fetchall()
+        next_cursor = db_utils.encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return {'posts': rows[:limit], 'next_cursor': next_cursor}
+
+    def get_user_growth(self, username, resolution='day', since=None, until=None, limit=90):
+        seconds = db_utils.GROWTH_RESOLUTIONS[resolution]
+        conn = self.connection()
+        user = conn.execute("SELECT id FROM users WHERE username = %s", (username,)).fetchone()
+        if not user or not str(user['id']).isdigit():
+            return None
+        sql = "SELECT * FROM user_growth WHERE user_id = %s AND resolution = %s"
+        params = [int(user['id']), seconds]
+        if since is not None:
+            sql += " AND bucket >= %s"
+            params.append(since // seconds * seconds)
+        if until is not None:
+            sql += " AND bucket < %s"
+            params.append(until)
+        sql += " ORDER BY bucket DESC LIMIT %s"
+        params.append(limit)
+        rows = conn.execute(sql, params).fetchall()[::-1]
+        return db_utils.growth_buckets(username, resolution, rows)
+
+    def search(self, text, search_type='posts', column=None, username=None, limit=20, offset=0):
+        # Same contract as db_utils.search: rank is lower-is-better.
+        _, columns, weights = db_utils.SEARCH_TYPES[search_type]
+        if column is not None and column not in columns:
+            raise ValueError(f"Unknown {search_type} search field: {column}")
+        query = pg_tsquery(text, PG_SEARCH_LABELS[columns.index(column)] if column else None)
+        if query is None:
+            raise ValueError("Search query is empty")
+
+        shown = f"COALESCE({column}, '')" if column else f"concat_ws(' ', {', '.join(columns)})"
+        vector = _pg_search_vector(columns)
+        sql = f'''
+            SELECT {search_type}.*,
+                ts_headline('simple', {shown}, query, %s) AS snippet,
+                -ts_rank(%s::real[], {vector}, query) AS rank
+            FROM {search_type}, to_tsquery('simple', %s) AS query
+            WHERE {vector} @@ query'''
+        params = [PG_HEADLINE_OPTIONS, _pg_rank_weights(weights), query]
+        if username and search_type == 'posts':
+            sql += " AND posts.username = %s"
+            params.append(username)
+        sql += " ORDER BY rank LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
+        return self.connection().execute(sql, params).fetchall()
+
+    def table_columns(self, table_name):
+        rows = self.connection().execute(
+            """SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position""",
+            (table_name,)).fetchall()
+        return [(row['column_name'], PG_EXPORT_TYPES.get(row['data_type'], 'TEXT')) for row in rows]
+
+    def iter_table_chunks(self, table_name, columns, since=None, chunk_size=db_utils.EXPORT_CHUNK_SIZE):
+        # Keyset-paginates on the primary key, one short query per chunk.
+        from psycopg.rows import tuple_row
+
+        key = PG_EXPORT_KEYS[table_name]
+        names = ', '.join(f'"{name}"' for name, _ in columns)
+        last_key = None
+        while True:
+            conditions, params = [], []
+            if last_key is not None:
+                conditions.append(f"{key} > %s")
+                params.append(last_key)
+            if since:
+                conditions.append(f"{db_utils.EXPORT_TABLES[table_name]} > %s")
+                params.append(since)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            with self.connection().cursor(row_factory=tuple_row) as cursor:
+                rows = cursor.execute(f"SELECT {key}, {names} FROM {table_name} {where} ORDER BY {key} LIMIT %s",
+                                      (*params, chunk_size)).fetchall()
+            if not rows:
+                return
+            last_key = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+    def iter_export(self, table_name, fmt='csv', since=None, chunk_size=db_utils.EXPORT_CHUNK_SIZE):
+        if fmt not in db_utils.EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        if table_name not in db_utils.EXPORT_TABLES:
+            raise ValueError(f"Unknown table: {table_name}")
+        columns = self.table_columns(table_name)
+        return db_utils.encode_export(columns, self.iter_table_chunks(table_name, columns, since, chunk_size), fmt)
+
+    def get_export_watermark(self, table_name):
+        column = db_utils.EXPORT_TABLES[table_name]
+        return self.connection().execute(
+            f"SELECT MAX({column}) AS watermark FROM {table_name}").fetchone()['watermark']
+
+    def get_archive_records(self, username=None):
+        if username:
+            return self.connection().execute(
+                "SELECT * FROM raw_archive WHERE username = %s ORDER BY id", (username,)).fetchall()
+        return self.connection().execute("SELECT * FROM raw_archive ORDER BY id").fetchall()
+
+    def get_archived_usernames(self):
+        return [row['username'] for row in self.connection().execute(
+            "SELECT DISTINCT username FROM raw_archive ORDER BY username")]
+
+    def get_archive_stats(self):
+        return self.connection().execute('''
+            SELECT COUNT(*) AS records, COUNT(DISTINCT username) AS users,
+                COALESCE(SUM(length), 0)::BIGINT AS stored_bytes, COALESCE(SUM(raw_size), 0)::BIGINT AS raw_bytes
+            FROM raw_archive
+        ''').fetchone()
+
+
+class WriteBehindStorage(Storage):
+    # Reads go straight to the backend; writes are pushed onto a Redis list
+    # in order. Readers only see what the drainer has applied to *their*
+    # backend, so across hosts the backend has to be the shared Postgres
+    # database.
+    def __init__(self, backend):
+        self.backend = backend
+
+    def init(self):
+        self.backend.init()
+
+    def write(self, ops):
+        # Never written around the queue: the drainer would later apply older
+        # queued operations on top (a stale 'running' over 'completed', an old
+        # end_cursor over a newer one). A failed push is retried for
+        # WRITE_PUSH_TIMEOUT and then raised, which fails the scrape so its
+        # task retries it, rather than losing or reordering writes.
+        payload = [json.dumps({'op': name, 'args': kwargs}) for name, kwargs in ops]
+        deadline = time.monotonic() + WRITE_PUSH_TIMEOUT
+        attempt = 0
+        while True:
+            try:
+                get_redis().rpush(WRITE_QUEUE_KEY, *payload)
+                return
+            except Exception as e:
+                delay = min(0.5 * 2 ** attempt, 10, deadline - time.monotonic())
+                if delay <= 0:
+                    raise
+                logger.warning(f"Write-behind queue unavailable, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                attempt += 1
+
+    def __getattr__(self, name):
+        # Only reached for names Storage doesn't define, i.e. the reads.
+        return getattr(self.backend, name)
+
+
+def make_storage():
+    backends = {'sqlite': SQLiteStorage, 'postgres': PostgresStorage}
+    if STORAGE_BACKEND not in backends:
+        raise RuntimeError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}; expected one of {sorted(backends)}")
+    backend = backends[STORAGE_BACKEND]()
+    return WriteBehindStorage(backend) if STORAGE_WRITE_BEHIND else backend
+
+
+def apply_batch(backend, raw):
+    # One transaction for the whole batch; if it fails, fall back to one
+    # operation at a time so a single bad record can't block the queue.
+    ops = [json.loads(item) for item in raw]
+    try:
+        backend.write([(op['op'], op['args']) for op in ops])
+        return 0
+    except Exception as e:
+        logger.error(f"Batch of {len(ops)} writes failed, retrying one by one: {e}")
+    failed = 0
+    for item, op in zip(raw, ops):
+        try:
+            backend.write([(op['op'], op['args'])])
+        except Exception as e:
+            logger.error(f"Dropping {op['op']} to {WRITE_DEAD_KEY}: {e}")
+            get_redis().rpush(WRITE_DEAD_KEY, item)
+            failed += 1
+    return failed
+
+
+def _keep_lock(client, owner, done):
+    # Heartbeat for the writer lock while a batch is being applied, which
+    # can take longer than WRITER_LOCK_TTL on a large or slow batch.
+    renew = client.register_script(WRITER_RENEW_LUA)
+    while not done.wait(WRITER_LOCK_TTL / 3):
+        if not renew(keys=[WRITER_LOCK_KEY], args=[owner, WRITER_LOCK_TTL]):
+            logger.error(f"Lost {WRITER_LOCK_KEY} while applying a batch")
+            return
+
+
+def drain(backend, batch_size=WRITE_BATCH_SIZE, idle_wait=0.5, once=False):
+    # The single writer. Operations are read with LRANGE and trimmed only
+    # after they commit, so a crash replays the last batch instead of losing
+    # it (every operation is an idempotent upsert). The Redis lock, renewed
+    # while a batch is applied, keeps a second drainer out, and a batch is
+    # only trimmed if we still hold it, so entries nobody applied are never
+    # dropped.
+    client = get_redis()
+    take_lock = client.register_script(WRITER_LOCK_LUA)
+    trim_owned = client.register_script(WRITER_TRIM_LUA)
+    release_lock = client.register_script(WRITER_RELEASE_LUA)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    applied = 0
+    while True:
+        if not take_lock(keys=[WRITER_LOCK_KEY], args=[owner, WRITER_LOCK_TTL]):
+            if once:
+                raise RuntimeError(f"Another writer holds {WRITER_LOCK_KEY}")
+            time.sleep(WRITER_LOCK_TTL / 3)
+            continue
+
+        raw = client.lrange(WRITE_QUEUE_KEY, 0, batch_size - 1)
+        if not raw:
+            if once:
+                release_lock(keys=[WRITER_LOCK_KEY], args=[owner])
+                return applied
+            time.sleep(idle_wait)
+            continue
+        started = time.monotonic()
+        done = threading.Event()
+        heartbeat = threading.Thread(target=_keep_lock, args=(client, owner, done), daemon=True)
+        heartbeat.start()
+        try:
+            failed = apply_batch(backend, raw)
+        finally:
+            done.set()
+            heartbeat.join()
+        if not trim_owned(keys=[WRITER_LOCK_KEY, WRITE_QUEUE_KEY], args=[owner, len(raw)]):
+            # The new writer starts from the head of the queue and re-applies
+            # this batch; the upserts make that harmless.
+            logger.error(f"Lost {WRITER_LOCK_KEY}; leaving {len(raw)} applied writes queued")
+            continue
+        applied += len(raw)
+        logger.info(f"Applied {len(raw) - failed}/{len(raw)} writes in {time.monotonic() - started:.3f}s")
+
+
+def queue_stats():
+    client = get_redis()
+    holder = client.get(WRITER_LOCK_KEY)
+    return {
+        'queued': client.llen(WRITE_QUEUE_KEY),
+        'failed': client.llen(WRITE_DEAD_KEY),
+        'writer': holder.decode() if holder else None,
+    }
+
+
+storage = make_storage()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Storage backend and write-behind queue")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('init', help="Create the schema on the configured backend")
+    drain_parser = commands.add_parser('drain', help="Apply queued writes (run exactly one)")
+    drain_parser.add_argument('--batch-size', type=int, default=WRITE_BATCH_SIZE)
+    drain_parser.add_argument('--once', action='store_true', help="Exit when the queue is empty")
+    commands.add_parser('stats', help="Show queue depth and the active writer")
+    args = parser.parse_args()
+
+    backend = storage.backend if isinstance(storage, WriteBehindStorage) else storage
+    if args.command == 'init':
+        backend.init()
+        print(f"Initialised {STORAGE_BACKEND} storage")
+    elif args.command == 'drain':
+        backend.init()
+        print(f"Applied {drain(backend, args.batch_size, once=args.once)} writes")
+    elif args.command == 'stats':
+        print(json.dumps(queue_stats()))
@@ -1,26 +1,106 @@
-from celery import Celery
-import os
-from insta_scraper import ScrapeUser
+import time
+import asyncio
+from celery_app import app
+from insta_scraper import ScrapeUser, ProfileUnavailable, RecordFailure
+from async_scraper import ScrapeMany, ASYNC_CONCURRENCY
+from scrape_queue import FRESHNESS_TTL, claim_usernames, record_batch, renew_inflight, release_inflight
+from scheduler import enqueue_due, plan_lease
+from storage import storage
+from metrics import track_stages, observe_task
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-app = Celery('macmap_scraper')
-
-app.conf.update(
-    broker_url=os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0'),
-    result_backend=os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0'),
-    task_serializer='json',
-    accept_content=['json'],
-    result_serializer='json',
-    worker_prefetch_multiplier=1,
-    result_expires=1800,  
-    task_acks_late=True,
-    worker_max_tasks_per_child=100,
-)
-
-@app.task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
-def scrape_insta(self, username):
+
+# Retries would otherwise inherit the queue-wait expiry of the original
+# message; by then the task holds a renewed claim of its own.
+@app.task(bind=True, autoretry_for=(Exception,),
+          retry_kwargs={'max_retries': 3, 'countdown': 60, 'expires': None})
+def scrape_insta(self, username, batch_id=None):
+    try:
+        renew_inflight(username, self.request.id)
+    except Exception as e:
+        logger.error(f"Failed to renew in-flight marker for {username}: {e}")
+    if self.request.retries == 0:
+        if batch_id:
+            record_batch(batch_id, 'started')
+        ops = [('update_scraping_status', {'username': username, 'status': 'running',
+                                           'posts_count': None, 'error_message': None})]
+        lease = plan_lease(storage.get_scraping_status(username) or {})
+        if lease:
+            ops.append(('update_refresh_schedule', {'username': username, **lease}))
+        storage.write(ops)
+    result = timed_scrape(self, username)
+    if result['status'] == 'failed':
+        RecordFailure(username, result['error'], result.get('permanent', False))
+    if batch_id:
+        record_batch(batch_id, result['status'])
+    try:
+        release_inflight(username, self.request.id)
+    except Exception as e:
+        logger.error(f"Failed to release in-flight marker for {username}: {e}")
+    return result
+
+
+@app.task(bind=True)
+def scrape_insta_batch(self, usernames, concurrency=None, force=False):
+    # Scrapes a whole list inside one event loop; far more profiles in flight
+    # per worker process than one scrape_insta at a time. Like dispatch_batch,
+    # it skips fresh accounts and ones queued or running elsewhere, and holds
+    # the in-flight claim of each username until that profile finishes.
+    usernames = list(dict.fromkeys(usernames))
+    fresh = set() if force else storage.get_recently_scraped(usernames, FRESHNESS_TTL)
+    claimed, existing = claim_usernames([u for u in usernames if u not in fresh])
+    logger.info(f"Starting async batch of {len(claimed)} usernames "
+                f"({len(fresh)} fresh, {len(existing)} already in flight)")
+
+    def release(username):
+        try:
+            release_inflight(username, claimed[username])
+        except Exception as e:
+            logger.error(f"Failed to release in-flight marker for {username}: {e}")
+
+    try:
+        results = asyncio.run(ScrapeMany(list(claimed), concurrency or ASYNC_CONCURRENCY, on_done=release))
+    except BaseException:
+        for username in claimed:
+            release(username)
+        raise
+    failed = [result for result in results if result['status'] != 'success']
+    return {
+        "status": "success" if not failed else "partial",
+        "total": len(usernames),
+        "succeeded": len(results) - len(failed),
+        "failed": failed,
+        "fresh": len(fresh),
+        "in_progress": len(existing),
+    }
+
+
+@app.task
+def refresh_due_accounts():
+    # Run by celery beat every REFRESH_TICK seconds.
+    return enqueue_due()
+
+
+def timed_scrape(self, username):
+    # Wraps run_scrape with the task histogram and the per-stage breakdown
+    # stored on scraping_status; attempts that end in a retry are kept too.
+    outcome = 'retry'
+    with track_stages() as timings:
+        try:
+            result = run_scrape(self, username)
+            outcome = result['status']
+            return result
+        finally:
+            observe_task('scrape_insta', outcome, time.monotonic() - timings.started)
+            try:
+                storage.record_stage_timings(username, timings.as_dict())
+            except Exception as e:
+                logger.error(f"Failed to store stage timings for {username}: {e}")
+
+
+def run_scrape(self, username):
     logger.info(f"Starting scrape task for username: {username}")
     
     try:
@@ -34,7 +114,17 @@ def scrape_insta(self, username):
             }
         else:
             raise Exception(f"Scraper failed for {username}")
-            
+
+    except ProfileUnavailable as exc:
+        logger.error(f"Not retrying {username}: {exc}")
+        return {
+            "status": "failed",
+            "username": username,
+            "error": str(exc),
+            "retries": self.request.retries,
+            "permanent": True,
+            "message": f"Profile unavailable: {username}"
+        }
     except Exception as exc:
         if self.request.retries >= self.max_retries:
             logger.error(f"Max retries exceeded for {username}")
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read at import time by db_utils, archive and cache; never let a test run against
+# the real database, archive or a live Redis.
+_scratch = tempfile.mkdtemp(prefix='instapost-tests-')
+os.environ['DB_PATH'] = os.path.join(_scratch, 'test.db')
+os.environ['ARCHIVE_DIR'] = os.path.join(_scratch, 'archive')
+os.environ['USER_CACHE_REDIS'] = 'false'
@@ -0,0 +1,85 @@
+import time
+import fakeredis
+import pytest
+import rate_limiter
+from rate_limiter import RateLimiter
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def limiter(server, limits):
+    return RateLimiter(limits, fakeredis.FakeRedis(server=server))
+
+
+def test_burst_then_wait(server):
+    limits = limiter(server, {'p': (1, 2)})
+    waits = [limits.take('p') for _ in range(4)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(1.0, abs=0.05)
+    assert waits[3] == pytest.approx(1.0, abs=0.05)
+
+
+def test_refill(server):
+    limits = limiter(server, {'p': (20, 1)})
+    assert limits.take('p') == 0
+    assert limits.take('p') > 0
+    time.sleep(0.1)
+    assert limits.take('p') == 0
+
+
+def test_bucket_is_shared_between_limiters(server):
+    # Two workers pointing at the same Redis draw from one budget.
+    first = limiter(server, {'p': (1, 1)})
+    second = limiter(server, {'p': (1, 1)})
+    assert first.take('p') == 0
+    assert second.take('p') > 0
+
+
+def test_per_key_buckets(server):
+    limits = limiter(server, {'proxy': (1, 1)})
+    assert limits.take('proxy', 'a') == 0
+    assert limits.take('proxy', 'b') == 0
+    assert limits.take('proxy', 'a') > 0
+    assert server_keys(server) == {b'ratelimit:proxy:a', b'ratelimit:proxy:b'}
+
+
+def test_zero_rate_is_unlimited(server):
+    limits = limiter(server, {'p': (0, 1)})
+    assert [limits.take('p') for _ in range(5)] == [0] * 5
+    assert server_keys(server) == set()
+
+
+def test_falls_back_to_local_buckets(server):
+    server.connected = False
+    limits = limiter(server, {'p': (1, 2)})
+    waits = [limits.take('p') for _ in range(3)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(1.0, abs=0.05)
+    assert 'p' in limits.local
+    # Redis isn't retried until REDIS_RETRY_INTERVAL has passed.
+    server.connected = True
+    assert limits.take('p') > 0
+    assert server_keys(server) == set()
+
+
+def test_returns_to_redis_after_retry_interval(server, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'REDIS_RETRY_INTERVAL', 0)
+    server.connected = False
+    limits = limiter(server, {'p': (1, 2)})
+    assert limits.take('p') == 0
+    server.connected = True
+    assert limits.take('p') == 0
+    assert server_keys(server) == {b'ratelimit:p'}
+
+
+def test_acquire_sleeps_until_granted(server):
+    limits = limiter(server, {'p': (20, 1)})
+    assert limits.acquire('p') == 0
+    assert limits.acquire('p') == pytest.approx(0.05, abs=0.03)
+
+
+def server_keys(server):
+    return set(fakeredis.FakeRedis(server=server).keys('*'))
@@ -0,0 +1,83 @@
+import fakeredis
+import pytest
+import db_utils
+import redis_utils
+import scheduler
+import storage
+from scheduler import plan_refresh, plan_backoff, plan_lease, REFRESH_MIN_INTERVAL, REFRESH_MAX_INTERVAL
+from scrape_queue import INFLIGHT_QUEUE_TTL, INFLIGHT_TTL
+
+NOW = 1_700_000_000
+
+
+def test_first_scrape_is_revisited_after_the_minimum():
+    plan = plan_refresh({}, 10, 1000, now=NOW)
+    assert plan['next_scrape_at'] == NOW + REFRESH_MIN_INTERVAL
+    assert plan['change_rate'] is None
+    assert plan['refresh_failures'] == 0
+
+
+def test_dormant_account_backs_off_to_the_maximum():
+    state = {'last_scraped': '2023-11-13 22:13:20', 'posts_count': 10, 'last_followers': 1000, 'change_rate': 0.0}
+    plan = plan_refresh(state, 10, 1000, now=NOW + 86400)
+    assert plan['next_scrape_at'] == NOW + 86400 + REFRESH_MAX_INTERVAL
+
+
+def test_unscheduled_account_is_left_alone():
+    assert plan_backoff({}, permanent=True, now=NOW) is None
+    assert plan_backoff({'next_scrape_at': None}, permanent=False, now=NOW) is None
+
+
+def test_missing_profile_waits_the_maximum():
+    backoff = plan_backoff({'next_scrape_at': NOW}, permanent=True, now=NOW)
+    assert backoff == {'next_scrape_at': NOW + REFRESH_MAX_INTERVAL, 'refresh_failures': 1}
+
+
+@pytest.mark.parametrize('failures', [0, 1, 2, 3])
+def test_transient_failures_back_off_exponentially(failures):
+    backoff = plan_backoff({'next_scrape_at': NOW, 'refresh_failures': failures}, permanent=False, now=NOW)
+    expected = min(REFRESH_MIN_INTERVAL * 2 ** (failures + 1), REFRESH_MAX_INTERVAL)
+    assert backoff == {'next_scrape_at': NOW + expected, 'refresh_failures': failures + 1}
+
+
+def test_backoff_is_capped():
+    backoff = plan_backoff({'next_scrape_at': NOW, 'refresh_failures': 50}, permanent=False, now=NOW)
+    assert backoff['next_scrape_at'] == NOW + REFRESH_MAX_INTERVAL
+
+
+def test_start_lease_covers_the_run():
+    assert plan_lease({}, now=NOW) is None
+    assert plan_lease({'next_scrape_at': NOW}, now=NOW) == {'next_scrape_at': NOW + INFLIGHT_TTL}
+
+
+@pytest.fixture
+def dispatched(tmp_path, monkeypatch):
+    monkeypatch.setattr(redis_utils, '_client', fakeredis.FakeRedis())
+    monkeypatch.setattr(db_utils, 'db_path', str(tmp_path / 'test.db'))
+    store = storage.SQLiteStorage()
+    store.init()
+    monkeypatch.setattr(scheduler, 'storage', store)
+    queued = []
+
+    class Group:
+        def __init__(self, signatures):
+            self.signatures = list(signatures)
+
+        def apply_async(self):
+            queued.extend(self.signatures)
+
+    monkeypatch.setattr(scheduler, 'group', Group)
+    yield store, queued
+    db_utils.close_connection()
+
+
+def test_backlog_is_not_requeued_while_its_tasks_wait(dispatched):
+    store, queued = dispatched
+    store.update_refresh_schedule('alice', NOW - 10)
+    assert scheduler.enqueue_due(now=NOW)['queued'] == 1
+    assert queued[0].options['expires'] == INFLIGHT_QUEUE_TTL
+    assert store.get_scraping_status('alice')['next_scrape_at'] == NOW + INFLIGHT_QUEUE_TTL
+
+    # Still waiting behind the backlog hours later: not due, not queued again.
+    assert scheduler.enqueue_due(now=NOW + 4 * REFRESH_MIN_INTERVAL) == {'due': 0, 'queued': 0, 'in_progress': 0}
+    assert len(queued) == 1
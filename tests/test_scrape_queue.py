@@ -0,0 +1,67 @@
+import fakeredis
+import pytest
+import db_utils
+import redis_utils
+import scrape_queue
+import storage
+import tasks
+from scrape_queue import INFLIGHT_QUEUE_TTL, INFLIGHT_TTL, inflight_key
+
+
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_utils, '_client', client)
+    return client
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    calls = []
+    monkeypatch.setattr(scrape_queue.app, 'send_task', lambda name, **options: calls.append(options))
+    return calls
+
+
+def test_claim_outlasts_queue_wait_and_expires_with_the_message(redis_client, sent):
+    task_id, status = scrape_queue.enqueue_scrape('alice')
+    assert status == 'queued'
+    assert sent[0]['expires'] == INFLIGHT_QUEUE_TTL
+    assert INFLIGHT_QUEUE_TTL - 5 <= redis_client.ttl(inflight_key('alice')) <= INFLIGHT_QUEUE_TTL
+    assert scrape_queue.enqueue_scrape('alice') == (task_id, 'in_progress')
+    assert len(sent) == 1
+
+
+def test_start_renews_only_a_live_claim(redis_client, sent):
+    task_id, _ = scrape_queue.enqueue_scrape('alice')
+    scrape_queue.renew_inflight('alice', task_id)
+    assert INFLIGHT_TTL - 5 <= redis_client.ttl(inflight_key('alice')) <= INFLIGHT_TTL
+
+    scrape_queue.release_inflight('alice', task_id)
+    scrape_queue.renew_inflight('alice', task_id)
+    assert redis_client.get(inflight_key('alice')) is None
+
+
+def test_async_batch_skips_fresh_and_claimed_usernames(redis_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(db_utils, 'db_path', str(tmp_path / 'test.db'))
+    store = storage.SQLiteStorage()
+    store.init()
+    monkeypatch.setattr(tasks, 'storage', store)
+    store.update_scraping_status('fresh', 'completed', posts_count=1)
+    redis_client.set(inflight_key('busy'), 'other-task')
+    held = {}
+
+    async def scrape_many(usernames, concurrency, on_done):
+        results = []
+        for username in usernames:
+            held[username] = redis_client.get(inflight_key(username)) is not None
+            results.append({'status': 'success', 'username': username})
+            on_done(username)
+        return results
+
+    monkeypatch.setattr(tasks, 'ScrapeMany', scrape_many)
+    result = tasks.scrape_insta_batch.apply(args=(['alice', 'fresh', 'busy', 'alice'],)).get()
+    assert held == {'alice': True}
+    assert (result['total'], result['succeeded'], result['fresh'], result['in_progress']) == (3, 1, 1, 1)
+    assert redis_client.get(inflight_key('alice')) is None
+    assert redis_client.get(inflight_key('busy')) == b'other-task'
+    db_utils.close_connection()
@@ -0,0 +1,14 @@
+from benchmarks.bench_startup import measure, scratch_env
+
+# Generous next to what the API measures today (~600 ms, ~60 MB), so only a
+# real regression - like the scraper stack creeping back into the import
+# graph - trips them.
+MAIN_BUDGET_MS = 2000
+MAIN_BUDGET_MB = 150
+
+
+def test_api_starts_without_the_scraper(tmp_path):
+    result = measure('main', 3, scratch_env(str(tmp_path)))
+    assert result['heavy'] == []
+    assert result['ms'] < MAIN_BUDGET_MS
+    assert result['mb'] < MAIN_BUDGET_MB
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import uuid
+import threading
+import fakeredis
+import pytest
+import db_utils
+import redis_utils
+import storage
+
+
+@pytest.fixture(autouse=True)
+def redis_client(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_utils, '_client', client)
+    return client
+
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+    # TEST_DATABASE_URL if set, otherwise a throwaway local server.
+    pytest.importorskip('psycopg')
+    url = os.getenv('TEST_DATABASE_URL')
+    if url:
+        return url
+    pgserver = pytest.importorskip('pgserver')
+    return pgserver.get_server(str(tmp_path_factory.mktemp('pg')), cleanup_mode='stop').get_uri()
+
+
+@pytest.fixture
+def sqlite_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_utils, 'db_path', str(tmp_path / 'test.db'))
+    store = storage.SQLiteStorage()
+    store.init()
+    yield store
+    db_utils.close_connection()
+
+
+@pytest.fixture
+def postgres_store(postgres_url):
+    # Each test gets a schema of its own, dropped afterwards.
+    import psycopg
+    from psycopg.conninfo import make_conninfo
+
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(postgres_url, autocommit=True) as admin:
+        admin.execute(f"CREATE SCHEMA {schema}")
+        store = storage.PostgresStorage(make_conninfo(postgres_url, options=f"-c search_path={schema}"))
+        try:
+            store.init()
+            yield store
+        finally:
+            store.connection().close()
+            admin.execute(f"DROP SCHEMA {schema} CASCADE")
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def store(request):
+    return request.getfixturevalue(f'{request.param}_store')
+
+
+def make_user(followers=100, **fields):
+    return {'id': '42', 'username': 'alice', 'full_name': 'Alice Liddell', 'biography': 'Superhero fan',
+            'followed_by': followers, 'follow': 5, **fields}
+
+
+def make_posts(count=5, **fields):
+    return [{'post_id': str(1000 + i), 'id': '42', 'username': 'alice', 'taken_at_timestamp': 1700000000 + i,
+             'liked_by': i, 'caption': f'post {i} #sunset beach' if i % 2 else f'post {i} city walk',
+             **fields} for i in range(count)]
+
+
+def test_save_page_and_read_back(store):
+    store.save_page('alice', make_user(), make_posts(), checkpoint={'end_cursor': 'abc'})
+    user = store.get_user_with_posts('alice')
+    assert user['followed_by'] == 100
+    assert len(user['posts']) == 5
+    assert store.get_existing_post_ids(['1000', '1004', '9999']) == {'1000', '1004'}
+    assert store.get_scraping_status('alice')['end_cursor'] == 'abc'
+    assert store.get_user_with_posts('bob') is None
+
+
+def test_batch_is_atomic(store):
+    with pytest.raises(Exception):
+        store.write([('save_page', {'username': 'alice', 'user_data': make_user()}), ('no_such_op', {})])
+    assert store.get_user_with_posts('alice') is None
+
+
+def test_post_pagination(store):
+    store.save_page('alice', make_user(), make_posts())
+    first = store.get_user_posts('alice', limit=2)
+    assert [post['post_id'] for post in first['posts']] == ['1004', '1003']
+    second = store.get_user_posts('alice', first['next_cursor'], limit=2)
+    assert [post['post_id'] for post in second['posts']] == ['1002', '1001']
+    last = store.get_user_posts('alice', second['next_cursor'], limit=2)
+    assert [post['post_id'] for post in last['posts']] == ['1000']
+    assert last['next_cursor'] is None
+
+    users = store.get_users_with_posts(['alice', 'nobody'], posts_per_user=3)
+    assert list(users) == ['alice']
+    assert [post['post_id'] for post in users['alice']['posts']] == ['1004', '1003', '1002']
+    assert users['alice']['next_cursor'] == store.get_user_posts('alice', limit=3)['next_cursor']
+
+
+def test_growth_history(store):
+    store.save_page('alice', make_user(100), make_posts())
+    store.save_page('alice', make_user(150), metrics=[dict(make_posts()[0], liked_by=50)])
+    growth = store.get_user_growth('alice', 'hour')
+    bucket = growth['buckets'][-1]
+    assert bucket['followers'] == 150
+    assert bucket['followers_min'] == 100
+    assert bucket['likes_gained'] == 50
+    assert store.get_user_growth('bob') is None
+
+
+def test_search(store):
+    store.save_page('alice', make_user(), make_posts())
+    results = store.search('#sunset')
+    assert sorted(row['post_id'] for row in results) == ['1001', '1003']
+    assert '<b>' in results[0]['snippet']
+    assert sorted(row['post_id'] for row in store.search('cit*', column='caption', username='alice')) == \
+        ['1000', '1002', '1004']
+    assert store.search('sunset', username='bob') == []
+    assert [row['username'] for row in store.search('super*', 'users')] == ['alice']
+    assert store.search('super*', 'users', 'full_name') == []
+    with pytest.raises(ValueError):
+        store.search('  ')
+    with pytest.raises(ValueError):
+        store.search('sunset', column='username')
+
+
+def test_export(store):
+    store.save_page('alice', make_user(), make_posts())
+    csv_text = b''.join(store.iter_export('posts', 'csv', chunk_size=2)).decode()
+    lines = csv_text.splitlines()
+    assert lines[0].startswith('post_id,')
+    assert len(lines) == 6
+    rows = [json.loads(line) for line in b''.join(store.iter_export('users', 'ndjson')).splitlines()]
+    assert rows[0]['username'] == 'alice'
+    assert store.get_export_watermark('posts') is not None
+    assert b''.join(store.iter_export('posts', 'ndjson', since='2999-01-01 00:00:00')) == b''
+    with pytest.raises(ValueError):
+        store.iter_export('posts', 'xml')
+
+
+def test_incremental_export_picks_up_metric_changes(store):
+    store.save_page('alice', make_user(), make_posts())
+    since = store.get_export_watermark('posts')
+    time.sleep(1.1)
+    store.save_page('alice', make_user(), metrics=[dict(post, liked_by=post['liked_by'] + (post['post_id'] == '1003'))
+                                                   for post in make_posts()])
+    rows = [json.loads(line) for line in b''.join(store.iter_export('posts', 'ndjson', since=since)).splitlines()]
+    assert [(row['post_id'], row['liked_by']) for row in rows] == [('1003', 4)]
+
+
+def test_status_schedule_and_freshness(store):
+    store.update_scraping_status('alice', 'completed', posts_count=5)
+    store.update_refresh_schedule('alice', int(time.time()) - 10, change_rate=0.5, last_followers=100)
+    store.update_refresh_schedule('bob', int(time.time()) + 3600)
+    assert store.get_recently_scraped(['alice', 'bob'], 60) == {'alice'}
+    assert store.get_due_refreshes(int(time.time())) == ['alice']
+    status = store.get_scraping_status('alice')
+    assert (status['status'], status['change_rate'], status['last_followers']) == ('completed', 0.5, 100)
+
+    # The failure count is kept by a bare reschedule and reset explicitly.
+    store.update_refresh_schedule('alice', int(time.time()) + 60, refresh_failures=2)
+    store.update_refresh_schedule('alice', int(time.time()) + 120)
+    assert store.get_scraping_status('alice')['refresh_failures'] == 2
+    store.update_refresh_schedule('alice', int(time.time()) + 180, refresh_failures=0)
+    assert store.get_scraping_status('alice')['refresh_failures'] == 0
+
+
+def test_media_manifest(store):
+    store.record_media('k1', 's3/k1', 10, 'etag', 'hash1')
+    assert store.get_media('k1')['s3_key'] == 's3/k1'
+    assert store.get_media_by_hash('hash1')['url_key'] == 'k1'
+
+
+def test_archive_index_is_idempotent(store):
+    # A write-behind replay of the same record must not duplicate it.
+    store.record_archive('alice', 'profile', None, 'segment-1', 0, 10, 'gzip', 40)
+    store.record_archive('alice', 'profile', None, 'segment-1', 0, 10, 'gzip', 40)
+    store.record_archive('alice', 'timeline', 'c1', 'segment-1', 10, 20, 'gzip', 80)
+    assert [record['kind'] for record in store.get_archive_records('alice')] == ['profile', 'timeline']
+    assert store.get_archived_usernames() == ['alice']
+    assert store.get_archive_stats() == {'records': 2, 'users': 1, 'stored_bytes': 30, 'raw_bytes': 120}
+
+
+def test_write_behind_applies_on_drain(sqlite_store, redis_client):
+    behind = storage.WriteBehindStorage(sqlite_store)
+    behind.save_page('alice', make_user(), make_posts())
+    behind.update_scraping_status('alice', 'completed', posts_count=5)
+    assert redis_client.llen(storage.WRITE_QUEUE_KEY) == 2
+    assert behind.get_user_with_posts('alice') is None
+
+    assert storage.drain(sqlite_store, once=True) == 2
+    assert redis_client.llen(storage.WRITE_QUEUE_KEY) == 0
+    assert redis_client.get(storage.WRITER_LOCK_KEY) is None
+    assert len(behind.get_user_with_posts('alice')['posts']) == 5
+    assert [row['post_id'] for row in behind.search('sunset')] != []
+
+
+def test_write_behind_waits_for_redis_instead_of_writing_around_the_queue(sqlite_store, monkeypatch):
+    # A direct write would be overtaken by the older 'running' still queued.
+    monkeypatch.setattr(storage, 'WRITE_PUSH_TIMEOUT', 2)
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(redis_utils, '_client', client)
+    behind = storage.WriteBehindStorage(sqlite_store)
+    behind.update_scraping_status('alice', 'running')
+
+    server.connected = False
+    threading.Timer(0.3, setattr, (server, 'connected', True)).start()
+    behind.update_scraping_status('alice', 'completed', posts_count=5)
+    assert sqlite_store.get_scraping_status('alice') is None
+    assert storage.drain(sqlite_store, once=True) == 2
+    assert sqlite_store.get_scraping_status('alice')['status'] == 'completed'
+
+    server.connected = False
+    with pytest.raises(Exception):
+        behind.update_scraping_status('alice', 'failed')
+    server.connected = True
+    assert client.llen(storage.WRITE_QUEUE_KEY) == 0
+    assert sqlite_store.get_scraping_status('alice')['status'] == 'completed'
+
+
+def test_drain_dead_letters_bad_writes(sqlite_store, redis_client):
+    redis_client.rpush(storage.WRITE_QUEUE_KEY, json.dumps({'op': 'no_such_op', 'args': {}}))
+    storage.WriteBehindStorage(sqlite_store).save_page('alice', make_user())
+    assert storage.drain(sqlite_store, once=True) == 2
+    assert redis_client.llen(storage.WRITE_QUEUE_KEY) == 0
+    assert json.loads(redis_client.lindex(storage.WRITE_DEAD_KEY, 0))['op'] == 'no_such_op'
+    assert sqlite_store.get_user_with_posts('alice') is not None
+
+
+def test_drain_refuses_when_another_writer_holds_the_lock(sqlite_store, redis_client):
+    redis_client.set(storage.WRITER_LOCK_KEY, 'other:1', ex=30)
+    storage.WriteBehindStorage(sqlite_store).save_page('alice', make_user())
+    with pytest.raises(RuntimeError):
+        storage.drain(sqlite_store, once=True)
+    assert redis_client.llen(storage.WRITE_QUEUE_KEY) == 1
+
+
+def test_drain_keeps_batch_when_lock_is_lost(sqlite_store, redis_client):
+    # Another writer takes over mid-batch: the batch must stay queued for
+    # it rather than be trimmed by the writer that lost the lock.
+    class Stolen:
+        def write(self, ops):
+            sqlite_store.write(ops)
+            redis_client.set(storage.WRITER_LOCK_KEY, 'other:1', ex=30)
+
+    storage.WriteBehindStorage(sqlite_store).save_page('alice', make_user())
+    with pytest.raises(RuntimeError):
+        storage.drain(Stolen(), once=True)
+    assert redis_client.llen(storage.WRITE_QUEUE_KEY) == 1
+    assert redis_client.get(storage.WRITER_LOCK_KEY) == b'other:1'
+
+
+def test_drain_renews_lock_during_slow_batch(sqlite_store, redis_client, monkeypatch):
+    monkeypatch.setattr(storage, 'WRITER_LOCK_TTL', 1)
+
+    batches = []
+
+    class Slow:
+        def write(self, ops):
+            time.sleep(0 if batches else 1.5)
+            sqlite_store.write(ops)
+            batches.append(ops)
+
+    storage.WriteBehindStorage(sqlite_store).save_page('alice', make_user())
+    assert storage.drain(Slow(), once=True) == 1
+    assert redis_client.llen(storage.WRITE_QUEUE_KEY) == 0
+    # Trimmed on the first pass, not re-applied after the lock expired.
+    assert len(batches) == 1
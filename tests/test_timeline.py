@@ -0,0 +1,169 @@
+import json
+import asyncio
+from urllib.parse import parse_qs, urlsplit
+import fakeredis
+import pytest
+import db_utils
+import redis_utils
+import storage
+import insta_scraper
+import async_scraper
+
+PAGE_SIZE = 3
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode()
+        self.headers = {}
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession:
+    # Serves one account whose timeline is `posts` (newest first), split into
+    # PAGE_SIZE pages; page n > 0 is fetched with cursor f'c{n}'.
+    def __init__(self, posts):
+        self.posts = posts
+        self.timeline_status = 200
+        self.failing_media = set()
+        self.cursors = []
+
+    def page(self, n):
+        edges = [{'node': {'id': str(post_id), 'taken_at_timestamp': post_id, 'display_url': f'https://cdn/{post_id}.jpg',
+                           'edge_liked_by': {'count': 1}}}
+                 for post_id in self.posts[n * PAGE_SIZE:(n + 1) * PAGE_SIZE]]
+        has_next = (n + 1) * PAGE_SIZE < len(self.posts)
+        return {'count': len(self.posts), 'edges': edges,
+                'page_info': {'has_next_page': has_next, 'end_cursor': f'c{n + 1}' if has_next else None}}
+
+    def get(self, url, proxies=None):
+        if 'web_profile_info' in url:
+            return FakeResponse(200, {'data': {'user': {'id': '42', 'username': 'alice',
+                                                        'edge_owner_to_timeline_media': self.page(0)}}})
+        cursor = json.loads(parse_qs(urlsplit(url).query)['variables'][0])['after']
+        self.cursors.append(cursor)
+        if self.timeline_status != 200:
+            return FakeResponse(self.timeline_status)
+        page = self.page(int(cursor[1:]))
+        return FakeResponse(200, {'data': {'user': {'edge_owner_to_timeline_media': page}}})
+
+
+@pytest.fixture
+def scraper(tmp_path, monkeypatch):
+    monkeypatch.setattr(redis_utils, '_client', fakeredis.FakeRedis())
+    monkeypatch.setattr(db_utils, 'db_path', str(tmp_path / 'test.db'))
+    store = storage.SQLiteStorage()
+    store.init()
+    monkeypatch.setattr(insta_scraper, 'storage', store)
+    monkeypatch.setattr(insta_scraper, 'archive_response', lambda *args, **kwargs: None)
+    monkeypatch.setattr(insta_scraper, 'Throttle', lambda *args, **kwargs: None)
+    session = FakeSession([])
+    monkeypatch.setattr(insta_scraper, 'GetSession', lambda: session)
+
+    def download(url, filename):
+        return None if filename in session.failing_media else filename.split('/')[-1]
+
+    monkeypatch.setattr(insta_scraper, 'DownloadMedia', download)
+    yield session, store
+    db_utils.close_connection()
+
+
+def stored_ids(store):
+    return {post['post_id'] for post in store.get_user_posts('alice', limit=100)['posts']}
+
+
+def test_refresh_stops_at_known_post(scraper):
+    session, store = scraper
+    session.posts = list(range(109, 100, -1))
+    assert insta_scraper.ScrapeUser('alice')
+    assert session.cursors == ['c1', 'c2']
+    assert store.get_scraping_status('alice')['backfill_complete']
+
+    session.posts = [111, 110] + session.posts
+    session.cursors = []
+    assert insta_scraper.ScrapeUser('alice')
+    assert session.cursors == []
+    assert stored_ids(store) == {str(post_id) for post_id in range(101, 112)}
+
+
+def test_failed_media_on_page_two_is_retried(scraper):
+    session, store = scraper
+    session.posts = list(range(103, 100, -1))
+    assert insta_scraper.ScrapeUser('alice')
+
+    # Two pages of new posts; one on the second page loses its media.
+    session.posts = list(range(109, 103, -1)) + session.posts
+    session.failing_media = {'media/42_105.jpg'}
+    assert insta_scraper.ScrapeUser('alice')
+    assert '105' not in stored_ids(store)
+    assert store.get_scraping_status('alice')['retry_taken_at'] == 105
+
+    # The first page is all stored now, but the walk goes on past the mark.
+    session.failing_media = set()
+    session.cursors = []
+    assert insta_scraper.ScrapeUser('alice')
+    assert session.cursors == ['c1']
+    assert '105' in stored_ids(store)
+    assert store.get_scraping_status('alice')['retry_taken_at'] is None
+
+
+def test_backfill_resumes_from_end_cursor(scraper, monkeypatch):
+    session, store = scraper
+    monkeypatch.setattr(insta_scraper, 'MAX_TIMELINE_PAGES', 2)
+    session.posts = list(range(112, 100, -1))
+    assert insta_scraper.ScrapeUser('alice')
+    status = store.get_scraping_status('alice')
+    assert (status['end_cursor'], status['backfill_complete']) == ('c2', 0)
+
+    # The refresh pass spends one page of the budget; the rest resumes the
+    # backfill where the last scrape left it.
+    for cursor, expected in (('c2', ('c3', 0)), ('c3', (None, 1))):
+        session.cursors = []
+        assert insta_scraper.ScrapeUser('alice')
+        assert session.cursors == [cursor]
+        status = store.get_scraping_status('alice')
+        assert (status['end_cursor'], status['backfill_complete']) == expected
+    assert len(stored_ids(store)) == 12
+
+
+def test_timeline_404_keeps_checkpoint(scraper, monkeypatch):
+    # Only the profile URL says the account is gone; a timeline 404 (say, a
+    # stale query hash) stops the walk and leaves the cursor to resume from.
+    session, store = scraper
+    monkeypatch.setattr(insta_scraper, 'MAX_TIMELINE_PAGES', 2)
+    session.posts = list(range(112, 100, -1))
+    assert insta_scraper.ScrapeUser('alice')
+
+    session.timeline_status = 404
+    assert insta_scraper.ScrapeUser('alice')
+    status = store.get_scraping_status('alice')
+    assert (status['status'], status['end_cursor']) == ('completed', 'c2')
+
+
+def test_async_timeline_404_is_not_a_missing_profile(scraper, monkeypatch):
+    session, store = scraper
+    session.timeline_status = 404
+
+    class AsyncSession:
+        async def get(self, url, proxies=None):
+            return session.get(url, proxies)
+
+    async def no_wait(bucket, key=None):
+        pass
+
+    async def fetch():
+        scraper = async_scraper.AsyncScraper(concurrency=1)
+        await scraper.session.close()
+        scraper.session = AsyncSession()
+        try:
+            return await scraper.fetch_timeline_page({'id': '42', 'username': 'alice'}, 'c2')
+        finally:
+            scraper.executor.shutdown()
+
+    monkeypatch.setattr(async_scraper, 'WaitForToken', no_wait)
+    assert asyncio.run(fetch()) is None
+    assert session.cursors == ['c2']